@@ -38,7 +38,8 @@ from fabric.api import env, abort
 from fabtools import require
 import requests
 
-from fabfile.utils import get_psql_version, _upload_template, get_real_instance, run_once_per_host
+from fabfile.utils import (get_psql_version, _upload_template, get_real_instance, run_once_per_host,
+                           invalidate_host_facts)
 
 
 @task
@@ -50,6 +51,7 @@ def start_services():
 @roles('db')
 def setup_db():
     require.postgres.server()
+    invalidate_host_facts(['get_psql_version'], env.host_string)
     require.deb.package("postgis")
     with warn_only():
         status_line = run(r'dpkg -s postgis | grep "Suggests\|Recommends"')
@@ -47,28 +47,37 @@ from fabric.contrib.files import exists
 from fabric.decorators import roles
 from fabric.operations import run, get
 from fabric.api import execute, task, env, sudo
-from fabtools import require, python
+from fabtools import require
 
 from fabfile.component import load_balancer
 from fabfile.utils import (_install_packages, _upload_template, get_real_instance,
-                           start_or_stop_with_delay, get_bool_from_cli, get_host_addr, show_version)
+                           start_or_stop_with_delay, get_bool_from_cli, get_host_addr, show_version,
+                           parallel_on_role, require_pip, invalidate_host_facts,
+                           fetch_remote_checksums)
 
 
 @task
+@parallel_on_role('ws')
 @roles('ws')
 def update_jormungandr_conf():
     """
-    update the jormungandr configuration
+    update the jormungandr configuration, returns the list of updated files
     """
     require.files.directories([env.jormungandr_base_dir, env.jormungandr_instances_dir, env.jormungandr_log_dir],
                               owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
 
-    _upload_template('jormungandr/jormungandr.wsgi.jinja', env.jormungandr_wsgi_file,
-                     context={
-                         'env': env
-                     })
-    _upload_template('jormungandr/settings.py.jinja', env.jormungandr_settings_file,
-                     context={'env': env})
+    templates = (('jormungandr/jormungandr.wsgi.jinja', env.jormungandr_wsgi_file),
+                 ('jormungandr/settings.py.jinja', env.jormungandr_settings_file))
+    return [dest for template, dest in templates
+            if _upload_template(template, dest, context={'env': env})]
+
+
+@task
+@roles('ws')
+def fetch_jormungandr_conf_checksums():
+    """ get in one command the checksums of all the jormungandr configuration files of the host """
+    fetch_remote_checksums([env.jormungandr_wsgi_file, env.jormungandr_settings_file] +
+                           [instance.jormungandr_config_file for instance in env.instances.values()])
 
 
 @task
@@ -86,6 +95,7 @@ def setup_jormungandr():
     execute(start_jormungandr_all)
 
 @task
+@parallel_on_role('ws')
 @roles('ws')
 #@runs_once
 def upgrade_ws_packages():
@@ -106,11 +116,11 @@ def upgrade_ws_packages():
         packages.append('libzmq-dev')
 
     require.deb.packages(packages)
+    invalidate_host_facts(['apache_version'], env.host_string)
     package_filter_list = ['navitia-jormungandr*deb',
                            'navitia-common*deb']
     _install_packages(package_filter_list)
-    if not python.is_pip_installed():
-        python.install_pip()
+    require_pip()
 
     #we want the version of the system for these packages
     run('''sed -e "/protobuf/d" -e "/psycopg2/d"  /usr/share/jormungandr/requirements.txt > /tmp/jormungandr_requirements.txt''')
@@ -289,18 +299,21 @@ def deploy_jormungandr_instance_conf(instance):
     """ Deploy or redeploy one jormungander coverage:
         * Deploy the json configuration file
         * Do not reload apache
+        returns the list of updated files
     """
     instance = get_real_instance(instance)
     config = {'key': instance.name,
               'zmq_socket': instance.jormungandr_zmq_socket_for_instance,
               'realtime_proxies': instance.realtime_proxies}
-    _upload_template("jormungandr/instance.json.jinja",
+    if _upload_template("jormungandr/instance.json.jinja",
                      instance.jormungandr_config_file,
                      context={
                          'json': json.dumps(config, indent=4)
                      },
                      use_sudo=True
-    )
+    ):
+        return [instance.jormungandr_config_file]
+    return []
 
 
 @task
@@ -29,23 +29,30 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
+import multiprocessing
 import os.path
-from retrying import Retrying
+from pipes import quote
+import threading
+import time
 import simplejson as json
 import requests
 
 from fabric.api import task, env, sudo, execute
 from fabric.colors import blue, red, green, yellow
-from fabric.context_managers import settings
+from fabric.context_managers import settings, hide
 from fabric.contrib.files import exists, is_link
 from fabric.decorators import roles
 from fabric.operations import run
 from fabric.utils import abort
-from fabtools import require, service, files, python
+from fabtools import require, service
 
-from fabfile.utils import (get_bool_from_cli, _install_packages, get_real_instance,
+from fabfile.utils import (get_bool_from_cli, _install_packages, get_real_instance, Parallel,
                            show_version, update_init, get_host_addr,
-                           _upload_template, start_or_stop_with_delay, idempotent_symlink)
+                           _upload_template, start_or_stop_with_delay, idempotent_symlink,
+                           parallel_on_role, require_pip, fetch_remote_checksums, ConfigBundle,
+                           journal_is_done, journal_mark_done, LocalState, stat_files,
+                           BudgetPool, get_mem_available, init_forked_process, time_that,
+                           plan_fanout, normalize_host, is_current_host)
 
 
 @task
@@ -67,6 +74,7 @@ def setup_kraken():
 
 
 @task
+@parallel_on_role('eng')
 @roles('eng')
 def upgrade_engine_packages():
     packages = ['logrotate', 'python2.7', 'gcc', 'python-dev']
@@ -104,12 +112,12 @@ def set_kraken_binary(instance, old=False):
 
 
 @task
+@parallel_on_role('eng')
 @roles('eng')
 def upgrade_monitor_kraken_packages():
     package_filter_list = ['navitia-monitor-kraken*deb']
     _install_packages(package_filter_list)
-    if not python.is_pip_installed():
-        python.install_pip()
+    require_pip()
     require.python.install_requirements('/usr/share/monitor_kraken/requirements.txt',
                                         use_sudo=True,
                                         exists_action='w')
@@ -118,21 +126,28 @@ def upgrade_monitor_kraken_packages():
 @task
 def get_no_data_instances():
     """ Get instances that have no data loaded ("status": null)"""
+    kraken_status.collect()
+    # first engine of each instance without data, their data.nav.lz4 are then looked for
+    # with a single command per engine
+    no_data = {}
     for instance in env.instances.values():
         for host in instance.kraken_engines:
             instance_has_data = test_kraken(instance, fail_if_error=False, hosts=[host])
             if not instance_has_data:
-                target_file = instance.kraken_database
-                with settings(host_string=host):
-                    target_file_exists = exists(target_file)
-                if not target_file_exists:
-                    env.excluded_instances.append(instance.name)
-                    print(blue("NOTICE: no data for {}, append it to exclude list"
-                               .format(instance.name)))
-                else:
-                    print(red("CRITICAL: instance {} is not available but *has* a "
-                        "{}, please inspect manually".format(instance.name, target_file)))
+                no_data.setdefault(host, []).append(instance)
                 break
+    for host, instances in no_data.iteritems():
+        with settings(host_string=host):
+            stats = stat_files([instance.kraken_database for instance in instances])
+        for instance in instances:
+            target_file = instance.kraken_database
+            if stats[target_file] is None:
+                env.excluded_instances.append(instance.name)
+                print(blue("NOTICE: no data for {}, append it to exclude list"
+                           .format(instance.name)))
+            else:
+                print(red("CRITICAL: instance {} is not available but *has* a "
+                    "{}, please inspect manually".format(instance.name, target_file)))
 
 
 @task
@@ -142,11 +157,156 @@ def require_monitor_kraken_started():
 
 
 @task
-def restart_all_krakens(wait='serial'):
-    """restart and test all kraken instances"""
+def restart_all_krakens(wait='serial', journal_step=None):
+    """restart and test all kraken instances
+    with wait='concurrent', the krakens of many instances are restarted at the same
+    time on each host, see restart_krakens_on_host()
+    with journal_step, the instances already restarted in this step of the upgrade are skipped
+    """
     execute(require_monitor_kraken_started)
+    if env.kraken_local_data_dir:
+        # all the data copied at once, the restarts then only check that they are up to date
+        if env.kraken_stage_fanout:
+            distribute_kraken_data()
+        else:
+            execute(stage_kraken_data)
+    if env.data_nav_manifests:
+        # all the data.nav.lz4 are checked at once, before the first restart
+        for host, checks in execute(verify_data_nav_manifests).iteritems():
+            _data_nav_checks.update(((host, name), check) for name, check in checks.iteritems())
+    if wait == 'concurrent':
+        execute(restart_krakens_on_host, journal_step=journal_step)
+        return
     for instance in env.instances.values():
+        if journal_is_done(journal_step, instance.name):
+            print(blue("NOTICE: kraken {} already restarted, skipping it".format(instance.name)))
+            continue
         restart_kraken(instance, wait=wait)
+        journal_mark_done(journal_step, instance.name)
+
+
+def _reload_kraken(i_name, wait, excluded_instances):
+    """
+    set the new kraken binary, restart and test the krakens of an instance, in a forked process
+    excluded_instances is the env.excluded_instances of the parent when submitting, the forked
+    process may have been created before they were known
+    """
+    env.excluded_instances = excluded_instances
+    try:
+        instance = get_real_instance(i_name)
+        set_kraken_binary(instance)
+        restart_kraken(instance, wait=wait)
+        if not wait or instance.name in env.excluded_instances:
+            return i_name, True, None
+        hosts = set(instance.kraken_engines).intersection(env.roledefs['eng'])
+        # the statuses were invalidated by the restart, the ones stored since were observed after it,
+        # however long the restart of the other engines took
+        not_loaded = [get_host_addr(h) for h in hosts
+                      if not (kraken_status.cached(h, instance.name, max_age=float('inf')) or {}).get('loaded')]
+        return i_name, not not_loaded, 'not loaded on {}'.format(', '.join(not_loaded)) if not_loaded else None
+    except (Exception, SystemExit) as e:
+        return i_name, False, repr(e)
+
+
+class KrakenReloader(object):
+    """
+    reload the krakens of instances as soon as they are submitted (eg when their binarization
+    is over), in nb_process forked processes: new binary, restart and test (see _reload_kraken())
+
+    reloader = KrakenReloader(4)
+    reloader.submit('fr-idf')
+    failed = reloader.join()
+    """
+    def __init__(self, nb_process, wait='serial', journal_step=None):
+        self.wait = wait
+        self.journal_step = journal_step
+        self.results = {}
+        self.pool = multiprocessing.Pool(nb_process, initializer=init_forked_process)
+
+    def submit(self, i_name):
+        if i_name in self.results:
+            return
+        if journal_is_done(self.journal_step, i_name):
+            print(blue("NOTICE: kraken {} already restarted, skipping it".format(i_name)))
+            self.results[i_name] = None
+            return
+        print(blue("reloading kraken {}".format(i_name)))
+        self.results[i_name] = self.pool.apply_async(_reload_kraken, (i_name, self.wait, list(env.excluded_instances)),
+                                                     callback=self._done)
+
+    def _done(self, result):
+        i_name, ok, error = result
+        if ok:
+            journal_mark_done(self.journal_step, i_name)
+            print(green("kraken {} reloaded".format(i_name)))
+        else:
+            print(red("ERROR: reload of kraken {} failed: {}".format(i_name, error)))
+
+    def join(self):
+        """ wait for all the reloads, returns the instances whose reload failed """
+        self.pool.close()
+        self.pool.join()
+        return sorted(i_name for i_name, result in self.results.iteritems() if result and not result.get()[1])
+
+
+@task
+@parallel_on_role('eng')
+@roles('eng')
+def restart_krakens_on_host(journal_step=None):
+    """
+    restart and test all the krakens of the host, many at the same time as long as the
+    data being loaded fits in memory:
+    the data of each kraken is expected to need env.kraken_memory_factor times the size of its
+    data.nav.lz4, and the sum for the krakens loading at the same time stays under
+    env.kraken_memory_ratio of the memory available on the host, once the krakens are stopped
+    the commands of the restarts are run one at a time (see _env_lock), the loadings overlap
+    """
+    host = get_host_addr(env.host_string)
+    instances = []
+    for instance in env.instances.values():
+        if not is_current_host(instance.kraken_engines):
+            continue
+        if journal_is_done(journal_step, '{}@{}'.format(instance.name, host)):
+            print(blue("NOTICE: kraken {} already restarted on {}, skipping it".format(instance.name, host)))
+            continue
+        instances.append(instance)
+    if not instances:
+        return {}
+    sizes = stat_files([i.kraken_database for i in instances])
+    # the memory used by the krakens being restarted is freed when they are stopped
+    rss = _krakens_rss()
+    budget = (get_mem_available() + sum(rss.get(i.name, 0) for i in instances)) * env.kraken_memory_ratio
+    print(blue("restarting {} krakens on {}, {:.1f} GB available to load their data".format(
+        len(instances), host, budget / 2 ** 30)))
+    # the data is copied and checked before the restarts, in single commands
+    if env.kraken_local_data_dir:
+        _stage_data(instances)
+    if env.data_nav_manifests:
+        checks = _run_on_files(_MANIFEST_CHECK, [i.kraken_database for i in instances])
+        _data_nav_checks.update(((env.host_string, i.name), checks.get(i.kraken_database, 'unknown'))
+                                for i in instances)
+
+    def restart(instance):
+        with _env_lock:
+            if not restart_kraken_on_host(instance, env.host_string, stage=False):
+                return False
+        if instance.name in env.excluded_instances:
+            loaded = True
+        else:
+            loaded = bool(wait_kraken_loaded(instance, host, fail_if_error=False).get('loaded'))
+        if loaded:
+            journal_mark_done(journal_step, '{}@{}'.format(instance.name, host))
+        return loaded
+
+    jobs = [((sizes[i.kraken_database].size if sizes[i.kraken_database] else 0) * env.kraken_memory_factor, i)
+            for i in instances]
+    results = BudgetPool(budget, env.kraken_restart_nb_thread).map(restart, jobs)
+    failed = [instance.name for instance, loaded in results if not loaded]
+    if failed:
+        print(red("ERROR: krakens not loaded on {}: {}".format(host, ', '.join(failed))))
+    else:
+        print(green("OK: all krakens loaded on {}".format(host)))
+    return {instance.name: loaded for instance, loaded in results}
 
 
 @task
@@ -161,6 +321,8 @@ def require_all_krakens_started():
 def test_all_krakens(wait=False):
     """test all kraken instances"""
     wait = get_bool_from_cli(wait)
+    if not wait:
+        kraken_status.collect()
     for instance in env.instances.values():
         test_kraken(instance, fail_if_error=False, wait=wait, loaded_is_ok=True)
 
@@ -168,8 +330,8 @@ def test_all_krakens(wait=False):
 @task
 @roles('tyr_master')
 def swap_all_data_nav(force=False):
-    for instance in env.instances.values():
-        swap_data_nav(instance, force)
+    """ swap old/new data.nav.lz4 of all the instances at once, see swap_data_navs() """
+    return swap_data_navs(env.instances.values(), force)
 
 
 @task
@@ -177,17 +339,252 @@ def swap_all_data_nav(force=False):
 def swap_data_nav(instance, force=False):
     """ swap old/new data.nav.lz4, only if new is still in temp directory
     """
+    instance = get_real_instance(instance)
+    return swap_data_navs([instance], force)[instance.name]
+
+
+def _data_nav_targets(instance):
+    """ the data.nav.lz4 of the instance and the one written in the temp directory by the binarizations """
     plain_target = get_real_instance(instance).target_lz4_file
-    temp_target = os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
-    if exists(plain_target):
-        if exists(temp_target) and \
-           (force or (files.getmtime(temp_target) > files.getmtime(plain_target))):
-            swap_temp = os.path.join(os.path.dirname(temp_target), 'x')
-            files.move(plain_target, swap_temp)
-            files.move(temp_target, plain_target)
-            files.move(swap_temp, temp_target)
-    elif exists(temp_target):
-        files.move(temp_target, plain_target)
+    return plain_target, os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
+
+
+def swap_data_navs(instances, force=False):
+    """
+    swap old/new data.nav.lz4 of the instances, only if new is still in temp directory
+    (and more recent than old, unless force is set), in a single remote script
+    returns and prints the result of each instance:
+    swapped, moved (no old one), unchanged (temp is older), no data
+    aborts if the data.nav.lz4 of an instance could not be swapped
+    """
+    force = get_bool_from_cli(force)
+    script = []
+    for instance in instances:
+        instance = get_real_instance(instance)
+        plain_target, temp_target = _data_nav_targets(instance)
+        swap_temp = os.path.join(os.path.dirname(temp_target), 'x')
+        plain, temp, swap = quote(plain_target), quote(temp_target), quote(swap_temp)
+        script.append(
+            "if [ -e {plain} ]; then "
+            "if [ -e {temp} ] && {newer}; then "
+            "{{ mv {plain} {swap} && mv {temp} {plain} && mv {swap} {temp}; }} "
+            "&& echo '{name} swapped' || echo '{name} failed'; "
+            "else echo '{name} unchanged'; fi; "
+            "elif [ -e {temp} ]; then mv {temp} {plain} && echo '{name} moved' || echo '{name} failed'; "
+            "else echo '{name} no data'; fi"
+            .format(plain=plain, temp=temp, swap=swap, name=instance.name,
+                    newer='true' if force else '[ {} -nt {} ]'.format(temp, plain)))
+    if not script:
+        return {}
+    # the errors of mv are printed on stderr, only the results are read on stdout
+    with settings(hide('running', 'stdout')):
+        output = run('; '.join(script), combine_stderr=False)
+    results = dict(line.strip().split(' ', 1) for line in output.splitlines() if line.strip())
+    for name, result in sorted(results.iteritems()):
+        print((red if result == 'failed' else blue)("{}: data.nav.lz4 {}".format(name, result)))
+    if env.data_nav_manifests:
+        write_data_nav_manifests([get_real_instance(i).target_lz4_file for i in instances
+                                  if results.get(get_real_instance(i).name) in ('swapped', 'moved')])
+    failed = sorted(i.name for i in map(get_real_instance, instances) if results.get(i.name, 'failed') == 'failed')
+    if failed:
+        # a swap may have failed halfway, leaving no data.nav.lz4: its krakens must not be restarted
+        abort(red("ERROR: the data.nav.lz4 of {} could not be swapped".format(', '.join(failed))))
+    return results
+
+
+# check done by verify_data_nav_manifests() before restarting a kraken: ok, unknown (no manifest,
+# or the file has been rewritten since), missing, truncated or corrupt
+_MANIFEST_CHECK = """f=$1
+[ -e "$f" ] || { echo "$f missing"; exit 0; }
+[ -e "$f.manifest" ] || { echo "$f unknown"; exit 0; }
+read hash size mtime < "$f.manifest"
+set -- $(stat --format '%s %Y' "$f")
+[ "$2" = "$mtime" ] || { echo "$f unknown"; exit 0; }
+[ "$1" = "$size" ] || { echo "$f truncated"; exit 0; }
+[ "$({hash_command} < "$f" | cut -d' ' -f1)" = "$hash" ] && echo "$f ok" || echo "$f corrupt"
+"""
+
+_MANIFEST_WRITE = """f=$1
+s=$(stat --format '%s %Y' "$f") && set -- $s && hash=$({hash_command} < "$f") && set -- ${hash%% *} "$@" &&
+echo "$1 $2 $3" > "$f.manifest.tmp" && mv -f "$f.manifest.tmp" "$f.manifest" && echo "$f ok" || echo "$f failed"
+"""
+
+
+def _run_on_files(script, paths):
+    """
+    run a sh script on each file of the current host, env.data_nav_hash_nb_process at the same
+    time, in a single command
+    returns a dict path -> last word printed by the script for this file
+    """
+    if not paths:
+        return {}
+    script = script.replace('{hash_command}', env.data_nav_hash_command)
+    # a file that can't be read must not abort the others, the script reports it
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run("printf '%s\\0' {} | xargs -0 -n 1 -P {} sh -c {} _".format(
+            ' '.join(quote(p) for p in paths), env.data_nav_hash_nb_process, quote(script)))
+    return dict(line.strip().rsplit(' ', 1) for line in output.splitlines() if line.strip())
+
+
+def write_data_nav_manifests(paths):
+    """
+    write next to each data file of the current host a <file>.manifest with its hash
+    (env.data_nav_hash_command), size and modification time, see verify_data_nav_manifests
+    returns the files whose manifest could not be written
+    """
+    results = _run_on_files(_MANIFEST_WRITE, paths)
+    failed = [p for p in paths if results.get(p) != 'ok']
+    if failed:
+        print(red("ERROR: can't write the manifest of {}".format(', '.join(failed))))
+    return failed
+
+
+@task
+@roles('tyr_master')
+def write_all_data_nav_manifests():
+    """ write the manifest of the data.nav.lz4 of all the instances, see write_data_nav_manifests() """
+    return write_data_nav_manifests([i.target_lz4_file for i in env.instances.values()])
+
+
+@task
+@parallel_on_role('eng')
+@roles('eng')
+def verify_data_nav_manifests():
+    """
+    check the data.nav.lz4 of all the krakens of the host against their manifest, in parallel
+    returns a dict instance -> ok, unknown, missing, truncated or corrupt
+    """
+    instances = [i for i in env.instances.values() if is_current_host(i.kraken_engines)]
+    results = _run_on_files(_MANIFEST_CHECK, [i.kraken_database for i in instances])
+    checks = {i.name: results.get(i.kraken_database, 'unknown') for i in instances}
+    for name, check in sorted(checks.iteritems()):
+        if check in ('truncated', 'corrupt'):
+            print(red("ERROR: data.nav.lz4 of {} is {} on {}".format(name, check, env.host_string)))
+    print(blue("data.nav.lz4 checked on {}: {}".format(env.host_string, ', '.join(
+        '{} {}'.format(len([c for c in checks.itervalues() if c == check]), check)
+        for check in sorted(set(checks.itervalues()))))))
+    return checks
+
+
+def _rsync_command(local=False):
+    """ rsync copying the data of the krakens, delta transfer is not the default for local copies """
+    return 'rsync --times{} --ignore-missing-args{}'.format(
+        ' --no-whole-file' if local else '',
+        ' --bwlimit={}'.format(env.kraken_stage_bwlimit) if env.kraken_stage_bwlimit else '')
+
+
+def _stage_data(instances):
+    """
+    copy the data of the krakens of the instances (kraken_shared_database) to their kraken_database,
+    in env.kraken_local_data_dir of the current host, with its manifest if any (see
+    write_data_nav_manifests()), in a single command. rsync only copies the data that changed
+    (delta transfer, the source still has to be read) and replaces the local file atomically.
+    """
+    script = []
+    for instance in instances:
+        source = instance.kraken_shared_database
+        script.append("mkdir -p {dir} && {rsync} {source} {manifest} {dir}/".format(
+            dir=quote(os.path.dirname(instance.kraken_database)), rsync=_rsync_command(local=True),
+            source=quote(source), manifest=quote(source + '.manifest')))
+    if script:
+        with settings(hide('running', 'stdout')):
+            run(' && '.join(script))
+
+
+@task
+@parallel_on_role('eng')
+@roles('eng')
+def stage_kraken_data():
+    """ copy the data of all the krakens of the host to env.kraken_local_data_dir, see _stage_data() """
+    instances = [i for i in env.instances.values() if is_current_host(i.kraken_engines)]
+    with time_that(blue("data of {} krakens staged on {} in {{elapsed}}".format(len(instances), env.host_string))):
+        _stage_data(instances)
+
+
+def _fanout_link(link):
+    """
+    copy the data of an instance to the local data directory of an engine (the destination),
+    from another engine (the source, which needs ssh access to it) or from its shared data
+    (source None), then check it against its manifest, in a forked process
+    returns the link, whether the copy is valid, and its duration
+    """
+    i_name, source, destination = link
+    instance = get_real_instance(i_name)
+    start = time.time()
+    try:
+        with settings(host_string=destination):
+            if source is None:
+                _stage_data([instance])
+            else:
+                with settings(hide('running', 'stdout')):
+                    run("mkdir -p {dir} && {rsync} {source} {manifest} {dir}/".format(
+                        dir=quote(os.path.dirname(instance.kraken_database)), rsync=_rsync_command(),
+                        source=quote('{}:{}'.format(source, instance.kraken_database)),
+                        manifest=quote(':{}.manifest'.format(instance.kraken_database))))
+            valid = True
+            if env.data_nav_manifests:
+                check = _run_on_files(_MANIFEST_CHECK, [instance.kraken_database]).get(instance.kraken_database)
+                valid = check in ('ok', 'unknown')
+    except (Exception, SystemExit) as e:
+        print(red("ERROR: copy of the data of {} to {} failed: {}".format(i_name, destination, e)))
+        valid = False
+    return link, valid, time.time() - start
+
+
+@task
+def distribute_kraken_data(nb_process=None):
+    """
+    copy the data of the krakens to env.kraken_local_data_dir on their engines as trees (see
+    plan_fanout()): the first engine of an instance copies its shared data, then each engine having
+    a valid copy sends it to another one. The engines need ssh access to each other.
+    An engine whose copy from another engine failed copies the shared data at the next round.
+    nb_process copies are run at the same time (default env.kraken_fanout_nb_process)
+    returns the engines that have no valid copy, by instance
+    """
+    holders = {name: [None] for name in env.instances}
+    missing = {i.name: [e for e in i.kraken_engines if e in env.roledefs['eng']] for i in env.instances.values()}
+    failed, fallbacks = {}, []
+    pool = multiprocessing.Pool(int(nb_process or env.kraken_fanout_nb_process), init_forked_process)
+    try:
+        while any(missing.values()) or fallbacks:
+            # next round of all the instances, the hosts that failed are not sources
+            links = [(name, source, destination) for name in missing
+                     for source, destination in (plan_fanout(holders[name], missing[name]) or [[]])[0]]
+            for name, _, destination in links:
+                missing[name].remove(destination)
+            links, fallbacks = fallbacks + links, []
+            results = pool.imap_unordered(_fanout_link, links)
+            for n, ((name, source, destination), valid, duration) in enumerate(results, 1):
+                print((green if valid else red)("{}: {} -> {} {} in {:.0f}s ({}/{})".format(
+                    name, get_host_addr(source) if source else 'shared data', get_host_addr(destination),
+                    'done' if valid else 'FAILED', duration, n, len(links))))
+                if valid:
+                    holders[name].append(destination)
+                elif source is not None:
+                    fallbacks.append((name, None, destination))
+                else:
+                    failed.setdefault(name, []).append(destination)
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+
+# results of verify_data_nav_manifests(), by (host, instance), used by the next restart
+_data_nav_checks = {}
+
+
+def _data_nav_is_sound(instance, host):
+    """ False if the data.nav.lz4 of the kraken is truncated or corrupt, see verify_data_nav_manifests() """
+    check = _data_nav_checks.pop((host, instance.name), None)
+    if check is None:
+        with settings(host_string=host):
+            check = _run_on_files(_MANIFEST_CHECK, [instance.kraken_database]).get(instance.kraken_database)
+    if check in ('truncated', 'corrupt'):
+        print(red("ERROR: data.nav.lz4 of {} is {} on {}, not restarting its kraken".format(
+            instance.name, check, host)))
+        return False
+    return True
 
 
 @task
@@ -199,39 +596,46 @@ def purge_data_nav(force=False):
     - temp data file is more recent than actual data file
     - temp data file exists but actual data file is missing
     """
-    if not force:
+    targets = {instance.name: _data_nav_targets(instance) for instance in env.instances.values()}
+    stats = stat_files([f for plain_temp in targets.itervalues() for f in plain_temp])
+    if not get_bool_from_cli(force):
         print("Checking lz4 temp files purge conditions before proceeding...")
         reason = {}
-        for instance in env.instances.values():
-            plain_target = get_real_instance(instance).target_lz4_file
-            temp_target = os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
-            if exists(plain_target):
-                if exists(temp_target) and files.getmtime(temp_target) > files.getmtime(plain_target):
-                    reason[instance.name] = "{} is more recent than {}".format(temp_target, plain_target)
-            elif exists(temp_target):
-                reason[instance.name] = "{} does not exists".format(plain_target)
+        for name, (plain_target, temp_target) in targets.iteritems():
+            if stats[plain_target]:
+                if stats[temp_target] and stats[temp_target].mtime > stats[plain_target].mtime:
+                    reason[name] = "{} is more recent than {}".format(temp_target, plain_target)
+            elif stats[temp_target]:
+                reason[name] = "{} does not exists".format(plain_target)
         if reason:
             print(yellow("Error: Can't purge lz4 temp files, reasons:"))
             for k, v in reason.iteritems():
                 print("  {}: {}".format(k, v))
             exit(1)
 
-    for instance in env.instances.values():
-        plain_target = get_real_instance(instance).target_lz4_file
-        temp_target = os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
-        if exists(temp_target):
-            files.remove(temp_target)
+    temp_targets = [temp_target for _, temp_target in targets.itervalues() if stats[temp_target]]
+    print(blue("purging {} lz4 temp files, {:.1f} GB reclaimed".format(
+        len(temp_targets), sum(stats[f].size for f in temp_targets) / float(2 ** 30))))
+    if temp_targets:
+        run('rm -f {}'.format(' '.join(quote(f) for f in temp_targets)))
 
 
 @task
 def check_dead_instances():
     dead = 0
     threshold = env.kraken_threshold * len(env.instances)
+    kraken_status.collect()
+    # as with _test_kraken, a kraken that can't be polled for another reason than a timeout
+    # stops the upgrade instead of being counted as dead
+    errors = ['{} on {}: {}'.format(instance.name, host, kraken_status.errors[(get_host_addr(host), instance.name)])
+              for instance in env.instances.values() for host in instance.kraken_engines_url
+              if (get_host_addr(host), instance.name) in kraken_status.errors]
+    if errors:
+        print(red("ERROR: can't poll monitor-kraken: {}".format(', '.join(errors))))
+        exit(1)
     for instance in env.instances.values():
         for host in instance.kraken_engines_url:
-            request = 'http://{}:{}/{}/?instance={}'.format(host,
-                env.kraken_monitor_port, env.kraken_monitor_location_dir, instance.name)
-            result = _test_kraken(request, fail_if_error=False)
+            result = kraken_status.get(host, instance.name, fail_if_error=False)
             if not result or result['status'] == 'timeout' or result['loaded'] is False:
                 dead += 1
     if dead > int(threshold):
@@ -255,12 +659,15 @@ def restart_kraken(instance, wait='serial'):
         :param wait: string.
                Possible values=False or None: restart in parallel, no test
                'serial': restart serially and test
-               'parallel': restart in parallel and test
+               'parallel' or 'concurrent': restart in parallel and test
         The default value is 'serial' because it is the safest scenario
         to restart the krakens of an instance in production.
     """
     if wait:
         wait = wait.lower()
+        if wait == 'concurrent':
+            # a single instance, see restart_all_krakens() for the concurrent restart of many instances
+            wait = 'parallel'
         if wait not in ('serial', 'parallel'):
             wait = None
     instance = get_real_instance(instance)
@@ -278,14 +685,25 @@ def restart_kraken(instance, wait='serial'):
 
 
 @task
-def restart_kraken_on_host(instance, host):
+def restart_kraken_on_host(instance, host, stage=True):
     """ Restart a kraken of an instance on a given server
+        with env.kraken_local_data_dir and stage, its data is copied on the server first
+        with env.data_nav_manifests, a kraken whose data.nav.lz4 is truncated or corrupt
+        is not restarted
     """
     instance = get_real_instance(instance)
+    if env.kraken_local_data_dir and stage:
+        with settings(host_string=host):
+            _stage_data([instance])
+    if env.data_nav_manifests and not _data_nav_is_sound(instance, host):
+        return False
+    kraken_status.invalidate(host, instance.name)
+    _restart_dates[(get_host_addr(host), instance.name)] = time.time()
     with settings(host_string=host):
         kraken = 'kraken_' + instance.name
         start_or_stop_with_delay(kraken, 4000, 500, start=False, only_once=True)
         start_or_stop_with_delay(kraken, 4000, 500, only_once=env.KRAKEN_START_ONLY_ONCE)
+    return True
 
 
 @task
@@ -294,6 +712,7 @@ def require_kraken_started(instance):
     """
     instance = get_real_instance(instance)
     kraken = 'kraken_' + instance.name
+    kraken_status.invalidate(instance=instance.name)
     for host in instance.kraken_engines:
         with settings(host_string=host):
             start_or_stop_with_delay(kraken, 4000, 500, only_once=True)
@@ -305,18 +724,185 @@ def stop_kraken(instance):
     """
     instance = get_real_instance(instance)
     kraken = 'kraken_' + instance.name
+    kraken_status.invalidate(instance=instance.name)
     for host in instance.kraken_engines:
         with settings(host_string=host):
             start_or_stop_with_delay(kraken, 4000, 500, start=False, only_once=True)
 
 
+class KrakenStatusCollector(object):
+    """
+    status of the krakens given by monitor-kraken, shared by all the tasks of a run
+
+    the status of each (host, instance) is kept with its date and read again from
+    the monitor only when older than env.kraken_status_max_age seconds, or
+    env.kraken_status_failure_max_age seconds for a kraken that could not be reached.
+    collect() polls many krakens at the same time, with a pooled http session, and keeps
+    in errors the failures that are not timeouts.
+    """
+    def __init__(self):
+        self.snapshots = {}
+        self.errors = {}
+        self.pid = None
+
+    def _own(self):
+        """ a forked process can't use the connections nor the lock of its parent, it gets its own """
+        if self.pid != os.getpid():
+            self.pid, self._session, self._lock = os.getpid(), requests.Session(), threading.Lock()
+
+    @property
+    def session(self):
+        self._own()
+        return self._session
+
+    @property
+    def lock(self):
+        self._own()
+        return self._lock
+
+    @staticmethod
+    def url(host, instance):
+        return 'http://{}:{}/{}/?instance={}'.format(get_host_addr(host), env.kraken_monitor_port,
+                                                     env.kraken_monitor_location_dir, instance)
+
+    def store(self, host, instance, result, error=None):
+        """ result is None if the kraken could not be reached, error the reason if it is not a timeout """
+        key = (get_host_addr(host), instance)
+        with self.lock:
+            self.snapshots[key] = (time.time(), result)
+            if error is None:
+                self.errors.pop(key, None)
+            else:
+                self.errors[key] = error
+
+    def _lookup(self, host, instance, max_age=None):
+        """ returns (True, status) if the status of the kraken is fresh enough, else (False, None) """
+        snapshot = self.snapshots.get((get_host_addr(host), instance))
+        if snapshot:
+            if snapshot[1] is None:
+                max_age = env.kraken_status_failure_max_age if max_age is None else min(
+                    max_age, env.kraken_status_failure_max_age)
+            elif max_age is None:
+                max_age = env.kraken_status_max_age
+            if time.time() - snapshot[0] <= max_age:
+                return True, snapshot[1]
+        return False, None
+
+    def cached(self, host, instance, max_age=None):
+        """ returns the status of the kraken if it is fresh enough, else None """
+        return self._lookup(host, instance, max_age)[1]
+
+    def get(self, host, instance, fail_if_error=True, max_age=None):
+        fresh, result = self._lookup(host, instance, max_age)
+        # with fail_if_error, a kraken that could not be reached is polled again to fail
+        if not fresh or result is None and fail_if_error:
+            result = _test_kraken(self.url(host, instance), fail_if_error)
+            self.store(host, instance, result)
+        return result
+
+    def collect(self, instances=None, max_age=None):
+        """ poll at the same time all the krakens of the instances (all by default) not fresh enough """
+        pairs = [(host, instance.name)
+                 for instance in (instances or env.instances.values())
+                 for host in instance.kraken_engines
+                 if not self._lookup(host, instance.name, max_age)[0]]
+
+        def poll(pair):
+            result, error = None, None
+            try:
+                result = _test_kraken(self.url(*pair), fail_if_error=False)
+            except (Exception, SystemExit) as e:
+                error = repr(e)
+            self.store(pair[0], pair[1], result, error)
+
+        if pairs:
+            pool = Parallel(min(env.kraken_status_nb_thread, len(pairs)))
+            with pool:
+                pool.map(poll, pairs)
+
+    def invalidate(self, host=None, instance=None):
+        with self.lock:
+            for key in self.snapshots.keys():
+                if (host is None or key[0] == get_host_addr(host)) and instance in (None, key[1]):
+                    del self.snapshots[key]
+                    self.errors.pop(key, None)
+
+
+kraken_status = KrakenStatusCollector()
+
+# duration of the last data loading of each instance
+kraken_load_history = LocalState('kraken_load')
+# date of the last restart of each (host, instance)
+_restart_dates = {}
+# fabric's env is global: the threads restarting krakens change it (settings()) one at a time
+_env_lock = threading.RLock()
+
+
+def _expected_load_time(instance, engine):
+    """
+    how long the kraken should take to load its data: the duration of its last loading,
+    else estimated from the size of its data.nav.lz4, None if unknown
+    """
+    previous = kraken_load_history.get(instance.name)
+    if previous:
+        return previous
+    with _env_lock, settings(host_string=engine):
+        stat = stat_files([instance.kraken_database])[instance.kraken_database]
+    if stat:
+        return float(stat.size) / 2 ** 20 / env.kraken_load_rate
+
+
+def _is_kraken_running(instance, engine):
+    with _env_lock, settings(hide('running', 'stdout', 'warnings'), host_string=engine, warn_only=True):
+        return run("pgrep --full {}/kraken$".format(instance.kraken_basedir)).succeeded
+
+
+def wait_kraken_loaded(instance, host, fail_if_error=True):
+    """
+    poll monitor-kraken until the kraken of the instance on the host has loaded its data
+
+    the polls are spread over the expected loading time with an increasing interval, the
+    waiting ends early if the kraken process is not running anymore; failed polls are retried
+    """
+    engine = next((e for e in instance.kraken_engines if get_host_addr(e) == host), host)
+    start = _restart_dates.get((host, instance.name), time.time())
+    expected = _expected_load_time(instance, engine)
+    delay = env.KRAKEN_RESTART_DELAY
+    if expected:
+        delay = max(delay, expected * env.kraken_load_margin)
+        print(blue("waiting for kraken {} on {}, expected load time {:.0f}s".format(instance.name, host, expected)))
+    # no need to poll before half of the expected time
+    time.sleep(max(0, start + (expected or 0) / 2 - time.time()))
+    interval = 1
+    while True:
+        try:
+            result = _test_kraken(kraken_status.url(host, instance.name), fail_if_error)
+        except (Exception, SystemExit) as e:
+            # the monitor may not answer while kraken is restarting, keep polling until the deadline
+            print(yellow("WARNING: kraken {} on {} is not reachable yet ({!r})".format(instance.name, host, e)))
+            result = None
+        if result and result.get('loaded'):
+            kraken_status.store(host, instance.name, result)
+            kraken_load_history.set(instance.name, round(time.time() - start, 1))
+            return result
+        if not _is_kraken_running(instance, engine):
+            print(red("ERROR: kraken {} is not running anymore on {}".format(instance.name, host)))
+            return {'status': 'dead'}
+        if time.time() - start > delay:
+            print(red("ERROR: could not reach {}, too many retries ! (waited {:.0f}s)".format(
+                instance.name, time.time() - start)))
+            return {'status': False}
+        time.sleep(interval)
+        interval = min(interval * 1.5, env.kraken_poll_max_interval)
+
+
 def _test_kraken(query, fail_if_error=True):
     """
     poll on kraken monitor until it gets a 'running' status
     """
     print("calling : {}".format(query))
     try:
-        response = requests.get(query, timeout=2)
+        response = kraken_status.session.get(query, timeout=2)
     except requests.exceptions.Timeout as t:
         print("timeout error {}".format(t))
         if fail_if_error:
@@ -339,20 +925,11 @@ def test_kraken(instance, fail_if_error=True, wait=False, loaded_is_ok=None, hos
     hosts = [e.split('@')[1] for e in hosts or instance.kraken_engines]
     will_return = len(hosts) == 1
     for host in hosts:
-        request = 'http://{}:{}/{}/?instance={}'.format(host,
-            env.kraken_monitor_port, env.kraken_monitor_location_dir, instance.name)
-
         if wait:
             # we wait until we get a response and the instance is 'loaded'
-            try:
-                result = Retrying(stop_max_delay=env.KRAKEN_RESTART_DELAY * 1000,
-                                  wait_fixed=1000, retry_on_result=lambda x: x is None or not x['loaded']) \
-                    .call(_test_kraken, request, fail_if_error)
-            except Exception as e:
-                print(red("ERROR: could not reach {}, too many retries ! ({})".format(instance.name, e)))
-                result = {'status': False}
+            result = wait_kraken_loaded(instance, host, fail_if_error)
         else:
-            result = _test_kraken(request, fail_if_error)
+            result = kraken_status.get(host, instance.name, fail_if_error)
 
         try:
             if result['status'] != 'running':
@@ -403,52 +980,85 @@ def test_kraken(instance, fail_if_error=True, wait=False, loaded_is_ok=None, hos
 
 
 @task
+@parallel_on_role('eng')
 @roles('eng')
 def update_monitor_configuration():
+    """ returns the list of updated files """
+    templates = (('kraken/monitor_kraken.wsgi.jinja', env.kraken_monitor_wsgi_file),
+                 ('kraken/monitor_settings.py.jinja', env.kraken_monitor_config_file))
+    return [dest for template, dest in templates
+            if _upload_template(template, dest, context={'env': env})]
+
+
+def _eng_instance_templates(instance):
+    """ (template, destination, context, upload options) of the kraken files of an instance """
+    service_context = {'env': env,
+                       'instance': instance.name,
+                       'kraken_base_conf': env.kraken_basedir,
+    }
+    service_file = env.service_name('kraken_{}'.format(instance.name))
+    if env.use_systemd:
+        service_template = ("kraken/systemd_kraken.jinja", service_file, service_context, {'mode': '644'})
+    else:
+        service_template = ("kraken/kraken.initscript.jinja", service_file, service_context, {'mode': '755'})
+    return [("kraken/kraken.ini.jinja", "%s/%s/kraken.ini" % (env.kraken_basedir, instance.name),
+             {'env': env, 'instance': instance}, {}),
+            service_template]
 
-    _upload_template('kraken/monitor_kraken.wsgi.jinja', env.kraken_monitor_wsgi_file,
-            context={'env': env})
-    _upload_template('kraken/monitor_settings.py.jinja', env.kraken_monitor_config_file,
-            context={'env': env})
 
+@task
+@roles('eng')
+def fetch_eng_conf_checksums():
+    """ get in one command the checksums of all the kraken configuration files of the host """
+    paths = [env.kraken_monitor_wsgi_file, env.kraken_monitor_config_file]
+    for instance in env.instances.values():
+        if is_current_host(instance.kraken_engines):
+            paths.extend(dest for _, dest, _, _ in _eng_instance_templates(instance))
+    fetch_remote_checksums(paths)
+
+
+@task
+@parallel_on_role('eng')
+@roles('eng')
+def push_eng_conf_bundle():
+    """
+    push all the kraken configuration files of the host in a single archive
+    returns the updated files by instance name (None for the monitor)
+    """
+    bundle = ConfigBundle()
+    files = {None: [env.kraken_monitor_wsgi_file, env.kraken_monitor_config_file]}
+    bundle.add('kraken/monitor_kraken.wsgi.jinja', env.kraken_monitor_wsgi_file, context={'env': env})
+    bundle.add('kraken/monitor_settings.py.jinja', env.kraken_monitor_config_file, context={'env': env})
+    for instance in env.instances.values():
+        if not is_current_host(instance.kraken_engines):
+            continue
+        bundle.add_directory(os.path.join(instance.kraken_basedir, instance.name), owner=env.KRAKEN_USER)
+        files[instance.name] = []
+        for template, dest, context, options in _eng_instance_templates(instance):
+            bundle.add(template, dest, context=context, **options)
+            files[instance.name].append(dest)
+    updated = bundle.push()
+    if updated:
+        update_init(host='eng')
+    return {name: [f for f in paths if f in updated] for name, paths in files.iteritems()}
 
 
 @task
 def update_eng_instance_conf(instance, host=None):
+    """ returns the updated files by host """
     instance = get_real_instance(instance)
     hosts = [host] if host else instance.kraken_engines
+    changed = {}
     for host in hosts:
         with settings(host_string=host):
             require.files.directory(os.path.join(instance.kraken_basedir, instance.name),
                                     owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
-            _upload_template("kraken/kraken.ini.jinja", "%s/%s/kraken.ini" %
-                             (env.kraken_basedir, instance.name),
-                             context={
-                                 'env': env,
-                                 'instance': instance,
-                             }
-            )
-
-            if env.use_systemd:
-                _upload_template("kraken/systemd_kraken.jinja",
-                                 "{}".format(env.service_name('kraken_{}'.format(instance.name))),
-                                 context={'env': env,
-                                          'instance': instance.name,
-                                          'kraken_base_conf': env.kraken_basedir,
-                                 },
-                                 mode='644'
-                )
-            else:
-                _upload_template("kraken/kraken.initscript.jinja",
-                                 "{}".format(env.service_name('kraken_{}'.format(instance.name))),
-                                 context={'env': env,
-                                          'instance': instance.name,
-                                          'kraken_base_conf': env.kraken_basedir,
-                                 },
-                                 mode='755'
-                )
-            # TODO check this, make it consistent with env.use_systemd
-            update_init(host='eng')
+            changed[host] = [dest for template, dest, context, options in _eng_instance_templates(instance)
+                             if _upload_template(template, dest, context=context, **options)]
+            if changed[host]:
+                # TODO check this, make it consistent with env.use_systemd
+                update_init(host='eng')
+    return changed
 
 
 @task
@@ -586,9 +1196,7 @@ def is_not_synchronized(instance, hosts=None):
     hosts = [e.split('@')[1] for e in hosts or instance.kraken_engines]
     publication_dates = set()
     for host in hosts:
-        request = 'http://{}:{}/{}/?instance={}'.format(host,
-            env.kraken_monitor_port, env.kraken_monitor_location_dir, instance.name)
-        result = _test_kraken(request, fail_if_error=False)
+        result = kraken_status.get(host, instance.name, fail_if_error=False)
         publication_dates.add(result.get('publication_date'))
 
     print('publication date for {}, : {}'.format(instance, publication_dates))
@@ -608,6 +1216,7 @@ def check_kraken_data_synchronization():
     for the moment it's a manually called function
     """
     res = 0
+    kraken_status.collect()
     for instance in env.instances:
         res += is_not_synchronized(instance)
 
@@ -632,6 +1241,109 @@ def redeploy_kraken(instance, create=True):
     execute(remove_kraken_instance, instance, purge_logs=True, apply_on='reverse')
 
 
+def plan_placement(costs, capacities, replicas, current=None, tolerance=0.1):
+    """
+    assign the krakens of the instances to engine hosts, balancing the load of the hosts
+
+    costs: instance -> (memory, nb threads) of one of its krakens
+    capacities: host -> (memory, nb cpus)
+    replicas: instance -> number of hosts running it
+    current: instance -> hosts running it now, a current host is kept if its load is not more
+             than `tolerance` above the best host, to avoid useless moves
+
+    the biggest instances are placed first, each one on the least loaded hosts (the load of a
+    host is its biggest used fraction of memory or cpus).
+    returns (instance -> sorted list of hosts, host -> load)
+    """
+    current = current or {}
+    used = {host: [0, 0] for host in capacities}
+
+    def load(host, cost=(0, 0)):
+        return max(float(used[host][i] + cost[i]) / capacities[host][i] for i in (0, 1))
+
+    plan = {}
+    for instance in sorted(costs, key=lambda i: (costs[i], i), reverse=True):
+        cost = costs[instance]
+        plan[instance] = []
+        for _ in range(min(replicas[instance], len(capacities))):
+            candidates = sorted((load(host, cost), host) for host in capacities if host not in plan[instance])
+            best_load, host = candidates[0]
+            kept = [h for l, h in candidates if h in current.get(instance, ()) and l <= best_load + tolerance]
+            if kept:
+                host = kept[0]
+            plan[instance].append(host)
+            used[host][0] += cost[0]
+            used[host][1] += cost[1]
+        plan[instance].sort()
+    return plan, {host: load(host) for host in capacities}
+
+
+@task
+@roles('eng')
+def get_engine_resources():
+    """ returns the memory, the number of cpus and the memory used by each kraken of the host """
+    with settings(hide('running', 'stdout')):
+        memory = int(run("awk '/^MemTotal:/ {print $2}' /proc/meminfo")) * 1024
+        cpus = int(run('nproc'))
+    return memory, cpus, _krakens_rss()
+
+
+def _krakens_rss():
+    """ memory used by each kraken running on the current host, by instance """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        processes = run("ps -eo rss=,args= | grep '[/]kraken$'")
+    rss = {}
+    for line in processes.splitlines():
+        kb, _, command = line.strip().partition(' ')
+        rss[os.path.basename(os.path.dirname(command.strip()))] = int(kb) * 1024
+    return rss
+
+
+@task
+def plan_kraken_placement(replicas=None, tolerance=0.1):
+    """
+    propose a placement of the krakens on the eng hosts that balances their memory and cpu load,
+    and the redeploy_kraken moves to apply it.
+    The memory of a kraken is its measured RSS, else kraken_memory_factor times its data.nav.lz4.
+    :param replicas: number of hosts for each instance, by default its current number
+    :param tolerance: an instance stays on its current hosts if their load is not more than this above the best ones
+    """
+    resources = execute(get_engine_resources)
+    capacities = {host: (memory, cpus) for host, (memory, cpus, _) in resources.iteritems()}
+    # the engines of the instances may be named differently than in the eng role
+    hosts = {normalize_host(host): host for host in capacities}
+    costs, nb_replicas, current = {}, {}, {}
+    for instance in env.instances.values():
+        rss = [r[2][instance.name] for r in resources.values() if instance.name in r[2]]
+        if rss:
+            memory = max(rss)
+        else:
+            with settings(host_string=instance.kraken_engines[0]):
+                stat = stat_files([instance.kraken_database])[instance.kraken_database]
+            memory = stat.size * env.kraken_memory_factor if stat else 0
+        costs[instance.name] = (memory, instance.kraken_nb_threads)
+        current[instance.name] = sorted(hosts[normalize_host(h)] for h in instance.kraken_engines
+                                        if normalize_host(h) in hosts)
+        nb_replicas[instance.name] = int(replicas) if replicas else len(current[instance.name]) or 1
+
+    plan, loads = plan_placement(costs, capacities, nb_replicas, current, float(tolerance))
+
+    print(blue("Load of the eng hosts with this placement:"))
+    for host in sorted(loads):
+        print(blue("  {}: {:.0%} ({:.1f} GB, {} cpus)".format(
+            host, loads[host], capacities[host][0] / 2. ** 30, capacities[host][1])))
+        if loads[host] > 1:
+            print(red("WARNING: {} is overloaded, more engines are needed".format(host)))
+    moves = [name for name in sorted(plan) if plan[name] != current[name]]
+    if not moves:
+        print(green("The current placement is already balanced, nothing to do"))
+    for name in moves:
+        print(yellow("{}: {} -> {}".format(name, ', '.join(current[name]), ', '.join(plan[name]))))
+        print("  set zmq_server={} in add_instance('{}'), then: fab redeploy_kraken:{}".format(
+            [get_host_addr(h) for h in plan[name]], name, name))
+    return plan
+
+
 @task
 def redeploy_all_krakens(create=True):
     """
@@ -30,53 +30,89 @@
 # www.navitia.io
 
 import StringIO
+import collections
 import ConfigParser
+import datetime
+import multiprocessing
 import os
+from pipes import quote
+import Queue
 from io import BytesIO
 from retrying import Retrying, RetryError
+import threading
 import time
 
 from fabric.api import execute, env, task
 from fabric.colors import red, blue, green, yellow
-from fabric.context_managers import settings, warn_only, cd, shell_env
+from fabric.context_managers import settings, warn_only, cd, shell_env, hide
 from fabric.contrib.files import exists
 from fabric.decorators import roles
 from fabric.operations import run, get, sudo, put
-from fabtools import require, python, files
+from fabtools import require, files
 
 from fabfile.component import db
 from fabfile.component.kraken import get_no_data_instances
-from fabfile.utils import (_install_packages, _upload_template, update_init, Parallel,
+from fabfile.utils import (_install_packages, _upload_template, update_init,
                            start_or_stop_with_delay, supervision_downtime, time_that,
                            get_real_instance, require_directories, require_directory,
-                           run_once_per_host, execute_flat, idempotent_symlink)
+                           run_once_per_host, execute_flat, idempotent_symlink, parallel_on_role,
+                           require_pip, fetch_remote_checksums, changed_files, ConfigBundle,
+                           journal_is_done, journal_mark_done, LocalState, stat_files,
+                           get_mem_available, get_host_addr, get_bool_from_cli,
+                           init_forked_process, AdaptiveLimiter, estimate_makespan)
 
 
 @task
+@parallel_on_role('tyr')
 @roles('tyr')
 def update_tyr_config_file():
-    _upload_template("tyr/settings.py.jinja", env.tyr_settings_file,
-                     context={
-                        'env': env,
-                        'tyr_broker_username': env.tyr_broker_username,
-                        'tyr_broker_password': env.tyr_broker_password,
-                        'rabbitmq_host': env.rabbitmq_host,
-                        'rabbitmq_port': env.rabbitmq_port,
-                        'tyr_postgresql_user': env.tyr_postgresql_user,
-                        'tyr_postgresql_password': env.tyr_postgresql_password,
-                        'postgresql_database_host': env.postgresql_database_host,
-                        'tyr_postgresql_database': env.tyr_postgresql_database,
-                        'tyr_base_instances_dir': env.tyr_base_instances_dir,
-                        'tyr_base_logfile': env.tyr_base_logfile,
-                        'redis_host': env.redis_host,
-                        'redis_port': env.redis_port,
-                        'tyr_redis_password': env.tyr_redis_password,
-                        'tyr_redis_db': env.tyr_redis_db
-                     })
-    _upload_template('tyr/tyr.wsgi.jinja', env.tyr_wsgi_file,
-                     context={
-                         'tyr_settings_file': env.tyr_settings_file
-                     })
+    """ returns the list of updated files """
+    return [dest for template, dest, context in _tyr_config_templates()
+            if _upload_template(template, dest, context=context)]
+
+
+def _tyr_config_templates():
+    """ (template, destination, context) of the tyr files shared by all instances """
+    return [("tyr/settings.py.jinja", env.tyr_settings_file,
+             {
+                'env': env,
+                'tyr_broker_username': env.tyr_broker_username,
+                'tyr_broker_password': env.tyr_broker_password,
+                'rabbitmq_host': env.rabbitmq_host,
+                'rabbitmq_port': env.rabbitmq_port,
+                'tyr_postgresql_user': env.tyr_postgresql_user,
+                'tyr_postgresql_password': env.tyr_postgresql_password,
+                'postgresql_database_host': env.postgresql_database_host,
+                'tyr_postgresql_database': env.tyr_postgresql_database,
+                'tyr_base_instances_dir': env.tyr_base_instances_dir,
+                'tyr_base_logfile': env.tyr_base_logfile,
+                'redis_host': env.redis_host,
+                'redis_port': env.redis_port,
+                'tyr_redis_password': env.tyr_redis_password,
+                'tyr_redis_db': env.tyr_redis_db
+             }),
+            ('tyr/tyr.wsgi.jinja', env.tyr_wsgi_file,
+             {
+                 'tyr_settings_file': env.tyr_settings_file
+             })]
+
+
+@task
+@parallel_on_role('tyr')
+@roles('tyr')
+def push_tyr_conf_bundle():
+    """
+    push all the tyr configuration files of the host in a single archive
+    returns the list of updated files
+    """
+    bundle = ConfigBundle()
+    for template, dest, context in _tyr_config_templates():
+        bundle.add(template, dest, context=context)
+    for instance in env.instances.values():
+        bundle.add_directory(instance.base_ed_dir, owner=env.KRAKEN_USER)
+        for template, dest, context in _tyr_instance_templates(instance):
+            bundle.add(template, dest, context=context)
+    return bundle.push()
 
 
 @task
@@ -138,6 +174,7 @@ def setup_tyr():
 
 
 @task
+@parallel_on_role('tyr')
 @roles('tyr')
 def upgrade_tyr_packages():
     packages = [
@@ -154,8 +191,7 @@ def upgrade_tyr_packages():
     package_filter_list = ['navitia-tyr*deb',
                            'navitia-common*deb']
     _install_packages(package_filter_list)
-    if not python.is_pip_installed():
-        python.install_pip()
+    require_pip()
 
     #we want the version of the system for these packages
     run('''sed -e "/protobuf/d" -e "/psycopg2/d"  /usr/share/tyr/requirements.txt > /tmp/tyr_requirements.txt''')
@@ -205,6 +241,7 @@ def setup_tyr_master():
 
 
 @task
+@parallel_on_role('tyr')
 @roles('tyr')
 def upgrade_ed_packages():
     require.deb.packages([
@@ -320,29 +357,55 @@ def start_services():
     require.service.started('redis-server')
 
 
+def _datanav_versions(kraken_db):
+    """
+    the versions of the data.nav.lz4 stored by backup_datanav(), the most recent first:
+    a versions directory next to the data.nav.lz4, with a <md5>.lz4 file per version
+    and an index file listing them
+    """
+    versions_dir = os.path.join(os.path.dirname(kraken_db), 'versions')
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        index = run("cat {}".format(quote(os.path.join(versions_dir, 'index'))))
+    return versions_dir, index.split() if index.succeeded else []
+
+
+def _link_or_copy(source, destination):
+    """ command making destination a hardlink (see env.datanav_hardlinks) or a copy of source """
+    if env.datanav_hardlinks:
+        return "ln -f {} {}".format(quote(source), quote(destination))
+    # reflink (instant copy) where the filesystem allows it
+    # nfsv4 acl, don't try to preserve permissions, inheritance do the work
+    return "cp {}--reflink=auto {} {}".format('' if env.standalone is False else '--archive ',
+                                              quote(source), quote(destination))
+
+
 @task
 @roles('tyr')
 def backup_datanav(instance):
-    """ Backup a data.nav.lz4 for a given instance in data.nav.lz4_$instance"""
+    """
+    Store the data.nav.lz4 of a given instance as a new version, keeping the last
+    env.datanav_versions versions, see rollback_datanav()
+    """
 
     env.tyr_config = get_tyr_config(instance)
     kraken_db = env.tyr_config.get('instance', 'target-file')
 
-    # if data.nav.lz4 found, copy it
+    # if data.nav.lz4 found, store it
     if exists("%s" % (kraken_db)):
-        # nfsv4 acl, don't try to preserve permissions, inheritance do the work
-        if env.standalone is False:
-            run("cp %s %s_%s" % (kraken_db, kraken_db, instance))
-        else:
-            run("cp --archive %s %s_%s" % (kraken_db, kraken_db, instance))
-
-        # verify backup
-        print("Verify backup")
-        md5_db = run("md5sum %s | awk '{print $1}'" % kraken_db)
-        md5_dbcpy = run("md5sum %s_%s | awk '{print $1}'" % (kraken_db, instance))
-
-        if md5_db != md5_dbcpy:
-            print(red("%s and %s are not equals, exiting. (No space left on device ?)" % (kraken_db, kraken_db + '_' + instance)))
+        versions_dir, versions = _datanav_versions(kraken_db)
+        md5 = run("md5sum %s | awk '{print $1}'" % kraken_db)
+        version = os.path.join(versions_dir, md5 + '.lz4')
+        versions = [md5] + [v for v in versions if v != md5]
+        script = ['mkdir -p {}'.format(quote(versions_dir)),
+                  # a version is never modified, an already stored content is not copied again
+                  '[ -e {0} ] || {{ {1} && mv -f {0}.tmp {0}; }}'.format(
+                      quote(version), _link_or_copy(kraken_db, version + '.tmp')),
+                  "printf '{}\\n' > {}".format('\\n'.join(versions[:env.datanav_versions]),
+                                                quote(os.path.join(versions_dir, 'index')))]
+        script.extend('rm -f {}'.format(quote(os.path.join(versions_dir, v + '.lz4')))
+                      for v in versions[env.datanav_versions:])
+        run(' && '.join(script))
+        print(green("data.nav.lz4 of {} stored as version {}".format(instance, md5)))
     else:
         print(yellow("WARNING: %s doesn't have a data.nav.lz4, add it to the auto-exclusion list for binarization" % instance))
         env.excluded_instances.append(instance)
@@ -350,29 +413,45 @@ def backup_datanav(instance):
 
 @task
 @roles('tyr')
-def rollback_datanav(instance):
-    """ Rollback a data.nav.lz4_$instance file for a given instance """
+def rollback_datanav(instance, version=None):
+    """
+    Put back a version of the data.nav.lz4 of a given instance, by default the last one
+    stored by backup_datanav(), see list_datanav_versions
+    without any version stored, the backup of the former backup_datanav() (data.nav.lz4_<instance>)
+    is put back
+    the data.nav.lz4 is replaced by an atomic rename
+    """
 
     env.tyr_config = get_tyr_config(instance)
     kraken_db = env.tyr_config.get('instance', 'target-file')
 
-    # if data.nav.lz4 backup found, copy it
-    if exists("%s_%s" % (kraken_db, instance)):
-        # nfsv4 acl, don't try to preserve permissions, inheritance do the work
-        if env.standalone is False:
-            run("cp %s_%s %s" % (kraken_db, instance, kraken_db))
-        else:
-            run("cp --archive %s_%s %s" % (kraken_db, instance, kraken_db))
+    versions_dir, versions = _datanav_versions(kraken_db)
+    version = version or (versions[0] if versions else None)
+    if version:
+        source = os.path.join(versions_dir, '{}.lz4'.format(version))
+    else:
+        source = '{}_{}'.format(kraken_db, instance)
+    if exists(source):
+        run("{} && mv -f {} {}".format(_link_or_copy(source, kraken_db + '.tmp'),
+                                       quote(kraken_db + '.tmp'), quote(kraken_db)))
+        print(green("data.nav.lz4 of {} rolled back to {}".format(
+            instance, 'version {}'.format(version) if version else source)))
+    else:
+        print(red("ERROR: no version {} of the data.nav.lz4 of {}".format(version or '', instance)))
 
-        # verify backup
-        print("Verify backup")
-        md5_db = run("md5sum %s | awk '{print $1}'" % kraken_db)
-        md5_dbcpy = run("md5sum %s_%s | awk '{print $1}'" % (kraken_db, instance))
 
-        if md5_db != md5_dbcpy:
-            print(red("%s and %s are not equals, exiting. (No space left on device ?)" % (kraken_db, kraken_db + '_' + instance)))
-    else:
-        print(red("ERROR: %s_%s does not exist" % (kraken_db, instance)))
+@task
+@roles('tyr')
+def list_datanav_versions(instance):
+    """ List the versions of the data.nav.lz4 of a given instance, the most recent first """
+    env.tyr_config = get_tyr_config(instance)
+    kraken_db = env.tyr_config.get('instance', 'target-file')
+    versions_dir, versions = _datanav_versions(kraken_db)
+    stats = stat_files([os.path.join(versions_dir, v + '.lz4') for v in versions])
+    for v in versions:
+        stat = stats[os.path.join(versions_dir, v + '.lz4')]
+        print("{}: {}".format(v, '{:.1f} MB'.format(stat.size / 2. ** 20) if stat else 'missing'))
+    return versions
 
 
 @task
@@ -402,8 +481,15 @@ def get_tyr_config(instance):
 @task
 @roles('tyr_master')
 @run_once_per_host
-def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, instances=None):
-    """launch binarization on all instances for the upgrade"""
+def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, instances=None, force=False,
+                                  on_done=None, max_attempts=1):
+    """launch binarization on all instances for the upgrade
+    the instances whose datasets and navitia-ed version did not change since their last
+    binarization are skipped, unless force is set
+    on_done is called with the name of each instance as soon as it is binarized
+    a failed binarization is attempted again up to max_attempts times (see _collect_binarizations())
+    returns the instances whose binarization failed
+    """
     if pilot_supervision:
         supervision_downtime(step='tyr_beat')
         supervision_downtime(step='bina')
@@ -428,32 +514,372 @@ def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, i
         else:
             instances2process = set(instances)
 
-        def binarize_instance(i_name):
-            with time_that(blue("data loaded for " + i_name + " in {elapsed}")):
-                print(blue("loading data for {}".format(i_name)))
-                update_ed_db(i_name)
-
-                if i_name in env.excluded_instances:
-                    print(blue("NOTICE: i_name {} has been excluded, skipping it".format(i_name)))
-                    instances2process.remove(i_name)
-                else:
-                    if launch_rebinarization(i_name, True):
-                        # do not remove if bina failed
-                        instances2process.remove(i_name)
-            # print instances not yet binarized, this allows to easily resume the binarization
-            # process in case of crash or freeze (use include:x,y,z,....)
-            # see http://jira.canaltp.fr/browse/DEVOP-408
-            print(blue("Instances left: {}".format(','.join(instances2process))))
-
-        # run the bina in parallel (if you want sequential, set env.nb_thread_for_bina = 1)
-        with Parallel(env.nb_thread_for_bina) as pool:
-            pool.map(binarize_instance, instances2process)
+        fingerprints = get_bina_fingerprints(instances2process)
+        if not get_bool_from_cli(force):
+            for i_name in get_unchanged_instances(fingerprints):
+                print(blue("NOTICE: datasets and navitia-ed of {} are unchanged, skipping its binarization"
+                           .format(i_name)))
+                instances2process.remove(i_name)
+
+        def bina_done(i_name, duration):
+            if not duration:
+                return
+            # recorded before on_done, which may swap the new data.nav.lz4 out of temp/
+            save_bina_fingerprints(fingerprints, [i_name])
+            save_bina_history(fingerprints, {i_name: duration})
+            if on_done:
+                on_done(i_name)
+
+        sizes = _data_nav_sizes(instances2process)
+        # None without any binarization recorded, then no estimation of the time left
+        expected = expected_bina_durations(instances2process, sizes)
+        ordered_instances = sort_by_bina_duration(instances2process, expected or sizes)
+        max_attempts = int(max_attempts)
+        if env.bina_distributed and len(env.roledefs['tyr']) > 1:
+            durations = distributed_binarization(ordered_instances, bina_done, max_attempts, expected)
+        else:
+            # run the bina in parallel (if you want sequential, set env.nb_thread_for_bina = 1)
+            # longest first, one instance at a time per thread, to finish as early as possible
+            nb_thread, limiter = env.nb_thread_for_bina, None
+            if env.bina_adaptive:
+                # as many binarizations at the same time as the host can take, see AdaptiveLimiter
+                limiter = AdaptiveLimiter(*env.bina_adaptive_bounds, name='binarizations',
+                                          start=env.nb_thread_for_bina)
+                nb_thread = env.bina_adaptive_bounds[1]
+            durations = threaded_binarization(ordered_instances, nb_thread, bina_done, max_attempts, limiter,
+                                              expected)
+        # do not remove if bina failed
+        instances2process.difference_update(durations)
         return tuple(instances2process)
     finally:
         if pilot_tyr_beat:
             start_tyr_beat()
 
 
+# duration of the last binarization of each instance
+bina_durations = LocalState('bina_durations')
+
+
+def _binarize(i_name):
+    """
+    upgrade the ed database and binarize an instance on the current host
+    returns the duration of the binarization (0 if it was not needed), None if it failed
+    """
+    start = time.time()
+    print(blue("loading data for {}".format(i_name)))
+    update_ed_db(i_name)
+    if i_name in env.excluded_instances:
+        print(blue("NOTICE: i_name {} has been excluded, skipping it".format(i_name)))
+        return 0
+    if journal_is_done('bina', i_name):
+        print(blue("NOTICE: {} already binarized during this upgrade, skipping it".format(i_name)))
+        return 0
+    # in the foreground: the binarization runs on the current host, in the slot it was given
+    # (see get_bina_slots()), and is over when the command returns
+    if _launch_rebinarization(i_name, True, background=False):
+        return time.time() - start
+
+
+def _bina_done(i_name, duration):
+    if duration:
+        journal_mark_done('bina', i_name)
+        bina_durations.set(i_name, round(duration, 1))
+
+
+# last binarizations of each instance, see save_bina_history()
+bina_history = LocalState('bina_history')
+
+# inputs and output of the last binarization of each instance, see get_bina_fingerprints()
+bina_fingerprints = LocalState('bina_fingerprints')
+
+
+def _temp_lz4_file(i_name):
+    """ data.nav.lz4 written by the binarizations of the upgrade, see kraken.swap_data_nav() """
+    target = get_real_instance(i_name).target_lz4_file
+    return os.path.join(os.path.dirname(target), 'temp', os.path.basename(target))
+
+
+@task
+@roles('db')
+def get_last_datasets():
+    """ returns the last dataset of each type binarized for each instance """
+    with settings(hide('running', 'stdout')):
+        res = run('sudo -i -u postgres psql -A -t -c '
+                  '"select distinct on (instance.name, data_set.family_type) instance.name, data_set.name '
+                  '  from instance, job, data_set '
+                  '  where instance.id = job.instance_id and job.id = data_set.job_id and job.state=\'done\' '
+                  '  order by instance.name, data_set.family_type, job.created_at desc;" jormungandr')
+    datasets = {}
+    for line in res.splitlines():
+        if line.strip():
+            i_name, dataset = line.strip().split('|', 1)
+            datasets.setdefault(i_name, []).append(dataset)
+    return datasets
+
+
+def get_bina_fingerprints(instances):
+    """
+    fingerprint of the inputs of the binarization of each instance, on the current (tyr_master) host:
+    the navitia-ed version and the path, size and mtime of the last datasets
+    """
+    datasets = execute(get_last_datasets).values()[0]
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        version = run("dpkg-query --show --showformat='${Version}' navitia-ed")
+    stats = stat_files([d for i_name in instances for d in datasets.get(i_name, [])])
+    return {i_name: dict(version=version,
+                         datasets=sorted([d] + list(stats[d] or []) for d in datasets.get(i_name, [])))
+            for i_name in instances}
+
+
+def get_unchanged_instances(fingerprints):
+    """
+    the instances with the same fingerprint as their last binarization, and whose
+    data.nav.lz4 is the one produced by this binarization
+    """
+    known = bina_fingerprints.load()
+    candidates = [i_name for i_name, fingerprint in fingerprints.iteritems()
+                  if known.get(i_name, {}).get('inputs') == fingerprint and fingerprint['datasets']]
+    targets = stat_files([get_real_instance(i_name).target_lz4_file for i_name in candidates])
+    return [i_name for i_name in candidates
+            if list(targets[get_real_instance(i_name).target_lz4_file] or []) == known[i_name]['output']]
+
+
+def save_bina_history(fingerprints, durations):
+    """
+    add the binarizations done to the history of their instance: duration, size of the datasets
+    and of the data.nav.lz4 produced, navitia-ed version
+    """
+    durations = {i_name: duration for i_name, duration in durations.iteritems() if duration}
+    outputs = stat_files([_temp_lz4_file(i_name) for i_name in durations])
+    for i_name, duration in durations.iteritems():
+        output = outputs[_temp_lz4_file(i_name)]
+        entry = dict(date=datetime.datetime.now().isoformat(), duration=round(duration, 1),
+                     datasets_size=sum(d[1] for d in fingerprints[i_name]['datasets'] if len(d) > 1),
+                     data_nav_size=output.size if output else None,
+                     version=fingerprints[i_name]['version'])
+        bina_history.set(i_name, (bina_history.get(i_name, []) + [entry])[-env.bina_history_size:])
+
+
+def find_bina_regressions(history, factor):
+    """
+    the instances whose last binarization took more than factor times the median of the previous
+    ones, per byte of datasets when their sizes are known
+    returns {instance: (last cost, median cost)}
+    """
+    regressions = {}
+    for i_name, entries in history.iteritems():
+        if len(entries) < 2:
+            continue
+        if all(e.get('datasets_size') for e in entries):
+            costs = [float(e['duration']) / e['datasets_size'] for e in entries]
+        else:
+            costs = [e['duration'] for e in entries]
+        previous = sorted(costs[:-1])
+        median = previous[len(previous) // 2]
+        if costs[-1] > factor * median:
+            regressions[i_name] = (costs[-1], median)
+    return regressions
+
+
+@task
+def show_bina_history(nb_thread=None):
+    """
+    show the last binarizations of the instances, the ones that regressed (see find_bina_regressions())
+    and the expected duration of the binarization of all the instances with nb_thread threads
+    (default nb_thread_for_bina), to plan an upgrade
+    eg: fab prod show_bina_history:nb_thread=4
+    """
+    history = bina_history.load()
+    regressions = find_bina_regressions(history, env.bina_regression_factor)
+    for i_name in sorted(history):
+        last = history[i_name][-1]
+        line = "{}: {}s on {} (datasets: {}, data.nav.lz4: {}, navitia-ed {}), {} binarizations known".format(
+            i_name, last['duration'], last['date'], last['datasets_size'], last['data_nav_size'],
+            last['version'], len(history[i_name]))
+        if i_name in regressions:
+            print(red(line + ", {:.1f} times slower than usual".format(
+                regressions[i_name][0] / regressions[i_name][1])))
+        else:
+            print(line)
+    expected = expected_bina_durations(env.instances.keys())
+    nb_thread = int(nb_thread or env.nb_thread_for_bina)
+    if expected is None:
+        print(yellow("WARNING: no binarization recorded yet, can't estimate the binarization time"))
+        return
+    print(blue("expected binarization time of the {} instances with {} thread(s): {}".format(
+        len(expected), nb_thread, datetime.timedelta(seconds=int(estimate_makespan(expected.values(), nb_thread))))))
+
+
+def save_bina_fingerprints(fingerprints, instances):
+    """ record the fingerprints of the instances binarized, with the data.nav.lz4 they produced """
+    outputs = stat_files([_temp_lz4_file(i_name) for i_name in instances])
+    for i_name in instances:
+        output = outputs[_temp_lz4_file(i_name)]
+        if output:
+            bina_fingerprints.set(i_name, dict(inputs=fingerprints[i_name], output=list(output)))
+
+
+@task
+@roles('tyr')
+def get_bina_slots():
+    """ number of binarizations the host can run at the same time, according to its cpus and memory """
+    with settings(hide('running', 'stdout')):
+        cpus = int(run('nproc'))
+    return max(1, min(cpus // env.bina_cpus_per_job, get_mem_available() // env.bina_memory_per_job))
+
+
+def _bina_jobs(jobs, results, limiter=None):
+    """
+    binarize the instances of the jobs queue on the current host until it gives None,
+    putting their duration in the results queue (see _binarize())
+    """
+    for i_name in iter(jobs.get, None):
+        try:
+            with time_that(blue("data loaded for " + i_name + " in {elapsed}")):
+                if limiter:
+                    with limiter:
+                        duration = _binarize(i_name)
+                else:
+                    duration = _binarize(i_name)
+        except (Exception, SystemExit) as e:
+            print(red("ERROR: binarization of {} failed on {}: {}".format(i_name, env.host_string, e)))
+            duration = None
+        results.put((i_name, env.host_string, duration))
+
+
+def _bina_worker(host, jobs, results):
+    """ binarize the instances of the jobs queue on a tyr host, in a forked process """
+    init_forked_process()
+    with settings(host_string=host):
+        _bina_jobs(jobs, results)
+
+
+def _collect_binarizations(instances, jobs, results, workers, on_done=None, max_attempts=1, expected=None):
+    """
+    feed the workers with the instances, in order, and wait for their binarizations.
+    A failed instance is put back at the end of the jobs queue after env.bina_retry_delay seconds,
+    doubled at each attempt, up to max_attempts, while the other instances go on.
+    No more retries once the failed instances exceed env.acceptable_bina_fail_rate: something
+    is broken for all of them.
+    With the expected duration of each instance (see expected_bina_durations()), an estimation
+    of the time left is printed with the instances left.
+    on_done is called with the name and the duration of each instance done, as soon as it is done
+    returns the duration of the binarization of each instance done (see _binarize())
+    """
+    for i_name in instances:
+        jobs.put(i_name)
+    left, done, failures, retries = list(instances), {}, collections.Counter(), []
+    # rate computed on all the instances, like when the failed ones were binarized in a second pass
+    nb_instances = max(len(env.instances), len(instances))
+    while left and any(w.is_alive() for w in workers) or not results.empty():
+        for retry in [r for r in retries if r[0] <= time.time()]:
+            retries.remove(retry)
+            jobs.put(retry[1])
+        try:
+            i_name, host, duration = results.get(timeout=1)
+        except Queue.Empty:
+            continue
+        if duration is None:
+            failures[i_name] += 1
+            if failures[i_name] < max_attempts and \
+                    float(len(failures)) / nb_instances <= env.acceptable_bina_fail_rate:
+                delay = env.bina_retry_delay * 2 ** (failures[i_name] - 1)
+                print(yellow("WARNING: binarization failed for {} on {}, retrying in {}s ({}/{})".format(
+                    i_name, get_host_addr(host), delay, failures[i_name] + 1, max_attempts)))
+                retries.append((time.time() + delay, i_name))
+                continue
+            left.remove(i_name)
+            print(red("ERROR: binarization failed for {} on {}".format(i_name, get_host_addr(host))))
+        else:
+            left.remove(i_name)
+            done[i_name] = duration
+            _bina_done(i_name, duration)
+            if on_done:
+                on_done(i_name, duration)
+            print(green("binarization done for {} on {} ({}/{})".format(
+                i_name, get_host_addr(host), len(instances) - len(left), len(instances))))
+        # print instances not yet binarized, this allows to easily resume the binarization
+        # process in case of crash or freeze (use include:x,y,z,....)
+        # see http://jira.canaltp.fr/browse/DEVOP-408
+        eta = ''
+        if expected and left:
+            eta = " (about {} left)".format(datetime.timedelta(
+                seconds=int(estimate_makespan([expected[i] for i in left], len(workers)))))
+        print(blue("Instances left: {}{}".format(','.join(left), eta)))
+    for _ in workers:
+        jobs.put(None)
+    for worker in workers:
+        worker.join()
+    return done
+
+
+def threaded_binarization(instances, nb_thread, on_done=None, max_attempts=1, limiter=None, expected=None):
+    """
+    binarize the instances on the current host, nb_thread at the same time (at most, with
+    an AdaptiveLimiter), the instances being taken in order
+    returns the duration of the binarization of each instance done (see _binarize())
+    """
+    jobs, results = Queue.Queue(), Queue.Queue()
+    workers = [threading.Thread(target=_bina_jobs, args=(jobs, results, limiter))
+               for _ in range(min(nb_thread, len(instances)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    return _collect_binarizations(instances, jobs, results, workers, on_done, max_attempts, expected)
+
+
+def distributed_binarization(instances, on_done=None, max_attempts=1, expected=None):
+    """
+    binarize the instances on all the tyr hosts, each one running as many binarizations
+    at the same time as it has slots (see get_bina_slots()), the instances being taken in order
+    returns the duration of the binarization of each instance done (see _binarize())
+    """
+    slots = execute(get_bina_slots)
+    print(blue("binarization slots: {}".format(', '.join('{}: {}'.format(get_host_addr(h), n)
+                                                          for h, n in sorted(slots.iteritems())))))
+    jobs, results = multiprocessing.Queue(), multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_bina_worker, args=(host, jobs, results))
+               for host, nb in slots.iteritems() for _ in range(min(nb, len(instances)))]
+    for worker in workers:
+        worker.start()
+    return _collect_binarizations(instances, jobs, results, workers, on_done, max_attempts, expected)
+
+
+def _data_nav_sizes(instances):
+    """ size of the data.nav.lz4 of each instance on tyr_master, 0 if there is none """
+    files = {i: get_real_instance(i).target_lz4_file for i in instances}
+    with settings(host_string=env.roledefs['tyr_master'][0]):
+        stats = stat_files(files.values())
+    return {i: stats[f].size if stats[f] else 0 for i, f in files.iteritems()}
+
+
+def expected_bina_durations(instances, sizes=None):
+    """
+    expected binarization time of each instance: the duration of its last binarization,
+    else estimated from the size of its data.nav.lz4 (see _data_nav_sizes())
+    returns None if an instance can't be estimated: no binarization of a known size recorded yet
+    """
+    durations = bina_durations.load()
+    sizes = sizes or _data_nav_sizes(instances)
+    # time per byte of the instances already binarized, to estimate the others
+    rates = sorted(durations[i] / sizes[i] for i in instances if i in durations and sizes[i])
+    if not rates and any(i not in durations for i in instances):
+        return None
+    rate = rates[len(rates) // 2] if rates else 0
+    return {i: durations.get(i, sizes[i] * rate) for i in instances}
+
+
+def sort_by_bina_duration(instances, expected=None):
+    """
+    sort the instances by decreasing expected binarization time (see expected_bina_durations()),
+    by decreasing size of their data.nav.lz4 if it can't be estimated
+    """
+    if not expected:
+        sizes = _data_nav_sizes(instances)
+        expected = expected_bina_durations(instances, sizes) or sizes
+    return sorted(instances, key=expected.get, reverse=True)
+
+
 @task
 @roles('tyr_master')
 @run_once_per_host
@@ -462,14 +888,25 @@ def launch_rebinarization(instance, use_temp=False):
         During upgrade, we need to regenerate data.nav.lz4 file because of
         serialization objects changes; we have to find the last input file
         processed
-        "cd" command is executed manually (not in a context manager)
-        because it is not good to use global variable with parallel
+    """
+    return _launch_rebinarization(instance, use_temp)
+
+
+def _launch_rebinarization(instance, use_temp=False, background=True):
+    """
+    body of launch_rebinarization(), not cached by run_once_per_host: the retries of a failed
+    binarization (see _collect_binarizations()) run it again
+    with background, the binarization is handed to the celery workers of tyr, which may run it
+    on any tyr host; else it runs in the manage.py process, on the current host
+    "cd" command is executed manually (not in a context manager)
+    because it is not good to use global variable with parallel
     """
     with shell_env(TYR_CONFIG_FILE=env.tyr_settings_file), settings(user=env.KRAKEN_USER):
         print(blue("NOTICE: launching binarization on {} @{}".format(instance, time.strftime('%H:%M:%S'))))
         try:
-            run("cd " + env.tyr_basedir + " && python manage.py import_last_dataset --background {}{}".
-                format(instance, ' --custom_output_dir temp' if use_temp else ''))
+            run("cd " + env.tyr_basedir + " && python manage.py import_last_dataset {}{}{}".
+                format('--background ' if background else '', instance,
+                       ' --custom_output_dir temp' if use_temp else ''))
             return True
         except:
             print(red("ERROR: failed binarization on {}".format(instance)))
@@ -556,10 +993,17 @@ def test_tyr_backup_file_presence():
 
 @task
 def update_tyr_confs():
-    execute_flat(update_tyr_config_file)
-    for instance in env.instances.values():
-        execute_flat(update_tyr_instance_conf, instance)
+    """ returns the list of updated files """
+    if env.use_config_bundle:
+        changed = changed_files(execute_flat(push_tyr_conf_bundle))
+    else:
+        if env.upload_only_changed_templates:
+            execute_flat(fetch_tyr_conf_checksums)
+        changed = changed_files(execute_flat(update_tyr_config_file))
+        for instance in env.instances.values():
+            changed.extend(changed_files(execute_flat(update_tyr_instance_conf, instance)))
     execute(update_cities_conf)
+    return changed
 
 
 @task
@@ -572,37 +1016,35 @@ def update_cities_conf():
                          context={'env': env})
 
 
+def _tyr_instance_templates(instance):
+    """ (template, destination, context) of the tyr files of an instance """
+    context = {'env': env, 'instance': instance}
+    return [("tyr/instance.ini.jinja", "{}/{}.ini".format(env.tyr_base_instances_dir, instance.name), context),
+            # /srv/ed/$instance/alembic.ini, used by update_ed_db()
+            ("tyr/ed_alembic.ini.jinja", "{}/alembic.ini".format(instance.base_ed_dir), context),
+            # we need a settings file to init the db with postgis
+            # will be deprecated when migrating to postgis 2.1
+            ("tyr/ed_settings.sh.jinja", "{}/settings.sh".format(instance.base_ed_dir), context)]
+
+
 @task
 @roles('tyr')
-def update_tyr_instance_conf(instance):
-    _upload_template("tyr/instance.ini.jinja",
-                     "{}/{}.ini".format(env.tyr_base_instances_dir, instance.name),
-                     context={
-                         'env': env,
-                         'instance': instance,
-                     },
-    )
+def fetch_tyr_conf_checksums():
+    """ get in one command the checksums of all the tyr configuration files of the host """
+    paths = [env.tyr_settings_file, env.tyr_wsgi_file]
+    for instance in env.instances.values():
+        paths.extend(dest for _, dest, _ in _tyr_instance_templates(instance))
+    fetch_remote_checksums(paths)
 
+
+@task
+@roles('tyr')
+def update_tyr_instance_conf(instance):
+    """ returns the list of updated files """
     require_directory(instance.base_ed_dir,
                             owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
-    # /srv/ed/$instance/alembic.ini, used by update_ed_db()
-    _upload_template("tyr/ed_alembic.ini.jinja",
-                     "{}/alembic.ini".format(instance.base_ed_dir),
-                     context={
-                         'env': env,
-                         'instance': instance,
-                     },
-    )
-
-    #we need a settings file to init the db with postgis
-    # will be deprecated when migrating to postgis 2.1
-    _upload_template("tyr/ed_settings.sh.jinja",
-                     "{}/settings.sh".format(instance.base_ed_dir),
-                     context={
-                         'env': env,
-                         'instance': instance,
-                     },
-    )
+    return [dest for template, dest, context in _tyr_instance_templates(instance)
+            if _upload_template(template, dest, context=context)]
 
 
 @task
@@ -36,6 +36,7 @@ import re
 import os
 from importlib import import_module
 from fabric.operations import run
+from fabfile.utils import host_fact
 
 env.distrib = 'ubuntu14.04'
 env.KRAKEN_USER = 'www-data'
@@ -70,6 +71,9 @@ env.service_name = service_name
 
 env.default_ssh_user = 'root'
 
+# print the number of ssh connections opened and reused at the end of the run
+env.show_connection_stats = False
+
 
 def make_ssh_url(serv, *args):
     """
@@ -88,12 +92,25 @@ env.make_ssh_url = make_ssh_url
 env.KRAKEN_RABBITMQ_OK_PORT = 5672
 env.KRAKEN_RABBITMQ_WRONG_PORT = 56722
 env.PUPPET_RESTART_DELAY = 30
-# max time (in s) that a kraken can take to restart
+# max time (in s) that a kraken can take to restart, extended for the
+# krakens expected to load longer (see kraken.wait_kraken_loaded)
 env.KRAKEN_RESTART_DELAY = 90
+# loading speed of a kraken (in MB/s of data.nav.lz4) when its previous loading time is unknown
+env.kraken_load_rate = 20
+# a kraken is considered as failed after this many times its expected loading time
+env.kraken_load_margin = 3
+# max time (in s) between 2 polls of a restarting kraken
+env.kraken_poll_max_interval = 10
 env.TYR_WORKER_START_DELAY = 10
 env.APACHE_START_DELAY = 8
 env.KRAKEN_START_ONLY_ONCE = True
-env.KRAKEN_RESTART_SCHEME = 'parallel'  # possible values: 'parallel', 'serial'
+env.KRAKEN_RESTART_SCHEME = 'parallel'  # possible values: 'parallel', 'serial', 'concurrent'
+# with KRAKEN_RESTART_SCHEME='concurrent', the krakens of a host are restarted at the same time,
+# at most kraken_restart_nb_thread of them, while the memory needed to load their data
+# (kraken_memory_factor x size of data.nav.lz4) fits in kraken_memory_ratio of the available memory
+env.kraken_restart_nb_thread = 8
+env.kraken_memory_factor = 4
+env.kraken_memory_ratio = 0.8
 env.TYR_START_ONLY_ONCE = True
 env.APACHE_START_ONLY_ONCE = True
 
@@ -154,6 +171,22 @@ env.manual_package_deploy = False
 
 # backup all configuration files before uploading a new one
 env.backup_conf_files = False
+# upload a configuration file only if its content is different from the remote one
+env.upload_only_changed_templates = False
+# push all the tyr and kraken configuration files of a host in a single archive
+env.use_config_bundle = False
+
+# local directory where fabric keeps its state between runs (eg the journal of an upgrade)
+env.fabric_state_dir = '~/.fabric_navitia'
+# journal of the running upgrade_all, see UpgradeJournal
+env.upgrade_journal = None
+
+# status of the krakens read from monitor-kraken is reused during this many seconds
+env.kraken_status_max_age = 30
+# and this many seconds for a kraken that could not be reached
+env.kraken_status_failure_max_age = 10
+# number of monitor-kraken requests sent at the same time
+env.kraken_status_nb_thread = 16
 
 #postgis dir is usefull for old postgis version where we cannot  do a 'create extention'
 env.postgis_dir = '/usr/share/postgresql/9.1/contrib/postgis-1.5'
@@ -195,9 +228,10 @@ env.jormungandr_additional_settings = {}
 
 # Apache
 env.base_apache = '/etc/apache2/'
+@host_fact
 def apache_version():
     """
-    Return the apache version
+    Return the apache version, gathered once per host
     """
     lines = run('apt-cache policy apache2').split('\n')
     try:
@@ -381,7 +415,35 @@ env.dry_run = False
 
 #number of parallele binarization
 env.nb_thread_for_bina = 1
+# run the binarizations of upgrade_all on all the tyr hosts, each one running at most one
+# binarization per bina_cpus_per_job cpus and per bina_memory_per_job bytes of available memory
+env.bina_distributed = False
+env.bina_cpus_per_job = 2
+env.bina_memory_per_job = 4 * 2 ** 30
+# adapt the number of binarizations running at the same time on tyr_master to its load,
+# between the bounds, instead of using nb_thread_for_bina (see utils.AdaptiveLimiter)
+env.bina_adaptive = False
+env.bina_adaptive_bounds = (1, 8)
+# thresholds above which a host is considered as overloaded
+env.adaptive_max_load = 0.9
+env.adaptive_min_memory = 4 * 2 ** 30
+env.adaptive_max_iowait = 0.3
+#number of upgrade steps run at the same time by upgrade_all:parallel_steps=True
+env.nb_parallel_steps = 3
+#number of instances whose krakens are reloaded at the same time by upgrade_all:pipeline=True
+env.nb_pipeline_reloads = 4
+# number of hosts of a role on which tasks decorated with @parallel_on_role are run at the same time
+# eg: env.role_parallelism = {'eng': 4, 'ws': 6}, roles not listed are run serially
+env.role_parallelism = {}
 env.acceptable_bina_fail_rate = 0.08
+# with check_bina, a failed binarization is put back in the binarization queue up to
+# bina_max_attempts times, after bina_retry_delay seconds doubled at each attempt
+env.bina_max_attempts = 2
+env.bina_retry_delay = 30
+# number of binarizations of each instance kept in its history, see tyr.show_bina_history
+env.bina_history_size = 20
+# a binarization is reported as a regression when it is that many times slower than usual
+env.bina_regression_factor = 1.5
 
 #instances configurations
 env.instances = {}
@@ -395,6 +457,17 @@ env.tyr_source_dir_template = '{base}/{instance}/source'
 env.tyr_destination_dir_template = '{base}/destination'
 
 env.kraken_database_file = '{base_dest}/{instance}/data.nav.lz4'
+# local directory of the engines where the data of the krakens are copied before their restart
+# (eg when env.kraken_database_file is on nfs), with a bandwidth limit in KB/s (see kraken.stage_kraken_data)
+# kraken.ini points at the local copy: update the kraken configurations when changing it
+env.kraken_local_data_dir = None
+env.kraken_stage_bwlimit = None
+# copy the data from engine to engine as trees instead of copying it from the shared data on each
+# engine, nb_process copies at the same time (see kraken.distribute_kraken_data)
+env.kraken_stage_fanout = False
+env.kraken_fanout_nb_process = 8
+# free space kept on top of the space needed by an upgrade, see tasks.check_disk_space
+env.disk_space_margin = 0.1
 
 #in general we don't want to configure apache
 env.setup_apache = False
@@ -413,6 +486,18 @@ env.is_prod = False
 # see backup_datanav()tasks.tyr.backup_datanav
 env.excluded_instances = []
 
+# number of versions of the data.nav.lz4 of each instance kept by tyr.backup_datanav
+env.datanav_versions = 3
+# store the versions as hardlinks instead of copies (reflinks where the filesystem allows it)
+# only safe if the data.nav.lz4 is replaced by a new file, never rewritten in place
+env.datanav_hardlinks = False
+# write a manifest (hash, size, mtime) next to each data.nav.lz4 swapped by the upgrades, and
+# don't restart the krakens whose data.nav.lz4 does not match it (see kraken.verify_data_nav_manifests)
+env.data_nav_manifests = False
+# command hashing its standard input (eg xxh64sum if installed), and number of files hashed at once
+env.data_nav_hash_command = 'md5sum'
+env.data_nav_hash_nb_process = 4
+
 # url of the autocomplete service
 env.mimir_url = None
 #url of bragi, the autocomplete service over mimir
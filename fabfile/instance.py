@@ -99,6 +99,13 @@ class Instance:
 
     @property
     def kraken_database(self):
+        """ the data read by kraken: with env.kraken_local_data_dir, the copy staged on the engine """
+        if env.kraken_local_data_dir:
+            return os.path.join(env.kraken_local_data_dir, self.name, os.path.basename(self.kraken_shared_database))
+        return self.kraken_shared_database
+
+    @property
+    def kraken_shared_database(self):
         return env.kraken_database_file.format(base_dest=env.tyr_base_destination_dir, instance=self.name, ed_basedir=env.ed_basedir)
 
     @property
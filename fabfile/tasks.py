@@ -29,12 +29,16 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
+from collections import Counter
 import datetime
+import functools
+import multiprocessing
 import os
 import requests
 
 from fabric.api import run, env, task, execute, roles, abort
 from fabric.colors import blue, red, yellow, green
+from fabric.context_managers import settings
 from fabric.contrib.files import exists
 
 from fabfile.component import tyr, db, jormungandr, kraken
@@ -42,7 +46,9 @@ from fabfile.component.kraken import check_dead_instances
 from fabfile.utils import (get_bool_from_cli, show_version, get_host_addr,
                            show_dead_kraken_status, TimeCollector, compute_instance_status,
                            show_time_deploy, host_app_mapping, send_mail,
-                           supervision_downtime, get_real_instance)
+                           supervision_downtime, get_real_instance, TaskGraph, changed_files,
+                           UpgradeJournal, journal_is_done, journal_mark_done, stat_files,
+                           get_free_space, check_free_space, init_forked_process)
 from prod_tasks import (remove_kraken_vip, switch_to_first_phase,
                         switch_to_second_phase, switch_to_third_phase, enable_all_nodes)
 from fabfile.component.load_balancer import _adc_connection
@@ -100,15 +106,34 @@ def upgrade_all_packages():
     execute(jormungandr.upgrade_ws_packages)
 
 
+def _pipeline_bina_done(reloader, i_name):
+    """ with upgrade_all:pipeline, swap the data of an instance as soon as it is binarized, then reload its krakens """
+    kraken.swap_data_nav(i_name)
+    reloader.submit(i_name)
+
+
 @task
 def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
-                manual_lb=False, check_dead=True, check_bina=True):
-    """Upgrade all navitia packages, databases and launch rebinarisation of all instances """
+                manual_lb=False, check_dead=True, check_bina=True, parallel_steps=False, resume=False,
+                force_bina=False, pipeline=False, check_space=True):
+    """Upgrade all navitia packages, databases and launch rebinarisation of all instances
+    with resume, the steps and instances done by a previous upgrade_all that crashed are skipped
+    with pipeline, the krakens of each instance are reloaded as soon as its binarization is over
+    with check_space, the upgrade stops before anything is written if disk space is short
+    """
     up_tyr = get_bool_from_cli(up_tyr)
     up_confs = get_bool_from_cli(up_confs)
     check_version = get_bool_from_cli(check_version)
     check_dead = get_bool_from_cli(check_dead)
     check_bina = get_bool_from_cli(check_bina)
+    parallel_steps = get_bool_from_cli(parallel_steps)
+    resume = get_bool_from_cli(resume)
+    force_bina = get_bool_from_cli(force_bina)
+    pipeline = get_bool_from_cli(pipeline)
+    check_space = get_bool_from_cli(check_space)
+    if pipeline and env.use_load_balancer:
+        print(yellow("WARNING: pipeline is not available with load balancers, krakens are reloaded after the binarizations"))
+        pipeline = False
 
     if check_version:
         execute(compare_version_candidate_installed, host_name='tyr')
@@ -122,32 +147,83 @@ def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
             _adc_connection(check=True)
 
     execute(check_last_dataset)
+    if check_space and up_tyr:
+        check_disk_space()
     if send_mail in ('start', 'all'):
         broadcast_email('start')
 
     time_dict = TimeCollector()
     time_dict.register_start('total_deploy')
+    journal = env.upgrade_journal = UpgradeJournal(resume)
 
-    if up_tyr:
-        execute(update_tyr_step, time_dict, only_bina=False, check_bina=check_bina)
+    # with pipeline, kraken packages and configuration are upgraded before the binarizations,
+    # then the data of each instance is swapped and its krakens reloaded as soon as it is binarized
+    reloader = on_bina_done = None
+    if pipeline and not journal.is_done('kraken'):
+        supervision_downtime(step='kraken')
+        if not journal.is_done('kraken_packages'):
+            execute(upgrade_kraken_packages)
+            journal.mark_done('kraken_packages')
+        if up_confs:
+            update_kraken_confs()
+        time_dict.register_start('kraken')
+        reloader = kraken.KrakenReloader(env.nb_pipeline_reloads, wait=env.KRAKEN_RESTART_SCHEME,
+                                         journal_step='kraken')
+        on_bina_done = functools.partial(_pipeline_bina_done, reloader)
 
+    # with parallel_steps, kraken and jormungandr packages are upgraded during the binarization
+    steps = TaskGraph()
     if check_version:
-        execute(compare_version_candidate_installed)
-    execute(kraken.swap_all_data_nav)
+        steps.add_step('check_version', compare_version_candidate_installed)
+    first_steps = ['check_version'] if check_version else []
+    if up_tyr:
+        steps.add_step('tyr', update_tyr_step, args=(time_dict,),
+                       kwargs=dict(only_bina=False, check_bina=check_bina, force_bina=force_bina,
+                                   on_bina_done=on_bina_done),
+                       requires=first_steps, fork=False)
+    if parallel_steps:
+        if not pipeline:
+            steps.add_step('kraken_packages', upgrade_kraken_packages, requires=first_steps)
+        steps.add_step('jormungandr_packages', jormungandr.upgrade_ws_packages, requires=first_steps)
+    if not pipeline:
+        steps.add_step('swap_data_nav', kraken.swap_all_data_nav, requires=['tyr'] if up_tyr else first_steps)
+    steps.run(nb_process=env.nb_parallel_steps if parallel_steps else 1, journal=journal)
+
+    if reloader:
+        # the instances not binarized also need the new kraken binary
+        for instance in env.instances.values():
+            reloader.submit(instance.name)
+        failed = reloader.join()
+        time_dict.register_end('kraken')
+        if failed:
+            print(red("ERROR: the krakens of {} instances have not been reloaded: {}".format(
+                len(failed), ', '.join(failed))))
+        else:
+            journal.mark_done('kraken')
+        if check_dead:
+            execute(check_dead_instances)
 
     if env.use_load_balancer:
         # Upgrade kraken/jormun on first hosts set
         env.roledefs['eng'] = env.eng_hosts_1
         env.roledefs['ws'] = env.ws_hosts_1
-        if manual_lb:
-            raw_input(yellow("Please disable ENG1,3/WS1,5,6 and enable ENG2,4/WS2-4"))
-        else:
-            execute(switch_to_first_phase, env.eng_hosts_1, env.ws_hosts_1, env.ws_hosts_2)
+        if not journal.is_done('lb_phase_1'):
+            if manual_lb:
+                raw_input(yellow("Please disable ENG1,3/WS1,5,6 and enable ENG2,4/WS2-4"))
+            else:
+                execute(switch_to_first_phase, env.eng_hosts_1, env.ws_hosts_1, env.ws_hosts_2)
+            journal.mark_done('lb_phase_1')
         time_dict.register_start('kraken')
-        execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs, supervision=True)
-        if check_dead:
-            execute(check_dead_instances)
-        execute(upgrade_jormungandr, reload=False, up_confs=up_confs)
+        if not journal.is_done('kraken_phase_1'):
+            execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs, supervision=True,
+                    packages=not parallel_steps, journal_step='kraken_phase_1')
+            if check_dead:
+                execute(check_dead_instances)
+            journal.mark_done('kraken_phase_1')
+        if not journal.is_done('jormungandr_phase_1'):
+            execute(upgrade_jormungandr, reload=False, up_confs=up_confs, packages=not parallel_steps,
+                    journal_step='jormungandr_phase_1')
+            journal.mark_done('jormungandr_phase_1')
 
         # check first hosts set before upgrading the second one
         for server in env.roledefs['ws']:
@@ -157,27 +233,43 @@ def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
         # Upgrade kraken/jormun on remaining hosts
         env.roledefs['eng'] = env.eng_hosts_2
         env.roledefs['ws'] = env.ws_hosts_2
-        if manual_lb:
-            raw_input(yellow("Please enable ENG1,3/WS1,5,6 and disable ENG2,4/WS2-4"))
-        else:
-            execute(switch_to_second_phase, env.eng_hosts_1, env.eng_hosts_2,
-                    env.ws_hosts_1,  env.ws_hosts_2)
-        execute(upgrade_jormungandr, reload=False, up_confs=up_confs)
-        if manual_lb:
-            raw_input(yellow("Please enable WS1-6"))
-        else:
-            execute(switch_to_third_phase, env.ws_hosts_2)
+        if not journal.is_done('lb_phase_2'):
+            if manual_lb:
+                raw_input(yellow("Please enable ENG1,3/WS1,5,6 and disable ENG2,4/WS2-4"))
+            else:
+                execute(switch_to_second_phase, env.eng_hosts_1, env.eng_hosts_2,
+                        env.ws_hosts_1,  env.ws_hosts_2)
+            journal.mark_done('lb_phase_2')
+        if not journal.is_done('jormungandr_phase_2'):
+            execute(upgrade_jormungandr, reload=False, up_confs=up_confs, packages=not parallel_steps,
+                    journal_step='jormungandr_phase_2')
+            journal.mark_done('jormungandr_phase_2')
+        if not journal.is_done('lb_phase_3'):
+            if manual_lb:
+                raw_input(yellow("Please enable WS1-6"))
+            else:
+                execute(switch_to_third_phase, env.ws_hosts_2)
+            journal.mark_done('lb_phase_3')
         env.roledefs['ws'] = env.ws_hosts
-        execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs)
+        if not journal.is_done('kraken_phase_2'):
+            execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs,
+                    packages=not parallel_steps, journal_step='kraken_phase_2')
+            journal.mark_done('kraken_phase_2')
         time_dict.register_end('kraken')
         if not manual_lb:
             execute(enable_all_nodes, env.eng_hosts, env.ws_hosts_1,  env.ws_hosts_2)
         env.roledefs['eng'] = env.eng_hosts
     else:
-        time_dict.register_start('kraken')
-        execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs, supervision=True)
-        time_dict.register_end('kraken')
-        execute(upgrade_jormungandr, up_confs=up_confs)
+        if not journal.is_done('kraken'):
+            time_dict.register_start('kraken')
+            execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs, supervision=True,
+                    packages=not (parallel_steps or pipeline), journal_step='kraken')
+            journal.mark_done('kraken')
+            time_dict.register_end('kraken')
+        if not journal.is_done('jormungandr'):
+            execute(upgrade_jormungandr, up_confs=up_confs, packages=not parallel_steps,
+                    journal_step='jormungandr')
+            journal.mark_done('jormungandr')
 
     # check deployment OK
     for server in env.roledefs['ws']:
@@ -187,6 +279,8 @@ def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
     # start tyr_beat even if up_tyr is False
     execute(tyr.start_tyr_beat)
     time_dict.register_end('total_deploy')
+    journal.clear()
+    env.upgrade_journal = None
     if send_mail in ('end', 'all'):
         warn_dict = jormungandr.check_kraken_jormun_after_deploy()
         status = show_dead_kraken_status(warn_dict, show=True)
@@ -208,26 +302,25 @@ def broadcast_email(kind, status=None):
 
 
 @task
-def update_tyr_step(time_dict=None, only_bina=True, up_confs=True, check_bina=False):
+def update_tyr_step(time_dict=None, only_bina=True, up_confs=True, check_bina=False, force_bina=False,
+                    on_bina_done=None):
     # TODO only_bina is highly error prone
     """ deploy an upgrade of tyr
+    with force_bina, even the instances with unchanged datasets and navitia-ed are binarized
+    on_bina_done is called with the name of each instance as soon as it is binarized
     """
     if not time_dict:
         time_dict = TimeCollector()
     execute(tyr.stop_tyr_beat)
     execute(upgrade_tyr, up_confs=up_confs, pilot_tyr_beat=False)
     time_dict.register_start('bina')
-    instances_failed = execute(tyr.launch_rebinarization_upgrade, pilot_tyr_beat=False).values()[0]
+    # with check_bina, the failed binarizations are attempted again in the binarization pool
+    instances_failed = execute(tyr.launch_rebinarization_upgrade, pilot_tyr_beat=False,
+                               force=force_bina, on_done=on_bina_done,
+                               max_attempts=env.bina_max_attempts if check_bina else 1).values()[0]
     if check_bina and instances_failed:
-        if float(len(instances_failed)) / len(env.instances) <= env.acceptable_bina_fail_rate:
-            print(yellow("  WARNING: {} binarisation(s) have failed, process again".format(len(instances_failed))))
-            instances_failed = execute(tyr.launch_rebinarization_upgrade,
-                                       pilot_supervision=False,
-                                       pilot_tyr_beat=False,
-                                       instances=instances_failed).values()[0]
-        else:
-            print(yellow("  WARNING: Too many ({}) binarisations have failed, do not process again".
-                         format(len(instances_failed))))
+        print(yellow("  WARNING: {} binarisation(s) have failed: {}".format(
+            len(instances_failed), ','.join(instances_failed))))
     time_dict.register_end('bina')
     if only_bina:
         print show_time_deploy(time_dict)
@@ -305,33 +398,121 @@ def upgrade_version():
 
 
 @task
-def upgrade_kraken(wait='serial', up_confs=True, supervision=False):
+def upgrade_kraken_packages():
+    """Upgrade kraken and monitor-kraken packages, krakens are not restarted"""
+    execute(kraken.upgrade_engine_packages)
+    execute(kraken.upgrade_monitor_kraken_packages)
+
+
+@task
+def upgrade_kraken(wait='serial', up_confs=True, supervision=False, packages=True, journal_step=None):
     """Upgrade and restart all kraken instances"""
     if supervision:
         supervision_downtime(step='kraken')
-    execute(kraken.upgrade_engine_packages)
-    execute(kraken.upgrade_monitor_kraken_packages)
+    if get_bool_from_cli(packages):
+        execute(upgrade_kraken_packages)
     for instance in env.instances.values():
         execute(kraken.set_kraken_binary, instance)
     if up_confs:
-        execute(kraken.update_monitor_configuration)
-        for instance in env.instances.values():
-            execute(kraken.update_eng_instance_conf, instance)
-    execute(kraken.restart_all_krakens, wait=wait)
+        update_kraken_confs()
+    execute(kraken.restart_all_krakens, wait=wait, journal_step=journal_step)
+
+
+def update_kraken_confs():
+    """ update the configuration of the monitor and of all krakens, returns the updated files by instance name """
+    changes = {instance.name: [] for instance in env.instances.values()}
+    if env.use_config_bundle:
+        for host_changes in execute(kraken.push_eng_conf_bundle).values():
+            for name, files in host_changes.iteritems():
+                if name:
+                    changes[name].extend(files)
+        return changes
+    if env.upload_only_changed_templates:
+        execute(kraken.fetch_eng_conf_checksums)
+    execute(kraken.update_monitor_configuration)
+    for instance in env.instances.values():
+        changes[instance.name] = changed_files(execute(kraken.update_eng_instance_conf, instance))
+    return changes
 
 
 @task
-def upgrade_jormungandr(reload=True, up_confs=True):
+def upgrade_jormungandr(reload=True, up_confs=True, packages=True, journal_step=None):
     """Upgrade and restart all jormun instances"""
-    execute(jormungandr.upgrade_ws_packages)
+    if get_bool_from_cli(packages):
+        execute(jormungandr.upgrade_ws_packages)
     if up_confs:
+        if env.upload_only_changed_templates:
+            execute(jormungandr.fetch_jormungandr_conf_checksums)
         execute(jormungandr.update_jormungandr_conf)
         for instance in env.instances.values():
-            execute(jormungandr.deploy_jormungandr_instance_conf, instance)
+            if not journal_is_done(journal_step, instance.name):
+                execute(jormungandr.deploy_jormungandr_instance_conf, instance)
+                journal_mark_done(journal_step, instance.name)
     if reload:
         execute(jormungandr.reload_jormun_safe_all)
 
 
+def _disk_sweep(job):
+    """ size of the files and free space of the directories of a host, in a forked process """
+    host, paths, directories = job
+    with settings(host_string=host):
+        return host, stat_files(paths), get_free_space(directories)
+
+
+@task
+def check_disk_space(backup=False):
+    """
+    Check the free space before an upgrade, for every instance: the data.nav.lz4 written in temp/
+    by the binarizations, the versions stored by backup_datanav (with backup) and the copies of
+    the data on the engines (with env.kraken_local_data_dir), with env.disk_space_margin more.
+    All the hosts are looked at the same time. Aborts with the report of each mount if short.
+    """
+    backup = get_bool_from_cli(backup)
+    instances = env.instances.values()
+    tyr_master = env.roledefs['tyr_master'][0]
+    targets = {i.name: kraken._data_nav_targets(i) for i in instances}
+    jobs = [(tyr_master, [f for plain_temp in targets.itervalues() for f in plain_temp], [env.tyr_base_destination_dir])]
+    if env.kraken_local_data_dir:
+        jobs.extend((host, [i.kraken_database for i in instances if host in i.kraken_engines],
+                     [env.kraken_local_data_dir]) for host in env.roledefs['eng'])
+    pool = multiprocessing.Pool(len(jobs), init_forked_process)
+    try:
+        # one sweep per job, in order: tyr_master may also be an engine
+        sweep = pool.map(_disk_sweep, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    def size(stat):
+        return stat.size if stat else 0
+
+    required, available = Counter(), {}
+    _, stats, free = sweep[0]
+    mount, space = free[env.tyr_base_destination_dir]
+    available[(tyr_master, mount)] = space
+    data_sizes = {name: size(stats[plain]) for name, (plain, _) in targets.iteritems()}
+    for name, (plain, temp) in targets.iteritems():
+        # the new data.nav.lz4 is expected to be as big as the current one
+        required[(tyr_master, mount)] += max(data_sizes[name] - size(stats[temp]), 0)
+        if backup and not env.datanav_hardlinks:
+            required[(tyr_master, mount)] += data_sizes[name]
+    if env.kraken_local_data_dir:
+        for host, stats, free in sweep[1:]:
+            mount, space = free[env.kraken_local_data_dir]
+            available[(host, mount)] = space
+            local = [(data_sizes[i.name], size(stats[i.kraken_database])) for i in instances if host in i.kraken_engines]
+            # rsync keeps the old copy of a file until the new one is complete
+            required[(host, mount)] += sum(max(new - old, 0) for new, old in local) + max([old for _, old in local] or [0])
+
+    report = check_free_space(required, available, env.disk_space_margin)
+    for host, mount, needed, free_space, enough in report:
+        print((green if enough else red)("{} {}: {:.1f} GB needed, {:.1f} GB free".format(
+            get_host_addr(host), mount, needed / 2. ** 30, free_space / 2. ** 30)))
+    if not all(enough for _, _, _, _, enough in report):
+        abort(red("\n  ERROR: not enough disk space for the upgrade, see above"))
+    return report
+
+
 @task
 @roles("tyr_master")
 def isset_dataset(filename=None):
@@ -344,7 +525,7 @@ def check_last_dataset():
     """Check the data before upgrade"""
     datasets_pending = {}
     datasets = {'ok': [], 'ko': [], 'pending': [], 'empty': []}
-    nb_ko = 0
+    last_datasets = []
 
     date_stopchecking = datetime.datetime.now() - datetime.timedelta(days=10)
     str_date = date_stopchecking.strftime("%Y-%m-%d")
@@ -361,12 +542,7 @@ def check_last_dataset():
             if dataset != "":
                 fil, typ = dataset.split("|")
                 filname = os.path.split(fil)[1]
-                isset = execute(isset_dataset, fil)
-                if not isset:
-                    datasets['ko'].append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
-                    nb_ko += 1
-                else:
-                    datasets['ok'].append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
+                last_datasets.append({'instance': instance.name, 'file': fil, 'type': typ, 'filename': filname})
             else:
                 datasets['empty'].append(instance.name)
 
@@ -384,6 +560,13 @@ def check_last_dataset():
                                             'filename': filname, 'date': dat})
                 datasets_pending[instance.name].append(filname)
 
+    # all the datasets are looked for on tyr_master with a single command
+    with settings(host_string=env.roledefs['tyr_master'][0]):
+        stats = stat_files([data['file'] for data in last_datasets])
+    for data in last_datasets:
+        datasets['ok' if stats[data['file']] else 'ko'].append(data)
+    nb_ko = len(datasets['ko'])
+
     if len(datasets['ok']):
         print("******** AVAILABLE DATASETS ********")
         for data in datasets['ok']:
@@ -431,21 +614,31 @@ def update_all_configurations():
     """
     update all configuration and restart all services
     does not deploy any packages
+    with env.upload_only_changed_templates, only the services with an updated configuration are restarted
     """
     # TODO refactor this to follow a good orchestration for production
     execute(kraken.get_no_data_instances)
-    execute(jormungandr.update_jormungandr_conf)
-    execute(kraken.update_monitor_configuration)
-    execute(tyr.update_tyr_confs)
+    if env.upload_only_changed_templates:
+        execute(jormungandr.fetch_jormungandr_conf_checksums)
+        if not env.use_config_bundle:
+            execute(kraken.fetch_eng_conf_checksums)
+    jormungandr_changes = changed_files(execute(jormungandr.update_jormungandr_conf))
+    tyr_changes = tyr.update_tyr_confs()
     for instance in env.instances.values():
-        execute(tyr.update_tyr_instance_conf, instance)
-        execute(jormungandr.deploy_jormungandr_instance_conf, instance)
-        execute(kraken.update_eng_instance_conf, instance)
+        jormungandr_changes.extend(changed_files(execute(jormungandr.deploy_jormungandr_instance_conf, instance)))
+    kraken_changes = update_kraken_confs()
     #once all has been updated, we restart all services for the conf to be taken into account
-    execute(tyr.restart_tyr_worker)
-    execute(tyr.restart_tyr_beat)
-    execute(jormungandr.reload_jormun_safe_all)
-    execute(kraken.restart_all_krakens)
+    if tyr_changes:
+        execute(tyr.restart_tyr_worker)
+        execute(tyr.restart_tyr_beat)
+    if jormungandr_changes:
+        execute(jormungandr.reload_jormun_safe_all)
+    execute(kraken.require_monitor_kraken_started)
+    for instance in env.instances.values():
+        if kraken_changes[instance.name]:
+            kraken.restart_kraken(instance)
+        else:
+            print(blue("NOTICE: configuration of kraken {} unchanged, no restart".format(instance.name)))
 
     # and we test the jormungandr
     for server in env.roledefs['ws']:
@@ -29,34 +29,54 @@
 # https://groups.google.com/d/forum/navitia
 # www.navitia.io
 
+import atexit
+from collections import OrderedDict, Counter, namedtuple
 from contextlib import contextmanager
 from envelopes import Envelope
+import fcntl
 import functools
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
 from multiprocessing.dummy import Pool as ThreadPool
+import pickle
+import Queue
 from fabric.context_managers import settings
 import os
 from pipes import quote
 import random
 from retrying import Retrying, RetryError
 import string
+import StringIO
+import sys
+import tarfile
+import tempfile
+import threading
 import time
 import datetime
 import semver
+import socket
 from abc import ABCMeta, abstractmethod
 import re
 
 import requests
 from requests.auth import HTTPBasicAuth
 
-from fabric.api import env, task, roles, run, put, sudo, warn_only, execute
-from fabric.colors import green, yellow, red
-from fabric.context_managers import cd
+from Crypto import Random
+from fabric import state
+from fabric.api import env, task, roles, run, put, sudo, warn_only, execute, abort
+from fabric.colors import blue, green, yellow, red
+from fabric.context_managers import cd, hide
 from fabric.contrib.files import exists
 from fabric.decorators import roles
+from fabric.network import HostConnectionCache, normalize, normalize_to_string, join_host_strings
 from fabtools.files import upload_template
-from fabtools import require
+from fabtools import require, python
 from fabtools.require.files import temporary_directory
 from fabtools.utils import run_as_root
+from jinja2 import Environment, FileSystemLoader
 
 
 # thanks
@@ -144,20 +164,255 @@ def require_directories(dirs, is_on_nfs4=False, **kwargs):
             del kwargs['group']
     require.files.directories(dirs, **kwargs)
 
-    
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.path.pardir, 'templates')
+
+# md5 of remote files by (host_string, path), None if the file does not exist
+_remote_checksums = {}
+
+
+def fetch_remote_checksums(paths):
+    """
+    get the md5 of a list of files of the current host in a single command,
+    they are kept for the next _upload_template() of these files
+    """
+    checksums = dict.fromkeys(paths)
+    if not checksums:
+        return checksums
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = run_as_root('md5sum {} 2>/dev/null'.format(' '.join(quote(p) for p in checksums)))
+    for line in output.splitlines():
+        md5, _, path = line.strip().partition('  ')
+        if path in checksums:
+            checksums[path] = md5
+    for path, md5 in checksums.iteritems():
+        _remote_checksums[(env.host_string, path)] = md5
+    return checksums
+
+
+FileStat = namedtuple('FileStat', 'size mtime')
+
+
+def stat_files(paths):
+    """
+    get the size and modification time of a list of files of the current host in a single command
+    returns a dict path -> FileStat, None if the file does not exist
+    """
+    stats = dict.fromkeys(paths)
+    if not stats:
+        return stats
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = run_as_root("stat --format '%s %Y %n' {} 2>/dev/null".format(' '.join(quote(p) for p in stats)))
+    for line in output.splitlines():
+        size, mtime, path = line.strip().split(' ', 2)
+        if path in stats:
+            stats[path] = FileStat(int(size), int(mtime))
+    return stats
+
+
+def get_free_space(paths):
+    """
+    get the mount point and free space in bytes of the filesystem of each path of the current host
+    (of its first existing parent if it does not exist yet), in a single command
+    returns a dict path -> (mount point, free space)
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+    with settings(hide('running', 'stdout')):
+        output = run('df -P -B1 $(for p in {}; do while [ ! -e "$p" ]; do p=$(dirname "$p"); done; echo "$p"; done)'
+                     .format(' '.join(quote(p) for p in paths)))
+    # one line per path after the header, mount point last
+    lines = [line.split(None, 5) for line in output.splitlines()[1:]]
+    return {path: (line[5], int(line[3])) for path, line in zip(paths, lines)}
+
+
+def check_free_space(required, available, margin):
+    """
+    compare the space required on each (host, mount point) to the space available,
+    with margin (eg 0.1 for 10%) more
+    returns the list of (host, mount point, required, available, enough) sorted by host and mount point
+    """
+    return [(host, mount, needed, available[(host, mount)], needed * (1 + margin) <= available[(host, mount)])
+            for (host, mount), needed in sorted(required.iteritems())]
+
+
+def changed_files(results):
+    """
+    flatten the lists of changed files returned by configuration tasks,
+    called directly or through execute()
+    """
+    if isinstance(results, dict):
+        return [f for r in results.itervalues() for f in changed_files(r)]
+    return list(results or [])
+
+
+def _render_template(filename, context, template_dir):
+    jenv = Environment(loader=FileSystemLoader(template_dir))
+    return jenv.get_template(filename).render(**context or {}).encode('utf-8')
+
+
 def _upload_template(filename, destination, context=None, chown=True, user='www-data', **kwargs):
+    """
+    upload a jinja template of the templates directory
+    if env.upload_only_changed_templates is set, the template is rendered locally and
+    uploaded only if the remote file differs (see fetch_remote_checksums())
+
+    returns True if the file has been uploaded
+    """
     kwargs['use_jinja'] = True
-    kwargs['template_dir'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                          os.path.pardir, 'templates')
+    kwargs['template_dir'] = TEMPLATES_DIR
     kwargs['context'] = context
     kwargs['mkdir'] = False
     kwargs['chown'] = chown
     kwargs['user'] = user
     kwargs['use_sudo'] = True
     kwargs['backup'] = env.backup_conf_files
+    if env.upload_only_changed_templates:
+        key = (env.host_string, destination)
+        if key not in _remote_checksums:
+            fetch_remote_checksums([destination])
+        text = _render_template(filename, context, kwargs['template_dir'])
+        if _remote_checksums[key] == hashlib.md5(text).hexdigest():
+            return False
+        # the file may be changed after the upload (eg removed), so it will be checked again next time
+        del _remote_checksums[key]
     upload_template(filename, destination, **kwargs)
+    return True
+
+
+class ConfigBundle(object):
+    """
+    push all the configuration files of the current host in a single archive
+
+    the files are extracted next to their destination with a '.bundle' suffix, then
+    all renamed at once, so a service never reads a partially written configuration
+
+    bundle = ConfigBundle()
+    bundle.add_directory('/srv/kraken/fr-idf', owner=env.KRAKEN_USER)
+    bundle.add('kraken/kraken.ini.jinja', '/srv/kraken/fr-idf/kraken.ini', context={'env': env})
+    updated_files = bundle.push()
+    """
+    SUFFIX = '.bundle'
+
+    def __init__(self):
+        self.directories = OrderedDict()
+        self.files = OrderedDict()
+
+    def add_directory(self, path, owner='www-data', mode='755'):
+        self.directories[path] = (owner, mode)
+
+    def add(self, filename, destination, context=None, user='www-data', mode='644'):
+        self.files[destination] = (_render_template(filename, context, TEMPLATES_DIR), user, mode)
+
+    def _archive(self, destinations):
+        archive = tempfile.NamedTemporaryFile(suffix='.tar.gz')
+        with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+            for path, (owner, mode) in self.directories.iteritems():
+                info = tarfile.TarInfo(path.lstrip('/'))
+                info.type = tarfile.DIRTYPE
+                info.uname = info.gname = owner
+                info.mode = int(mode, 8)
+                info.mtime = time.time()
+                tar.addfile(info)
+            for path in destinations:
+                text, owner, mode = self.files[path]
+                info = tarfile.TarInfo(path.lstrip('/') + self.SUFFIX)
+                info.size = len(text)
+                info.uname = info.gname = owner
+                info.mode = int(mode, 8)
+                info.mtime = time.time()
+                tar.addfile(info, StringIO.StringIO(text))
+        archive.flush()
+        return archive
+
+    def push(self):
+        """
+        returns the list of updated files
+        with env.upload_only_changed_templates, the files with an unchanged content are not pushed
+        """
+        destinations = list(self.files)
+        if env.upload_only_changed_templates:
+            checksums = fetch_remote_checksums(destinations)
+            destinations = [path for path in destinations
+                            if checksums[path] != hashlib.md5(self.files[path][0]).hexdigest()]
+        if not destinations:
+            return []
+        # the archive holds credentials: a new file only readable by the ssh user (mktemp), removed in any case
+        with settings(hide('running', 'stdout')):
+            remote_archive = run('mktemp --suffix=.tar.gz /tmp/config_bundle_XXXXXXXXXX').strip()
+        try:
+            script = ['set -e', 'tar -xzpf {} -C /'.format(remote_archive)]
+            for path in destinations:
+                if env.backup_conf_files:
+                    script.append('if [ -f {0} ]; then cp -p {0} {0}.bak; fi'.format(quote(path)))
+                script.append('mv -f {} {}'.format(quote(path + self.SUFFIX), quote(path)))
+                _remote_checksums.pop((env.host_string, path), None)
+            archive = self._archive(destinations)
+            try:
+                put(archive.name, remote_archive, mode=0600)
+            finally:
+                archive.close()
+            run_as_root('; '.join(script))
+        finally:
+            with settings(hide('running', 'stdout'), warn_only=True):
+                run('rm -f {}'.format(remote_archive))
+        return destinations
+
 
+_host_facts = {}
+# facts invalidated in forked processes (eg fabric's parallel mode), to invalidate them in the fabric process too
+_forked_invalidations = multiprocessing.Queue()
 
+
+def _in_forked_process():
+    return multiprocessing.current_process().name != 'MainProcess'
+
+
+def host_fact(func):
+    """
+    Gather a fact (version, installed software, ...) only once per host for the whole run,
+    the cached value is returned to every caller until invalidate_host_facts() is called.
+    The fact is named after the function.
+    """
+    @functools.wraps(func)
+    def decorated():
+        if not _in_forked_process():
+            _apply_forked_invalidations()
+        key = (normalize_host(env.host_string), func.__name__)
+        if key not in _host_facts:
+            _host_facts[key] = func()
+        return _host_facts[key]
+    return decorated
+
+
+def _apply_forked_invalidations():
+    while True:
+        try:
+            facts, host_string = _forked_invalidations.get_nowait()
+        except Queue.Empty:
+            return
+        _forget_host_facts(facts, host_string)
+
+
+def _forget_host_facts(facts, host_string):
+    for key in list(_host_facts):
+        if (host_string is None or key[0] == normalize_host(host_string)) and (facts is None or key[1] in facts):
+            del _host_facts[key]
+
+
+def invalidate_host_facts(facts=None, host_string=None):
+    """
+    forget some facts (all if facts is None) of a host (all hosts if host_string is None),
+    call it when the host is changed, eg after a package installation
+    in a forked process, the fabric process forgets them too before its next fact
+    """
+    _forget_host_facts(facts, host_string)
+    if _in_forked_process():
+        _forked_invalidations.put((facts, host_string))
+
+
+@host_fact
 def get_psql_version():
     version_lines = run('psql --version')
     v_line = version_lines.split('\n')[0]
@@ -174,6 +429,30 @@ def get_host_addr(host):
     return host.split('@')[-1]
 
 
+_local_names = {'localhost': None, '127.0.0.1': None, '::1': None}
+
+
+def normalize_host(host):
+    """
+    the same key for all the host strings of a host: user@host:port with env.user and
+    port 22 by default, the local host being named by its fqdn
+    eg with env.user root, 'localhost' returns 'root@tyr.example.com:22'
+    """
+    user, name, port = normalize(host)
+    name = name.lower()
+    if name in _local_names:
+        if _local_names[name] is None:
+            _local_names[name] = socket.getfqdn().lower()
+        name = _local_names[name]
+    return join_host_strings(user, name, port)
+
+
+def is_current_host(host_strings):
+    """ True if one of the host strings names the current host (env.host_string), see normalize_host() """
+    current = normalize_host(env.host_string)
+    return any(normalize_host(h) == current for h in host_strings)
+
+
 class Parallel:
     """
     run job in multi thread
@@ -195,8 +474,554 @@ class Parallel:
         self.pool.close()
         self.pool.join()
 
-    def map(self, func, param):
-        self.pool.map(func, param)
+    def map(self, func, param, chunksize=None):
+        return self.pool.map(func, param, chunksize)
+
+
+class BudgetPool(object):
+    """
+    run jobs in threads, keeping the sum of the costs of the running jobs under a budget
+    (eg the memory needed by each job), the biggest jobs first.
+    A job costing more than the whole budget is run alone.
+
+    results = BudgetPool(budget=free_memory, nb_thread=4).map(load, [(size, data) for data, size in ...])
+    """
+    def __init__(self, budget, nb_thread):
+        self.budget = budget
+        self.nb_thread = nb_thread
+        self.used = 0
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def _run(self, func, cost, param):
+        with self.condition:
+            while self.running and self.used + cost > self.budget:
+                self.condition.wait()
+            self.used += cost
+            self.running += 1
+        try:
+            return func(param)
+        finally:
+            with self.condition:
+                self.used -= cost
+                self.running -= 1
+                self.condition.notify_all()
+
+    def map(self, func, jobs):
+        """ jobs is a list of (cost, param), returns the list of (param, result) in execution order """
+        jobs = sorted(jobs, key=lambda job: job[0], reverse=True)
+        with Parallel(self.nb_thread) as pool:
+            results = pool.map(lambda job: (job[1], self._run(func, *job)), jobs)
+        return results
+
+
+def estimate_makespan(durations, nb_slots):
+    """
+    time needed to run jobs of the given durations with nb_slots jobs at the same time,
+    the longest first, each one starting as soon as a slot is free
+    """
+    slots = [0] * max(nb_slots, 1)
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(slots, slots[0] + duration)
+    return max(slots)
+
+
+def plan_fanout(sources, destinations):
+    """
+    plan the copy of a file from sources to destinations as a tree: at each round, every host
+    having the file sends it to a host that doesn't, doubling the number of copies, so that the
+    number of rounds grows with the log of the number of destinations
+    returns the list of the rounds, each one a list of (source, destination)
+    """
+    holders, missing, rounds = list(sources), list(destinations), []
+    while missing and holders:
+        links = zip(holders, missing)
+        rounds.append(links)
+        missing = missing[len(links):]
+        holders.extend(destination for _, destination in links)
+    return rounds
+
+
+def get_mem_available():
+    """ memory (in bytes) available on the current host without swapping """
+    with settings(hide('running', 'stdout')):
+        return int(run("awk '/^MemAvailable:/ {print $2}' /proc/meminfo")) * 1024
+
+
+HostLoad = namedtuple('HostLoad', 'load mem_available iowait')
+
+
+def sample_host_load(period=1):
+    """
+    load of the current host: load average per cpu, available memory (in bytes) and
+    fraction of the cpu time spent waiting for io during `period` seconds
+    """
+    with settings(hide('running', 'stdout')):
+        output = run("cut -d' ' -f1 /proc/loadavg; nproc; awk '/^MemAvailable:/ {{print $2}}' /proc/meminfo; "
+                     "head -1 /proc/stat; sleep {}; head -1 /proc/stat".format(period)).splitlines()
+    load, cpus, mem_available = float(output[0]), int(output[1]), int(output[2]) * 1024
+    # cpu user nice system idle iowait ...
+    before, after = ([int(v) for v in line.split()[1:]] for line in output[3:5])
+    total = sum(after) - sum(before)
+    iowait = float(after[4] - before[4]) / total if total else 0
+    return HostLoad(load / cpus, mem_available, iowait)
+
+
+class AdaptiveLimiter(object):
+    """
+    limit the number of jobs running at the same time on the current host, between minimum and
+    maximum: every sample_interval seconds, the load of the host is sampled (see sample_host_load())
+    and one more job is allowed if the host is not loaded, one less if it is overloaded:
+     - load average per cpu above env.adaptive_max_load
+     - available memory below env.adaptive_min_memory
+     - iowait above env.adaptive_max_iowait
+
+    limiter = AdaptiveLimiter(1, 8)
+    with limiter:
+        run_job()
+    """
+    def __init__(self, minimum, maximum, sample_interval=30, name='jobs', start=None):
+        self.minimum, self.maximum = minimum, maximum
+        self.limit = min(max(start or minimum, minimum), maximum)
+        self.sample_interval = sample_interval
+        self.name = name
+        self.running = 0
+        self.last_sample = 0
+        self.condition = threading.Condition()
+        self.sampling = threading.Lock()
+
+    def adjust(self):
+        """ sample the load of the host and update the limit, unless it was done recently """
+        if time.time() - self.last_sample < self.sample_interval or not self.sampling.acquire(False):
+            return
+        try:
+            host_load = sample_host_load()
+            self.last_sample = time.time()
+            overloaded = host_load.load > env.adaptive_max_load or \
+                host_load.mem_available < env.adaptive_min_memory or host_load.iowait > env.adaptive_max_iowait
+            with self.condition:
+                limit = max(self.limit - 1, self.minimum) if overloaded else min(self.limit + 1, self.maximum)
+                if limit != self.limit:
+                    print(blue("{} at the same time: {} -> {} (load {:.2f}, {:.1f} GB available, iowait {:.0%})"
+                               .format(self.name, self.limit, limit, host_load.load,
+                                       host_load.mem_available / 2. ** 30, host_load.iowait)))
+                    self.limit = limit
+                    self.condition.notify_all()
+        finally:
+            self.sampling.release()
+
+    def __enter__(self):
+        self.adjust()
+        with self.condition:
+            while self.running >= self.limit:
+                self.condition.wait(self.sample_interval)
+                if self.running >= self.limit:
+                    self.condition.release()
+                    try:
+                        self.adjust()
+                    finally:
+                        self.condition.acquire()
+            self.running += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+
+class ConnectionPool(HostConnectionCache):
+    """
+    fabric connection cache, keeping track of the ssh connections opened and reused
+
+    fabric keeps one ssh transport per host for the whole run, and each run/sudo/put
+    opens a new channel on it: nested execute() or settings(host_string=...) reuse it.
+    Only the processes forked for parallel executions need to open their own connections,
+    they are not counted: the counters are the ones of the process that shows them.
+    """
+    opened = Counter()
+    # channels opened on a transport after its first one
+    reused = Counter()
+
+    def connect(self, key):
+        key = normalize_to_string(key)
+        ConnectionPool.opened[key] += 1
+        super(ConnectionPool, self).connect(key)
+        transport = dict.__getitem__(self, key).get_transport()
+        open_session, sessions = transport.open_session, itertools.count()
+
+        def counted_open_session(*args, **kwargs):
+            if next(sessions):
+                ConnectionPool.reused[key] += 1
+            return open_session(*args, **kwargs)
+        transport.open_session = counted_open_session
+
+# fabric modules have already imported the cache object, so we only change its class
+state.connections.__class__ = ConnectionPool
+
+
+@task
+def show_connection_stats():
+    """ print the number of ssh connections opened and reused by host, for this process only """
+    print(blue("---------- SSH connections"))
+    for host in sorted(set(ConnectionPool.opened) | set(ConnectionPool.reused)):
+        print("{}: {} opened, {} reused".format(host, ConnectionPool.opened[host], ConnectionPool.reused[host]))
+    print("total: {} opened, {} reused".format(sum(ConnectionPool.opened.values()),
+                                               sum(ConnectionPool.reused.values())))
+
+
+@atexit.register
+def _show_connection_stats_at_exit():
+    if env.get('show_connection_stats') and multiprocessing.current_process().name == 'MainProcess':
+        show_connection_stats()
+
+
+def _prompt_possible():
+    """
+    True if fabric may ask something on the current host (eg a sudo password): it is not told
+    to abort instead (env.abort_on_prompts) and doesn't know the password
+    """
+    return not (env.abort_on_prompts or env.password or env.passwords.get(normalize_to_string(env.host_string)))
+
+
+class _RoleParallelTask(object):
+    """
+    callable set by the parallel_on_role() decorator
+
+    fabric reads 'parallel' and 'pool_size' when the task is executed,
+    so they follow env.role_parallelism even if it is set by the platform file
+    """
+    def __init__(self, func, role):
+        functools.update_wrapper(self, func)
+        self.wrapped = func
+        self.role = role
+
+    @property
+    def pool_size(self):
+        return env.role_parallelism.get(self.role)
+
+    @property
+    def parallel(self):
+        return (self.pool_size or 1) > 1
+
+    def __call__(self, *args, **kwargs):
+        if not env.parallel:
+            return self.wrapped(*args, **kwargs)
+        # we are in a child process of fabric's parallel mode:
+        # keep the output of the host in a single block and report its failure
+        Random.atfork()
+        if _prompt_possible():
+            # a captured prompt would wait for an answer without being shown
+            return self.wrapped(*args, **kwargs)
+        real_stdout, real_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = output = StringIO.StringIO()
+        try:
+            return self.wrapped(*args, **kwargs)
+        except BaseException as e:
+            print(red("ERROR: task {} failed on {}: {!r}".format(self.__name__, env.host_string, e)))
+            raise
+        finally:
+            sys.stdout, sys.stderr = real_stdout, real_stderr
+            sys.stdout.write("{}\n{}".format(green("---------- {} on {}".format(self.__name__, env.host_string)),
+                                              output.getvalue()))
+            sys.stdout.flush()
+
+
+def parallel_on_role(role):
+    """
+    run a role task on several hosts at the same time,
+    with at most env.role_parallelism[role] hosts in parallel (serial if not set)
+
+    the output of each host is printed in one block when the host is done, unless fabric may
+    prompt for something (see _prompt_possible())
+
+    use it between @task and @roles:
+    @task
+    @parallel_on_role('eng')
+    @roles('eng')
+    def my_task():
+    """
+    def decorator(func):
+        return _RoleParallelTask(func, role)
+    return decorator
+
+
+def init_forked_process():
+    """
+    to call first in a process forked from fabric: same precautions as fabric's parallel
+    mode, reseed the random generator and don't share the parent's ssh connections
+    """
+    Random.atfork()
+    state.connections.clear()
+
+
+def _run_forked_step(queue, name, task, args, kwargs):
+    """
+    body of a TaskGraph step run in its own process
+    """
+    init_forked_process()
+    try:
+        result = execute(task, *args, **kwargs)
+        try:
+            pickle.dumps(result)
+        except Exception:
+            result = None
+        queue.put((name, True, result))
+    except BaseException as e:
+        queue.put((name, False, repr(e)))
+
+
+class TaskGraph(object):
+    """
+    run fabric tasks according to the dependencies between them
+
+    each step is a task given to execute(), it is started as soon as all the steps it
+    requires are done. Independent steps run at the same time, each one in its own process
+    (as fabric does in parallel mode), so they can't update env.
+    Steps declared with fork=False are run in the fabric process itself, one at a time.
+    eg:
+    graph = TaskGraph()
+    graph.add_step('packages', upgrade_packages)
+    graph.add_step('bina', launch_bina, fork=False)
+    graph.add_step('restart', restart, requires=['packages', 'bina'])
+    graph.run(nb_process=2)
+    """
+    def __init__(self):
+        self.steps = OrderedDict()
+
+    def add_step(self, name, task, args=(), kwargs=None, requires=(), fork=True):
+        if name in self.steps:
+            raise ValueError("Step '{}' is already declared".format(name))
+        self.steps[name] = dict(task=task, args=tuple(args), kwargs=kwargs or {},
+                                requires=set(requires), fork=fork)
+
+    def check(self):
+        """ raise a ValueError on unknown or cyclic dependencies """
+        for name, step in self.steps.iteritems():
+            unknown = step['requires'].difference(self.steps)
+            if unknown:
+                raise ValueError("Step '{}' requires unknown step(s): {}".format(name, ', '.join(unknown)))
+        done, pending = set(), set(self.steps)
+        while pending:
+            ready = set(n for n in pending if self.steps[n]['requires'] <= done)
+            if not ready:
+                raise ValueError("Cyclic dependencies between steps: {}".format(', '.join(pending)))
+            done.update(ready)
+            pending.difference_update(ready)
+
+    def run(self, nb_process=1, journal=None):
+        """
+        run all the steps, at most nb_process of them at the same time
+        with nb_process=1 the steps are run one after the other, in declaration order
+        the steps recorded as done in the journal (see UpgradeJournal) are skipped, the others are recorded
+
+        returns a dict step name -> result of execute()
+        aborts once the running steps are over if one of them failed
+        """
+        self.check()
+        results, done, failed = {}, set(), {}
+        pending = list(self.steps)
+        if journal:
+            for name in list(pending):
+                if journal.is_done(name):
+                    print(blue("Step '{}' already done, skipping it".format(name)))
+                    pending.remove(name)
+                    done.add(name)
+        running = {}
+        queue = multiprocessing.Queue()
+
+        while pending or running:
+            ready = [] if failed else [n for n in pending if self.steps[n]['requires'] <= done]
+            for name in ready:
+                if nb_process > 1 and self.steps[name]['fork'] and len(running) < nb_process:
+                    step = self.steps[name]
+                    print(blue("Starting step '{}'".format(name)))
+                    p = multiprocessing.Process(target=_run_forked_step, name=name,
+                                                args=(queue, name, step['task'], step['args'], step['kwargs']))
+                    p.start()
+                    running[name] = p
+                    pending.remove(name)
+            inline = [n for n in ready if n in pending and (nb_process == 1 or not self.steps[n]['fork'])]
+            if inline:
+                name = inline[0]
+                step = self.steps[name]
+                pending.remove(name)
+                print(blue("Starting step '{}'".format(name)))
+                try:
+                    results[name] = execute(step['task'], *step['args'], **step['kwargs'])
+                    done.add(name)
+                    if journal:
+                        journal.mark_done(name)
+                except (Exception, SystemExit) as e:
+                    failed[name] = repr(e)
+                continue
+            if not running:
+                break
+            name, success, result = self._wait_step(queue, running)
+            running.pop(name).join()
+            if success:
+                results[name] = result
+                done.add(name)
+                if journal:
+                    journal.mark_done(name)
+                print(blue("Step '{}' is done".format(name)))
+            else:
+                failed[name] = result
+
+        if failed:
+            for name, error in failed.iteritems():
+                print(red("ERROR: step '{}' failed: {}".format(name, error)))
+            if pending:
+                print(red("Steps not run: {}".format(', '.join(pending))))
+            abort(red("{} step(s) failed".format(len(failed))))
+        return results
+
+    @staticmethod
+    def _wait_step(queue, running):
+        """ wait for a forked step to be over, and return (name, success, result) """
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                for name, p in running.iteritems():
+                    if p.exitcode not in (None, 0):
+                        return name, False, "process exited with code {}".format(p.exitcode)
+
+
+class LocalState(object):
+    """
+    json dict kept between runs in env.fabric_state_dir, one file per platform
+    eg the durations of the previous runs, to estimate the next ones
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(os.path.expanduser(env.fabric_state_dir), '{}_{}.json'.format(self.name, env.name))
+
+    def load(self):
+        """ a missing or unreadable file is an empty state, it is only used for estimations """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    @contextmanager
+    def _locked(self):
+        """ the forked processes of a run (TaskGraph, KrakenReloader...) may set it too """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    raise
+        with self.lock, open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def set(self, key, value):
+        with self._locked():
+            data = self.load()
+            data[key] = value
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path), dir=os.path.dirname(self.path))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, indent=2)
+                os.rename(tmp, self.path)
+            except Exception:
+                os.remove(tmp)
+                raise
+
+
+class UpgradeJournal(object):
+    """
+    local journal of an upgrade, to resume it after a crash
+
+    it records the steps that are done and, inside a step, the instances that are done.
+    It is a json file in env.fabric_state_dir, rewritten atomically on each change; a lock
+    file allows the forked steps of a TaskGraph to update it too.
+    eg:
+    journal = UpgradeJournal(resume=True)
+    if not journal.is_done('restart'):
+        for instance in instances:
+            if not journal.is_done('restart', instance):
+                restart(instance)
+                journal.mark_done('restart', instance)
+        journal.mark_done('restart')
+    journal.clear()
+    """
+    def __init__(self, resume=False, path=None):
+        self.path = path or os.path.join(os.path.expanduser(env.fabric_state_dir),
+                                         'upgrade_journal_{}.json'.format(env.name))
+        self.lock = threading.Lock()
+        if resume and os.path.exists(self.path):
+            data = self._load()
+            print(blue("Resuming upgrade started at {}, steps done: {}".format(
+                data['started'], ', '.join(data['steps']) or 'none')))
+        else:
+            if os.path.exists(self.path):
+                print(yellow("WARNING: discarding the journal of a previous upgrade ({})".format(self.path)))
+            elif resume:
+                print(yellow("WARNING: no upgrade to resume, starting from scratch"))
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            self._save(dict(started=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            steps=[], instances={}))
+
+    def _load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _save(self, data):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.rename(tmp, self.path)
+
+    @contextmanager
+    def _locked(self):
+        with self.lock, open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def is_done(self, step, instance=None):
+        with self._locked():
+            data = self._load()
+        if instance is None:
+            return step in data['steps']
+        return instance in data['instances'].get(step, [])
+
+    def mark_done(self, step, instance=None):
+        with self._locked():
+            data = self._load()
+            if instance is None:
+                if step not in data['steps']:
+                    data['steps'].append(step)
+            elif instance not in data['instances'].setdefault(step, []):
+                data['instances'][step].append(instance)
+            self._save(data)
+
+    def clear(self):
+        """ the upgrade is over, there is nothing to resume """
+        for path in (self.path, self.path + '.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def journal_is_done(step, instance=None):
+    """ True if the step (or the instance in the step) is recorded in the journal of the running upgrade """
+    return bool(env.upgrade_journal and step and env.upgrade_journal.is_done(step, instance))
+
+
+def journal_mark_done(step, instance=None):
+    if env.upgrade_journal and step:
+        env.upgrade_journal.mark_done(step, instance)
 
 
 def run_once_per_host(func):
@@ -342,12 +1167,27 @@ def show_version(action='show', host='eng'):
         return semver.compare(candidate, installed) > 0
 
 
+@host_fact
+def has_systemd():
+    with settings(warn_only=True):
+        return run('which systemd') != ''
+
+
+@host_fact
+def is_pip_installed():
+    return python.is_pip_installed()
+
+
+def require_pip():
+    if not is_pip_installed():
+        python.install_pip()
+        invalidate_host_facts(['is_pip_installed'], env.host_string)
+
+
 @task
 def update_init(host):
     with settings(host_string=env.roledefs[host][0]):
-        with settings(warn_only=True):
-            result = run('which systemd')
-        if result == '':
+        if not has_systemd():
             print('systemd is not installed')
         else:
             run('systemctl daemon-reload')
@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import settings
+
+from fabfile.component import tyr
+from fabfile.utils import FileStat, estimate_makespan
+
+
+def test_sort_by_bina_duration():
+    sizes = {'a': 100, 'b': 1000, 'c': 400, 'd': None}
+    stats = {'/srv/{}/data.nav.lz4'.format(i): FileStat(s, 0) if s else None for i, s in sizes.iteritems()}
+    with settings(roledefs={'tyr_master': ['root@tyr']}), \
+            mock.patch.object(tyr, 'get_real_instance',
+                              side_effect=lambda i: mock.Mock(target_lz4_file='/srv/{}/data.nav.lz4'.format(i))), \
+            mock.patch.object(tyr, 'stat_files', return_value=stats), \
+            mock.patch.object(tyr.bina_durations, 'load', return_value={'a': 50., 'b': 60.}):
+        # c is expected to take 400 * 0.5 = 200s (median rate of a and b: 0.5s and 0.06s per byte)
+        assert tyr.sort_by_bina_duration(set(sizes)) == ['c', 'b', 'a', 'd']
+
+
+def test_sort_by_bina_duration_without_history():
+    sizes = {'a': 100, 'b': 1000, 'c': 400, 'd': None}
+    stats = {'/srv/{}/data.nav.lz4'.format(i): FileStat(s, 0) if s else None for i, s in sizes.iteritems()}
+    with settings(roledefs={'tyr_master': ['root@tyr']}), \
+            mock.patch.object(tyr, 'get_real_instance',
+                              side_effect=lambda i: mock.Mock(target_lz4_file='/srv/{}/data.nav.lz4'.format(i))), \
+            mock.patch.object(tyr, 'stat_files', return_value=stats), \
+            mock.patch.object(tyr.bina_durations, 'load', return_value={'d': 30.}):
+        # no rate known, no estimation: the biggest data.nav.lz4 first
+        assert tyr.expected_bina_durations(set(sizes)) is None
+        assert tyr.sort_by_bina_duration(set(sizes)) == ['b', 'c', 'a', 'd']
+
+
+def test_unchanged_instances():
+    fingerprints = {'a': {'version': '1.0', 'datasets': [['/a.zip', 10, 100]]},
+                    'b': {'version': '1.1', 'datasets': [['/b.zip', 10, 100]]},
+                    'c': {'version': '1.0', 'datasets': [['/c.zip', 10, 100]]}}
+    known = {i: {'inputs': {'version': '1.0', 'datasets': f['datasets']}, 'output': [50, 200]}
+             for i, f in fingerprints.iteritems()}
+    targets = {'/srv/a/data.nav.lz4': FileStat(50, 200), '/srv/b/data.nav.lz4': FileStat(50, 200),
+               # c has been binarized again since, by another tyr job
+               '/srv/c/data.nav.lz4': FileStat(60, 300)}
+    with mock.patch.object(tyr, 'get_real_instance',
+                           side_effect=lambda i: mock.Mock(target_lz4_file='/srv/{}/data.nav.lz4'.format(i))), \
+            mock.patch.object(tyr, 'stat_files', side_effect=lambda paths: {p: targets[p] for p in paths}), \
+            mock.patch.object(tyr.bina_fingerprints, 'load', return_value=known):
+        assert tyr.get_unchanged_instances(fingerprints) == ['a']
+
+
+def test_estimate_makespan():
+    assert estimate_makespan([], 2) == 0
+    assert estimate_makespan([10, 3, 4, 5], 1) == 22
+    # 10 | 5 + 4 + 3
+    assert estimate_makespan([10, 3, 4, 5], 2) == 12
+    assert estimate_makespan([10, 3, 4, 5], 8) == 10
+
+
+def test_find_bina_regressions():
+    history = {
+        # twice slower, with the same datasets
+        'a': [dict(duration=100, datasets_size=10), dict(duration=110, datasets_size=10),
+              dict(duration=220, datasets_size=10)],
+        # twice slower, but with twice more data
+        'b': [dict(duration=100, datasets_size=10), dict(duration=200, datasets_size=20)],
+        # sizes unknown, the durations are compared
+        'c': [dict(duration=100, datasets_size=None), dict(duration=160, datasets_size=10)],
+        'd': [dict(duration=100, datasets_size=10)],
+    }
+    assert tyr.find_bina_regressions(history, 1.5) == {'a': (22, 11), 'c': (160, 100)}
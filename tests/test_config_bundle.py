@@ -0,0 +1,75 @@
+# encoding: utf-8
+
+import tarfile
+import mock
+import pytest
+
+from fabric.api import env, settings
+
+from fabfile import utils
+from fabfile.component import kraken
+
+
+def test_config_bundle():
+    bundle = utils.ConfigBundle()
+    bundle.add_directory('/srv/ed/fr-idf', owner='navitia')
+    bundle.add('tyr/tyr.wsgi.jinja', '/srv/tyr/tyr.wsgi', context={'tyr_settings_file': '/srv/tyr/settings.py'})
+    bundle.add('tyr/tyr.wsgi.jinja', '/srv/tyr/other.wsgi', context={'tyr_settings_file': '/srv/tyr/settings.py'},
+               user='root', mode='755')
+
+    archive = bundle._archive(['/srv/tyr/other.wsgi'])
+    with tarfile.open(archive.name) as tar:
+        members = {m.name: m for m in tar.getmembers()}
+        assert sorted(members) == ['srv/ed/fr-idf', 'srv/tyr/other.wsgi.bundle']
+        assert members['srv/ed/fr-idf'].isdir() and members['srv/ed/fr-idf'].uname == 'navitia'
+        assert members['srv/tyr/other.wsgi.bundle'].uname == 'root'
+        assert members['srv/tyr/other.wsgi.bundle'].mode == 0o755
+        assert '/srv/tyr/settings.py' in tar.extractfile('srv/tyr/other.wsgi.bundle').read()
+    archive.close()
+
+    with settings(host_string='h1', upload_only_changed_templates=False, backup_conf_files=False), \
+            mock.patch.object(utils, 'put') as put, mock.patch.object(utils, 'run_as_root') as run_as_root, \
+            mock.patch.object(utils, 'run', return_value='/tmp/config_bundle_x1Y2z3.tar.gz\r\n') as run:
+        assert bundle.push() == ['/srv/tyr/tyr.wsgi', '/srv/tyr/other.wsgi']
+        assert put.call_count == 1
+        assert run_as_root.call_count == 1
+        script = run_as_root.call_args[0][0]
+        assert 'mv -f /srv/tyr/tyr.wsgi.bundle /srv/tyr/tyr.wsgi' in script
+        assert 'mv -f /srv/tyr/other.wsgi.bundle /srv/tyr/other.wsgi' in script
+        # a private temporary file, removed even if the push fails
+        assert run.call_args_list[0][0][0].startswith('mktemp ')
+        assert put.call_args[0][1] == '/tmp/config_bundle_x1Y2z3.tar.gz'
+        assert put.call_args[1] == {'mode': 0o600}
+        run_as_root.side_effect = SystemExit(1)
+        with pytest.raises(SystemExit):
+            bundle.push()
+        assert run.call_args[0][0] == 'rm -f /tmp/config_bundle_x1Y2z3.tar.gz'
+
+
+def eng_instance():
+    instance = mock.Mock(kraken_engines=['eng1'], kraken_basedir='/srv/kraken')
+    instance.name = 'fr'
+    return instance
+
+
+def test_fetch_eng_conf_checksums_host_written_differently():
+    with settings(user='root', host_string='root@eng1:22', instances={'fr': eng_instance()},
+                  kraken_monitor_wsgi_file='/srv/monitor/monitor.wsgi',
+                  kraken_monitor_config_file='/srv/monitor/settings.py'), \
+            mock.patch.object(kraken, '_eng_instance_templates',
+                              return_value=[('kraken/kraken.ini.jinja', '/srv/kraken/fr/kraken.ini', {}, {})]), \
+            mock.patch.object(kraken, 'fetch_remote_checksums') as fetch:
+        kraken.fetch_eng_conf_checksums()
+    assert '/srv/kraken/fr/kraken.ini' in fetch.call_args[0][0]
+
+
+def test_push_eng_conf_bundle_host_written_differently():
+    with settings(user='root', host_string='root@eng1:22', instances={'fr': eng_instance()}, KRAKEN_USER='www-data',
+                  kraken_monitor_wsgi_file='/srv/monitor/monitor.wsgi',
+                  kraken_monitor_config_file='/srv/monitor/settings.py'), \
+            mock.patch.object(kraken, '_eng_instance_templates',
+                              return_value=[('kraken/kraken.ini.jinja', '/srv/kraken/fr/kraken.ini', {}, {})]), \
+            mock.patch.object(kraken, 'ConfigBundle') as bundle, \
+            mock.patch.object(kraken, 'update_init'):
+        bundle.return_value.push.return_value = ['/srv/kraken/fr/kraken.ini']
+        assert kraken.push_eng_conf_bundle() == {None: [], 'fr': ['/srv/kraken/fr/kraken.ini']}
@@ -0,0 +1,24 @@
+# encoding: utf-8
+
+from collections import Counter
+
+import mock
+
+from fabric import network
+
+from fabfile.utils import ConnectionPool
+
+
+def test_connection_pool_counts_reused_transports():
+    pool = ConnectionPool()
+    with mock.patch.object(ConnectionPool, 'opened', Counter()), \
+            mock.patch.object(ConnectionPool, 'reused', Counter()), \
+            mock.patch.object(network, 'connect', side_effect=lambda *args, **kwargs: mock.Mock()) as connect:
+        for _ in range(3):
+            pool['root@h1'].get_transport().open_session()
+        pool['root@h2:22'].get_transport().open_session()
+        # looking up a connection without opening a channel is not a reuse
+        pool['root@h2']
+        assert connect.call_count == 2
+        assert ConnectionPool.opened == {'root@h1:22': 1, 'root@h2:22': 1}
+        assert ConnectionPool.reused == {'root@h1:22': 2}
@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+import hashlib
+import subprocess
+
+import mock
+
+from fabric.api import settings
+
+from fabfile.component import kraken
+
+
+def test_kraken_not_restarted_on_corrupt_data():
+    instance = mock.Mock(kraken_database='/srv/kraken/fr/data.nav.lz4')
+    instance.name = 'fr'
+    with settings(data_nav_manifests=True, data_nav_hash_command='md5sum', data_nav_hash_nb_process=4), \
+            mock.patch.object(kraken, 'get_real_instance', return_value=instance), \
+            mock.patch.object(kraken, 'start_or_stop_with_delay') as start_or_stop, \
+            mock.patch.object(kraken, 'run', return_value='/srv/kraken/fr/data.nav.lz4 truncated') as run:
+        assert kraken.restart_kraken_on_host(instance, 'root@eng1') is False
+        assert not start_or_stop.called
+        assert 'xargs -0 -n 1 -P 4' in run.call_args[0][0]
+
+        # checked before by verify_data_nav_manifests()
+        kraken._data_nav_checks[('root@eng1', 'fr')] = 'ok'
+        run.reset_mock()
+        assert kraken.restart_kraken_on_host(instance, 'root@eng1') is True
+        assert not run.called
+        assert start_or_stop.call_count == 2
+        assert not kraken._data_nav_checks
+
+
+def test_stage_data():
+    instance = mock.Mock(kraken_shared_database='/srv/ed/data/fr/data.nav.lz4',
+                         kraken_database='/srv/local/fr/data.nav.lz4')
+    with settings(kraken_stage_bwlimit=50000), mock.patch.object(kraken, 'run') as run:
+        kraken._stage_data([instance])
+    assert run.call_args[0][0] == (
+        'mkdir -p /srv/local/fr && rsync --times --no-whole-file --ignore-missing-args --bwlimit=50000 '
+        '/srv/ed/data/fr/data.nav.lz4 /srv/ed/data/fr/data.nav.lz4.manifest /srv/local/fr/')
+
+
+def local_run(command):
+    process = subprocess.Popen(['/bin/sh', '-c', command], stdout=subprocess.PIPE)
+    return process.communicate()[0]
+
+
+def test_write_data_nav_manifests(tmpdir):
+    data = tmpdir.join('data.nav.lz4')
+    data.write('data')
+    missing = str(tmpdir.join('missing.nav.lz4'))
+    with settings(data_nav_hash_command='md5sum', data_nav_hash_nb_process=2), \
+            mock.patch.object(kraken, 'run', side_effect=local_run):
+        assert kraken.write_data_nav_manifests([str(data), missing]) == [missing]
+        assert kraken._run_on_files(kraken._MANIFEST_CHECK, [str(data), missing]) == {
+            str(data): 'ok', missing: 'missing'}
+    assert tmpdir.join('data.nav.lz4.manifest').read() == '{} 4 {}\n'.format(
+        hashlib.md5('data').hexdigest(), int(data.mtime()))
+    assert not tmpdir.join('missing.nav.lz4.manifest').exists()
+
+
+def test_verify_data_nav_manifests_host_written_differently():
+    instance = mock.Mock(kraken_engines=['eng1'], kraken_database='/srv/kraken/fr/data.nav.lz4')
+    instance.name = 'fr'
+    with settings(user='root', host_string='root@eng1:22', instances={'fr': instance}), \
+            mock.patch.object(kraken, '_run_on_files', return_value={'/srv/kraken/fr/data.nav.lz4': 'corrupt'}):
+        assert kraken.verify_data_nav_manifests() == {'fr': 'corrupt'}
@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import settings
+from fabric.operations import _AttributeString
+
+from fabfile.component import tyr
+
+
+def remote(output, succeeded=True):
+    result = _AttributeString(output)
+    result.succeeded = succeeded
+    return result
+
+
+def test_backup_datanav_keeps_last_versions():
+    config = mock.Mock()
+    config.get.return_value = '/srv/ed/data/fr/data.nav.lz4'
+    commands = []
+
+    def run(command):
+        commands.append(command)
+        if command.startswith('cat '):
+            return remote('v2\nv1\nv3')
+        if command.startswith('md5sum '):
+            return remote('v1')
+        return remote('')
+
+    with settings(standalone=False, datanav_versions=2, datanav_hardlinks=False), \
+            mock.patch.object(tyr, 'get_tyr_config', return_value=config), \
+            mock.patch.object(tyr, 'exists', return_value=True), \
+            mock.patch.object(tyr, 'run', side_effect=run):
+        tyr.backup_datanav('fr')
+    script = commands[-1]
+    # v1 is stored again by the current data.nav.lz4 and becomes the most recent version
+    assert "printf 'v1\\nv2\\n' > /srv/ed/data/fr/versions/index" in script
+    assert 'rm -f /srv/ed/data/fr/versions/v3.lz4' in script
+    assert 'cp --reflink=auto /srv/ed/data/fr/data.nav.lz4 /srv/ed/data/fr/versions/v1.lz4.tmp' in script
+
+
+def rollback(index, existing):
+    config = mock.Mock()
+    config.get.return_value = '/srv/ed/data/fr/data.nav.lz4'
+    commands = []
+
+    def run(command):
+        commands.append(command)
+        if command.startswith('cat '):
+            return remote(index, succeeded=index is not None)
+        return remote('')
+
+    with settings(standalone=False, datanav_hardlinks=False), \
+            mock.patch.object(tyr, 'get_tyr_config', return_value=config), \
+            mock.patch.object(tyr, 'exists', side_effect=lambda path: path in existing), \
+            mock.patch.object(tyr, 'run', side_effect=run):
+        tyr.rollback_datanav('fr')
+    return commands[1:]
+
+
+def test_rollback_datanav():
+    assert rollback('v2\nv1', ['/srv/ed/data/fr/versions/v2.lz4']) == [
+        'cp --reflink=auto /srv/ed/data/fr/versions/v2.lz4 /srv/ed/data/fr/data.nav.lz4.tmp && '
+        'mv -f /srv/ed/data/fr/data.nav.lz4.tmp /srv/ed/data/fr/data.nav.lz4']
+    # no version stored yet: the backup of the former backup_datanav()
+    assert rollback(None, ['/srv/ed/data/fr/data.nav.lz4_fr']) == [
+        'cp --reflink=auto /srv/ed/data/fr/data.nav.lz4_fr /srv/ed/data/fr/data.nav.lz4.tmp && '
+        'mv -f /srv/ed/data/fr/data.nav.lz4.tmp /srv/ed/data/fr/data.nav.lz4']
+    assert rollback(None, []) == []
@@ -0,0 +1,79 @@
+# encoding: utf-8
+
+import mock
+import pytest
+
+from fabric.api import settings
+
+from fabfile import tasks
+from fabfile.utils import FileStat, check_free_space
+
+GB = 2 ** 30
+
+
+def test_check_free_space():
+    required = {('root@tyr', '/srv'): 10 * GB, ('root@eng1', '/'): 4 * GB}
+    available = {('root@tyr', '/srv'): 20 * GB, ('root@eng1', '/'): 4 * GB}
+    assert check_free_space(required, available, 0.1) == [
+        ('root@eng1', '/', 4 * GB, 4 * GB, False),
+        ('root@tyr', '/srv', 10 * GB, 20 * GB, True),
+    ]
+
+
+def instance(name, engines):
+    i = mock.Mock(kraken_engines=engines, kraken_database='/local/{}/data.nav.lz4'.format(name))
+    i.name = name
+    return i
+
+
+def test_check_disk_space():
+    instances = {'fr': instance('fr', ['root@eng1']), 'be': instance('be', ['root@eng1', 'root@eng2'])}
+    tyr_stats = {'/srv/fr/data.nav.lz4': FileStat(3 * GB, 0), '/srv/fr/temp/data.nav.lz4': FileStat(1 * GB, 0),
+                 '/srv/be/data.nav.lz4': FileStat(2 * GB, 0), '/srv/be/temp/data.nav.lz4': None}
+    sweep = [
+        ('root@tyr', tyr_stats, {'/srv': ('/srv', 9 * GB)}),
+        # fr is not on eng1 yet, be has an old copy of 1 GB
+        ('root@eng1', {'/local/fr/data.nav.lz4': None, '/local/be/data.nav.lz4': FileStat(1 * GB, 0)},
+         {'/local': ('/', 6 * GB)}),
+        ('root@eng2', {'/local/be/data.nav.lz4': FileStat(2 * GB, 0)}, {'/local': ('/', 5 * GB)}),
+    ]
+    pool = mock.Mock()
+    pool.map.return_value = sweep
+    with settings(instances=instances, roledefs={'tyr_master': ['root@tyr'], 'eng': ['root@eng1', 'root@eng2']},
+                  tyr_base_destination_dir='/srv', kraken_local_data_dir='/local', disk_space_margin=0.1,
+                  datanav_hardlinks=False), \
+            mock.patch.object(tasks.kraken, '_data_nav_targets',
+                              side_effect=lambda i: ('/srv/{}/data.nav.lz4'.format(i.name),
+                                                     '/srv/{}/temp/data.nav.lz4'.format(i.name))), \
+            mock.patch.object(tasks.multiprocessing, 'Pool', return_value=pool):
+        assert tasks.check_disk_space() == [
+            # 3 GB for fr, 1 GB more for be, and the old copy of be kept until the new one is complete
+            ('root@eng1', '/', 5 * GB, 6 * GB, True),
+            ('root@eng2', '/', 2 * GB, 5 * GB, True),
+            # 2 GB more for the temp data.nav.lz4 of fr, 2 GB for be
+            ('root@tyr', '/srv', 4 * GB, 9 * GB, True),
+        ]
+        # the backups need 5 GB more
+        with pytest.raises(SystemExit):
+            tasks.check_disk_space(backup=True)
+
+
+def test_check_disk_space_tyr_master_is_an_engine():
+    instances = {'fr': instance('fr', ['root@eng1'])}
+    sweep = [
+        ('root@eng1', {'/srv/fr/data.nav.lz4': FileStat(3 * GB, 0), '/srv/fr/temp/data.nav.lz4': None},
+         {'/srv': ('/', 20 * GB)}),
+        ('root@eng1', {'/local/fr/data.nav.lz4': FileStat(1 * GB, 0)}, {'/local': ('/', 20 * GB)}),
+    ]
+    pool = mock.Mock()
+    pool.map.return_value = sweep
+    with settings(instances=instances, roledefs={'tyr_master': ['root@eng1'], 'eng': ['root@eng1']},
+                  tyr_base_destination_dir='/srv', kraken_local_data_dir='/local', disk_space_margin=0.1,
+                  datanav_hardlinks=False), \
+            mock.patch.object(tasks.kraken, '_data_nav_targets',
+                              side_effect=lambda i: ('/srv/{}/data.nav.lz4'.format(i.name),
+                                                     '/srv/{}/temp/data.nav.lz4'.format(i.name))), \
+            mock.patch.object(tasks.multiprocessing, 'Pool', return_value=pool):
+        # the binarization and the local copy share the same mount
+        assert tasks.check_disk_space() == [('root@eng1', '/', 6 * GB, 20 * GB, True)]
+    assert [job[0] for job in pool.map.call_args[0][1]] == ['root@eng1', 'root@eng1']
@@ -0,0 +1,87 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import settings
+
+from fabfile.component import tyr
+
+
+def binarize(i_name):
+    return None if i_name == 'broken' else 1.5
+
+
+def test_distributed_binarization():
+    with settings(roledefs={'tyr': ['root@tyr1', 'root@tyr2']}), \
+            mock.patch.object(tyr, 'execute', return_value={'root@tyr1': 2, 'root@tyr2': 1}), \
+            mock.patch.object(tyr, '_binarize', side_effect=binarize), \
+            mock.patch.object(tyr, '_bina_done') as bina_done:
+        done = tyr.distributed_binarization(['a', 'broken', 'b', 'c'])
+    assert sorted(done) == ['a', 'b', 'c']
+    assert sorted(c[0][0] for c in bina_done.call_args_list) == ['a', 'b', 'c']
+
+
+def test_threaded_binarization_retries_failed_instances():
+    attempts = []
+
+    def flaky_binarize(i_name):
+        attempts.append(i_name)
+        return None if i_name == 'broken' or attempts.count(i_name) == 1 and i_name == 'flaky' else 2
+
+    with settings(host_string='root@tyr', instances={}, bina_retry_delay=0, acceptable_bina_fail_rate=1), \
+            mock.patch.object(tyr, '_binarize', side_effect=flaky_binarize), \
+            mock.patch.object(tyr, '_bina_done'):
+        done = tyr.threaded_binarization(['a', 'flaky', 'broken', 'b'], 2, max_attempts=3)
+    assert sorted(done) == ['a', 'b', 'flaky']
+    assert attempts.count('flaky') == 2
+    assert attempts.count('broken') == 3
+    assert attempts.count('a') == 1
+
+
+def test_bina_recorded_before_on_done():
+    # with upgrade_all:pipeline, on_done swaps the data.nav.lz4 out of temp/, where the
+    # fingerprint and the history of the binarization are read
+    calls = mock.Mock()
+
+    def binarization(instances, nb_thread, on_done, *args):
+        on_done('a', 12.)
+        on_done('b', 0)
+        return {'a': 12., 'b': 0}
+
+    with settings(bina_distributed=False, bina_adaptive=False, nb_thread_for_bina=1), \
+            mock.patch.object(tyr, 'get_bina_fingerprints', return_value={'a': {}, 'b': {}}), \
+            mock.patch.object(tyr, '_data_nav_sizes', return_value={'a': 10, 'b': 10}), \
+            mock.patch.object(tyr, 'expected_bina_durations', return_value={'a': 1, 'b': 1}), \
+            mock.patch.object(tyr, 'threaded_binarization', side_effect=binarization), \
+            mock.patch.object(tyr, 'save_bina_fingerprints', calls.save_bina_fingerprints), \
+            mock.patch.object(tyr, 'save_bina_history', calls.save_bina_history):
+        failed = tyr.launch_rebinarization_upgrade(pilot_supervision=False, pilot_tyr_beat=False,
+                                                   instances=('a', 'b'), force=True, on_done=calls.on_done)
+    assert failed == ()
+    assert calls.mock_calls == [
+        mock.call.save_bina_fingerprints({'a': {}, 'b': {}}, ['a']),
+        mock.call.save_bina_history({'a': {}, 'b': {}}, {'a': 12.}),
+        mock.call.on_done('a'),
+    ]
+
+
+def test_failed_binarization_is_launched_again():
+    results = [Exception('import failed'), '']
+
+    def run(command):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    with settings(host_string='root@tyr', instances={}, excluded_instances=[], bina_retry_delay=0,
+                  acceptable_bina_fail_rate=1, tyr_settings_file='/srv/tyr/settings.py', tyr_basedir='/srv/tyr',
+                  KRAKEN_USER='www-data'), \
+            mock.patch.object(tyr, 'update_ed_db'), \
+            mock.patch.object(tyr, 'run', side_effect=run) as remote, \
+            mock.patch.object(tyr, '_bina_done'):
+        done = tyr.threaded_binarization(['a'], 1, max_attempts=2)
+    assert remote.call_count == 2
+    # run on the tyr host itself, not by the celery workers
+    assert remote.call_args[0][0] == 'cd /srv/tyr && python manage.py import_last_dataset a --custom_output_dir temp'
+    assert list(done) == ['a']
@@ -0,0 +1,68 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import settings
+
+from fabfile.component import kraken
+from fabfile.utils import plan_fanout
+
+
+def test_plan_fanout():
+    assert plan_fanout([None], []) == []
+    assert plan_fanout([None], ['e1', 'e2', 'e3', 'e4', 'e5', 'e6']) == [
+        [(None, 'e1')],
+        [(None, 'e2'), ('e1', 'e3')],
+        [(None, 'e4'), ('e1', 'e5'), ('e2', 'e6')],
+    ]
+    # 100 engines in 7 rounds, each host sending at most once per round
+    rounds = plan_fanout(['e0'], ['e{}'.format(i) for i in range(1, 101)])
+    assert len(rounds) == 7
+    for links in rounds:
+        assert len(set(source for source, _ in links)) == len(links)
+    assert sorted(d for links in rounds for _, d in links) == sorted('e{}'.format(i) for i in range(1, 101))
+    assert plan_fanout([], ['e1']) == []
+
+
+
+class Pool(object):
+    """ multiprocessing.Pool running the jobs in the test process """
+    def __init__(self, *args):
+        pass
+
+    def imap_unordered(self, func, jobs):
+        return [func(job) for job in jobs]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def fanout_link(link):
+    _, source, destination = link
+    # e3 can't be reached from e1, nothing can be copied to e4
+    return link, destination != 'root@e4' and (source, destination) != ('root@e1', 'root@e3'), 1.
+
+
+def test_distribute_kraken_data():
+    fr = mock.Mock(kraken_engines=['root@e1', 'root@e2', 'root@e3', 'root@e4', 'root@old'])
+    fr.name = 'fr'
+    be = mock.Mock(kraken_engines=['root@e1'])
+    be.name = 'be'
+    with settings(instances={'fr': fr, 'be': be}, roledefs={'eng': ['root@e1', 'root@e2', 'root@e3', 'root@e4']}), \
+            mock.patch.object(kraken.multiprocessing, 'Pool', Pool), \
+            mock.patch.object(kraken, '_fanout_link', side_effect=fanout_link) as link:
+        assert kraken.distribute_kraken_data(2) == {'fr': ['root@e4']}
+    links = [c[0][0] for c in link.call_args_list]
+    assert ('be', None, 'root@e1') in links
+    assert [l for l in links if l[0] == 'fr'] == [
+        # the first engine copies the shared data, then each engine having a copy sends it to another one
+        ('fr', None, 'root@e1'),
+        ('fr', None, 'root@e2'),
+        ('fr', 'root@e1', 'root@e3'),
+        # the failed copy from e1 is done again from the shared data, e3 is not a source until then
+        ('fr', None, 'root@e3'),
+        ('fr', None, 'root@e4'),
+    ]
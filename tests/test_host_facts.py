@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+import multiprocessing
+
+import mock
+
+from fabric.api import env, settings
+
+from fabfile import utils
+from fabfile.utils import host_fact, invalidate_host_facts
+
+calls = []
+
+
+@host_fact
+def dummy_fact():
+    calls.append(env.host_string)
+    return len(calls)
+
+
+def test_host_facts():
+    with settings(host_string='h1'):
+        assert dummy_fact() == 1
+        assert dummy_fact() == 1
+    with settings(host_string='h2'):
+        assert dummy_fact() == 2
+    assert calls == ['h1', 'h2']
+    invalidate_host_facts(['dummy_fact'], 'h1')
+    with settings(host_string='h2'):
+        assert dummy_fact() == 2
+    with settings(host_string='h1'):
+        assert dummy_fact() == 3
+    invalidate_host_facts()
+    with settings(host_string='h2'):
+        assert dummy_fact() == 4
+
+
+def test_host_facts_of_a_host_named_differently():
+    del calls[:]
+    with settings(user='root'), mock.patch.dict(utils._local_names, dict.fromkeys(utils._local_names)), \
+            mock.patch.object(utils.socket, 'getfqdn', return_value='Tyr.example.com'):
+        with settings(host_string='root@tyr.example.com'):
+            assert dummy_fact() == 1
+        for host_string in ('localhost', 'root@localhost:22', 'TYR.example.com', '127.0.0.1'):
+            with settings(host_string=host_string):
+                assert dummy_fact() == 1
+        invalidate_host_facts(['dummy_fact'], 'localhost')
+        with settings(host_string='tyr.example.com:22'):
+            assert dummy_fact() == 2
+    assert utils.normalize_host('eng1') == 'root@eng1:22'
+
+
+def upgrade(_):
+    with settings(host_string='root@h3'):
+        invalidate_host_facts(['dummy_fact'], 'root@h3')
+
+
+def test_host_facts_invalidated_in_a_forked_process():
+    del calls[:]
+    with settings(host_string='root@h3'):
+        assert dummy_fact() == 1
+    pool = multiprocessing.Pool(1)
+    try:
+        pool.map(upgrade, [0])
+    finally:
+        pool.close()
+        pool.join()
+    with settings(host_string='root@h3'):
+        assert dummy_fact() == 2
@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import env, settings
+
+from fabfile import tasks
+from fabfile.component import kraken
+
+
+class Instance(object):
+    def __init__(self, name):
+        self.name = name
+        self.kraken_engines = ['root@eng1']
+
+
+def test_kraken_reloader_sees_instances_excluded_after_fork():
+    instances = {n: Instance(n) for n in ('a', 'b')}
+    with settings(instances=instances, excluded_instances=[], roledefs={'eng': ['root@eng1']}), \
+            mock.patch.object(kraken, 'set_kraken_binary'), \
+            mock.patch.object(kraken, 'restart_kraken'), \
+            mock.patch.object(kraken.kraken_status, 'cached', return_value=None):
+        reloader = kraken.KrakenReloader(2)
+        # the instances without data are only known once the pool is forked
+        env.excluded_instances = ['a']
+        reloader.submit('a')
+        reloader.submit('b')
+        reloader.submit('a')
+        failed = reloader.join()
+    assert failed == ['b']
+    assert reloader.results['b'].get() == ('b', False, 'not loaded on eng1')
+
+
+def test_kraken_reloader_without_wait():
+    with settings(instances={'a': Instance('a')}, excluded_instances=[]), \
+            mock.patch.object(kraken, 'set_kraken_binary'), \
+            mock.patch.object(kraken, 'restart_kraken', side_effect=[SystemExit(1)]):
+        reloader = kraken.KrakenReloader(1, wait=None)
+        reloader.submit('a')
+        failed = reloader.join()
+    assert failed == ['a']
+    assert reloader.results['a'].get() == ('a', False, 'SystemExit(1,)')
+
+
+def test_pipeline_swaps_data_before_reloading():
+    reloader = mock.Mock()
+    with mock.patch.object(kraken, 'swap_data_nav') as swap_data_nav:
+        swap_data_nav.attach_mock(reloader.submit, 'submit')
+        tasks._pipeline_bina_done(reloader, 'a')
+    assert swap_data_nav.mock_calls == [mock.call('a'), mock.call.submit('a')]
+
+
+def test_reload_kraken_serial_restart_longer_than_the_status_max_age():
+    instance = Instance('a')
+    instance.kraken_engines = ['root@eng1', 'root@eng2']
+    loaded = {'status': 'running', 'loaded': True}
+
+    def restart_kraken(instance, wait):
+        # eng2 loads its data long after eng1
+        for host, date in (('root@eng1', 0), ('root@eng2', 600)):
+            kraken.time.time.return_value = date
+            kraken.kraken_status.store(host, 'a', loaded)
+
+    with settings(instances={'a': instance}, roledefs={'eng': ['root@eng1', 'root@eng2']}, kraken_status_max_age=30), \
+            mock.patch.object(kraken, 'set_kraken_binary'), \
+            mock.patch.object(kraken.time, 'time'), \
+            mock.patch.object(kraken, 'restart_kraken', side_effect=restart_kraken):
+        assert kraken._reload_kraken('a', 'serial', []) == ('a', True, None)
+    kraken.kraken_status.invalidate(instance='a')
@@ -0,0 +1,130 @@
+# encoding: utf-8
+
+import multiprocessing
+
+import mock
+import pytest
+
+from fabric.api import env, settings
+
+from fabfile.component import kraken
+
+
+def test_kraken_status_collector():
+    instance = mock.Mock(kraken_engines=['root@eng1', 'root@eng2'])
+    instance.name = 'fr-idf'
+    collector = kraken.KrakenStatusCollector()
+    status = {'status': 'running', 'loaded': True}
+    with settings(kraken_status_max_age=30, kraken_status_nb_thread=4, instances={'fr-idf': instance},
+                  kraken_monitor_port=85, kraken_monitor_location_dir='monitor-kraken'), \
+            mock.patch.object(kraken, '_test_kraken', return_value=status) as poll:
+        collector.collect()
+        assert poll.call_count == 2
+        assert collector.get('root@eng1', 'fr-idf') == status
+        assert collector.get('eng2', 'fr-idf') == status
+        assert poll.call_count == 2
+        collector.invalidate('root@eng1', 'fr-idf')
+        collector.collect()
+        assert poll.call_count == 3
+        assert poll.call_args[0][0] == 'http://eng1:85/monitor-kraken/?instance=fr-idf'
+        assert collector.get('eng1', 'fr-idf', max_age=0) == status
+        assert poll.call_count == 4
+
+
+def test_wait_kraken_loaded(tmpdir):
+    instance = mock.Mock(kraken_engines=['root@eng1'], kraken_basedir='/srv/kraken/fr-idf')
+    instance.name = 'fr-idf'
+    not_loaded = {'status': 'running', 'loaded': False}
+    loaded = {'status': 'running', 'loaded': True}
+    with settings(KRAKEN_RESTART_DELAY=90, kraken_load_margin=3, kraken_poll_max_interval=10,
+                  fabric_state_dir=str(tmpdir), name='test',
+                  kraken_monitor_port=85, kraken_monitor_location_dir='monitor-kraken'), \
+            mock.patch.object(kraken, '_expected_load_time', return_value=None), \
+            mock.patch.object(kraken.time, 'sleep'), \
+            mock.patch.object(kraken, '_is_kraken_running', return_value=True) as running, \
+            mock.patch.object(kraken, '_test_kraken', side_effect=[None, not_loaded, loaded]) as poll:
+        assert kraken.wait_kraken_loaded(instance, 'eng1') == loaded
+        assert poll.call_count == 3
+        assert kraken.kraken_load_history.get('fr-idf') is not None
+
+        # the kraken died while loading its data, no need to wait more
+        running.return_value = False
+        poll.side_effect = [not_loaded, loaded]
+        assert kraken.wait_kraken_loaded(instance, 'eng1') == {'status': 'dead'}
+        running.assert_called_with(instance, 'root@eng1')
+
+
+def test_wait_kraken_loaded_retries_failed_polls(tmpdir):
+    instance = mock.Mock(kraken_engines=['root@eng1'], kraken_basedir='/srv/kraken/fr-idf')
+    instance.name = 'fr-idf'
+    loaded = {'status': 'running', 'loaded': True}
+    with settings(KRAKEN_RESTART_DELAY=90, kraken_load_margin=3, kraken_poll_max_interval=10,
+                  fabric_state_dir=str(tmpdir), name='test',
+                  kraken_monitor_port=85, kraken_monitor_location_dir='monitor-kraken'), \
+            mock.patch.object(kraken, '_expected_load_time', return_value=None), \
+            mock.patch.object(kraken.time, 'sleep'), \
+            mock.patch.object(kraken, '_is_kraken_running', return_value=True), \
+            mock.patch.object(kraken, '_test_kraken', side_effect=[SystemExit(1), ValueError('not json'), loaded]) as poll:
+        assert kraken.wait_kraken_loaded(instance, 'eng1') == loaded
+        assert poll.call_count == 3
+
+        # the polls keep failing until the deadline
+        poll.side_effect = SystemExit(1)
+        with mock.patch.object(kraken.time, 'time', side_effect=[0, 0, 50, 300, 300]):
+            assert kraken.wait_kraken_loaded(instance, 'eng1') == {'status': False}
+
+
+def test_kraken_status_collector_caches_failures():
+    instance = mock.Mock(kraken_engines=['root@eng1'])
+    instance.name = 'fr-idf'
+    collector = kraken.KrakenStatusCollector()
+    with settings(kraken_status_max_age=30, kraken_status_failure_max_age=10, kraken_status_nb_thread=4,
+                  instances={'fr-idf': instance}, kraken_monitor_port=85, kraken_monitor_location_dir='monitor-kraken'), \
+            mock.patch.object(kraken.time, 'time', return_value=100), \
+            mock.patch.object(kraken, '_test_kraken', side_effect=SystemExit(1)) as poll:
+        collector.collect()
+        collector.collect()
+        assert collector.get('eng1', 'fr-idf', fail_if_error=False) is None
+        assert poll.call_count == 1
+        # polled again to fail
+        with pytest.raises(SystemExit):
+            collector.get('eng1', 'fr-idf')
+        kraken.time.time.return_value = 111
+        collector.collect()
+        assert poll.call_count == 3
+
+
+def session_id(_):
+    return id(kraken.kraken_status.session)
+
+
+def test_kraken_status_collector_session_in_forked_processes():
+    parent = id(kraken.kraken_status.session)
+    pool = multiprocessing.Pool(1)
+    try:
+        assert pool.map(session_id, [0]) != [parent]
+    finally:
+        pool.close()
+        pool.join()
+    assert id(kraken.kraken_status.session) == parent
+
+
+def test_check_dead_instances_stops_when_a_kraken_cant_be_polled():
+    instance = mock.Mock(kraken_engines=['root@eng1', 'root@eng2'], kraken_engines_url=['eng1', 'eng2'])
+    instance.name = 'fr-idf'
+    status = {'status': 'running', 'loaded': True}
+    with settings(kraken_status_max_age=30, kraken_status_failure_max_age=10, kraken_status_nb_thread=4,
+                  kraken_threshold=1, instances={'fr-idf': instance},
+                  kraken_monitor_port=85, kraken_monitor_location_dir='monitor-kraken'), \
+            mock.patch.object(kraken, 'kraken_status', kraken.KrakenStatusCollector()), \
+            mock.patch.object(kraken, 'show_version', return_value=('1.0', '1.0')), \
+            mock.patch.object(kraken, '_test_kraken', side_effect=[status, ValueError('not json')]):
+        # the threshold allows one dead kraken, but an error is not a dead kraken
+        with pytest.raises(SystemExit):
+            kraken.check_dead_instances()
+
+        # a timeout is a dead kraken
+        kraken.kraken_status.invalidate()
+        kraken._test_kraken.side_effect = [status, None]
+        kraken.check_dead_instances()
+        assert not kraken.kraken_status.errors
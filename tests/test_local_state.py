@@ -0,0 +1,38 @@
+# encoding: utf-8
+
+import multiprocessing
+import os
+
+from fabric.api import settings
+
+from fabfile.utils import LocalState
+
+
+def set_values(args):
+    state_dir, worker = args
+    with settings(fabric_state_dir=state_dir, name='test'):
+        state = LocalState('state')
+        for i in range(20):
+            state.set('{}_{}'.format(worker, i), i)
+
+
+def test_local_state_set_from_forked_processes(tmpdir):
+    state_dir = str(tmpdir.join('state'))
+    pool = multiprocessing.Pool(4)
+    pool.map(set_values, [(state_dir, w) for w in range(4)])
+    pool.close()
+    pool.join()
+    with settings(fabric_state_dir=state_dir, name='test'):
+        data = LocalState('state').load()
+    assert len(data) == 80
+    assert sorted(os.listdir(state_dir)) == ['state_test.json', 'state_test.json.lock']
+
+
+def test_local_state_tolerates_a_corrupt_file(tmpdir):
+    with settings(fabric_state_dir=str(tmpdir), name='test'):
+        state = LocalState('state')
+        assert state.get('a') is None
+        tmpdir.join('state_test.json').write('{"a": ')
+        assert state.get('a', 3) == 3
+        state.set('a', 1)
+        assert state.get('a') == 1
@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import env, task, roles, settings
+from fabric.tasks import requires_parallel
+
+from fabfile import utils
+from fabfile.utils import parallel_on_role
+
+
+@task
+@parallel_on_role('eng')
+@roles('eng')
+def dummy_task():
+    """ dummy doc """
+    return 'done'
+
+
+def test_parallel_on_role():
+    hosts = ['h1', 'h2', 'h3', 'h4', 'h5']
+    old = env.role_parallelism
+    try:
+        env.role_parallelism = {}
+        assert not requires_parallel(dummy_task)
+        env.role_parallelism = {'ws': 4}
+        assert not requires_parallel(dummy_task)
+        env.role_parallelism = {'eng': 3}
+        assert requires_parallel(dummy_task)
+        assert dummy_task.get_pool_size(hosts, None) == 3
+        assert dummy_task.get_pool_size(hosts[:2], None) == 2
+    finally:
+        env.role_parallelism = old
+    assert dummy_task.roles == ['eng']
+    assert dummy_task.__doc__ == ' dummy doc '
+    assert dummy_task() == 'done'
+
+
+@task
+@parallel_on_role('eng')
+@roles('eng')
+def printing_task():
+    print('on the host')
+
+
+def test_parallel_on_role_output(capsys):
+    with settings(parallel=True, host_string='root@h1', abort_on_prompts=True):
+        printing_task()
+    out = capsys.readouterr()[0]
+    # in a single block, after the name of the host
+    assert out.index('printing_task on root@h1') < out.index('on the host')
+
+    # fabric may ask for a password, the output is not captured
+    with settings(parallel=True, host_string='root@h1', abort_on_prompts=False, password=None, passwords={}):
+        with mock.patch.object(utils.StringIO, 'StringIO') as captured:
+            printing_task()
+    assert not captured.called
+    assert 'printing_task on root@h1' not in capsys.readouterr()[0]
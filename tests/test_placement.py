@@ -0,0 +1,45 @@
+# encoding: utf-8
+
+import mock
+
+from fabric.api import settings
+
+from fabfile.component import kraken
+from fabfile.component.kraken import plan_placement
+
+GB = 2 ** 30
+
+
+def test_plan_placement_balance():
+    costs = {'big': (8 * GB, 1), 'medium': (4 * GB, 1), 'small1': (2 * GB, 1), 'small2': (2 * GB, 1)}
+    capacities = {'eng1': (16 * GB, 8), 'eng2': (16 * GB, 8)}
+    plan, loads = plan_placement(costs, capacities, dict.fromkeys(costs, 1))
+    assert plan['big'] != plan['medium']
+    assert loads == {'eng1': 0.5, 'eng2': 0.5}
+
+
+def test_plan_placement_replicas_and_current():
+    costs = {'a': (4 * GB, 1), 'b': (2 * GB, 1)}
+    capacities = {'eng1': (16 * GB, 8), 'eng2': (16 * GB, 8), 'eng3': (16 * GB, 8)}
+    plan, _ = plan_placement(costs, capacities, {'a': 2, 'b': 3})
+    assert len(plan['a']) == 2
+    assert plan['b'] == ['eng1', 'eng2', 'eng3']
+
+    # an instance stays on its host while it is not much more loaded than the others
+    current = {'a': ['eng3'], 'b': ['eng3']}
+    plan, _ = plan_placement(costs, capacities, {'a': 1, 'b': 1}, current, tolerance=0.3)
+    assert plan == {'a': ['eng3'], 'b': ['eng3']}
+    plan, _ = plan_placement(costs, capacities, {'a': 1, 'b': 1}, current, tolerance=0)
+    assert plan['a'] == ['eng3'] and plan['b'] != ['eng3']
+
+
+def test_plan_kraken_placement_with_engines_named_differently():
+    instance = mock.Mock(kraken_engines=['eng2', 'root@eng3:22'], kraken_database='/srv/fr/data.nav.lz4',
+                         kraken_nb_threads=1)
+    instance.name = 'fr'
+    resources = {'root@eng1': (16 * GB, 8, {}), 'root@eng2': (16 * GB, 8, {'fr': GB}),
+                 'root@eng3': (16 * GB, 8, {'fr': GB})}
+    with settings(user='root', instances={'fr': instance}), \
+            mock.patch.object(kraken, 'execute', return_value=resources):
+        # fr stays on its engines
+        assert kraken.plan_kraken_placement() == {'fr': ['root@eng2', 'root@eng3']}
@@ -0,0 +1,85 @@
+# encoding: utf-8
+
+import time
+
+import mock
+
+from fabric.api import env, settings
+
+from fabfile.component import kraken
+from fabfile.utils import FileStat
+
+GB = 2 ** 30
+
+
+def test_restart_krakens_on_host_changes_env_one_thread_at_a_time():
+    instances = {}
+    for name in ('a', 'b', 'c', 'd'):
+        instances[name] = mock.Mock(kraken_engines=['eng1'], kraken_database='/srv/{}/data.nav.lz4'.format(name))
+        instances[name].name = name
+    running, overlaps, loading = [], [], []
+
+    def restart_kraken_on_host(instance, host, stage):
+        assert not stage
+        running.append(instance.name)
+        overlaps.append(len(running))
+        with settings(warn_only=True, host_string=host):
+            time.sleep(0.01)
+        running.remove(instance.name)
+        return True
+
+    def wait_kraken_loaded(instance, host, fail_if_error):
+        loading.append(instance.name)
+        time.sleep(0.05)
+        overlaps.append(-len(loading))
+        return {'loaded': True}
+
+    with settings(user='root', host_string='root@eng1', instances=instances, excluded_instances=[], warn_only=False,
+                  kraken_memory_ratio=1, kraken_memory_factor=1, kraken_restart_nb_thread=4,
+                  kraken_local_data_dir=None, data_nav_manifests=False), \
+            mock.patch.object(kraken, 'stat_files', return_value=dict.fromkeys(
+                [i.kraken_database for i in instances.values()], FileStat(GB, 0))), \
+            mock.patch.object(kraken, 'get_mem_available', return_value=8 * GB), \
+            mock.patch.object(kraken, '_krakens_rss', return_value={}), \
+            mock.patch.object(kraken, 'restart_kraken_on_host', side_effect=restart_kraken_on_host), \
+            mock.patch.object(kraken, 'wait_kraken_loaded', side_effect=wait_kraken_loaded):
+        assert kraken.restart_krakens_on_host() == dict.fromkeys('abcd', True)
+        assert env.warn_only is False
+        assert env.host_string == 'root@eng1'
+    assert max(overlaps) == 1
+    # the krakens load their data at the same time
+    assert min(overlaps) < -1
+
+
+def test_restart_krakens_on_host_prepares_the_data_first():
+    instances = {}
+    for name in ('a', 'b'):
+        instances[name] = mock.Mock(kraken_engines=['root@eng1'], kraken_database='/local/{}/data.nav.lz4'.format(name))
+        instances[name].name = name
+    calls = mock.Mock()
+    calls.restart_kraken_on_host.return_value = True
+    calls.wait_kraken_loaded.return_value = {'loaded': True}
+    with settings(host_string='root@eng1', instances=instances, excluded_instances=[],
+                  kraken_memory_ratio=1, kraken_memory_factor=1, kraken_restart_nb_thread=2,
+                  kraken_local_data_dir='/local', data_nav_manifests=True), \
+            mock.patch.object(kraken, 'stat_files', return_value=dict.fromkeys(
+                [i.kraken_database for i in instances.values()], FileStat(3 * GB, 0))), \
+            mock.patch.object(kraken, 'get_mem_available', return_value=2 * GB), \
+            mock.patch.object(kraken, '_krakens_rss', return_value={'a': 2 * GB, 'b': 2 * GB, 'other': 4 * GB}), \
+            mock.patch.object(kraken, '_stage_data', calls._stage_data), \
+            mock.patch.object(kraken, '_run_on_files', calls._run_on_files), \
+            mock.patch.object(kraken, 'restart_kraken_on_host', calls.restart_kraken_on_host), \
+            mock.patch.object(kraken, 'wait_kraken_loaded', calls.wait_kraken_loaded), \
+            mock.patch.object(kraken, 'BudgetPool', wraps=kraken.BudgetPool) as pool:
+        calls._run_on_files.return_value = {'/local/a/data.nav.lz4': 'ok'}
+        assert kraken.restart_krakens_on_host() == {'a': True, 'b': True}
+    # 2 GB available, and 4 GB freed by the krakens of a and b
+    assert pool.call_args[0][0] == 6 * GB
+    names = [c[0] for c in calls.mock_calls]
+    assert names[:2] == ['_stage_data', '_run_on_files']
+    assert sorted(i.name for i in calls._stage_data.call_args[0][0]) == ['a', 'b']
+    assert names.count('_stage_data') == 1 and names.count('_run_on_files') == 1
+    assert all(c[2] == {'stage': False} for c in calls.restart_kraken_on_host.mock_calls)
+    # the checks are used by restart_kraken_on_host()
+    assert kraken._data_nav_checks.pop(('root@eng1', 'a')) == 'ok'
+    assert kraken._data_nav_checks.pop(('root@eng1', 'b')) == 'unknown'
@@ -0,0 +1,66 @@
+# encoding: utf-8
+
+import mock
+import pytest
+
+from fabric.api import settings
+
+from fabfile.component import kraken
+from fabfile.utils import FileStat
+
+
+def instance(name):
+    i = mock.Mock(target_lz4_file='/srv/ed/data/{}/data.nav.lz4'.format(name))
+    i.name = name
+    return i
+
+
+def test_swap_data_navs_single_script():
+    instances = {'a': instance('a'), 'b': instance('b')}
+    with mock.patch.object(kraken, 'get_real_instance', side_effect=lambda i: instances.get(i, i)), \
+            mock.patch.object(kraken, 'run', return_value='a swapped\r\nb no data\r\n') as run:
+        assert kraken.swap_data_navs(['a', 'b']) == {'a': 'swapped', 'b': 'no data'}
+    assert run.call_count == 1
+    assert run.call_args[1] == {'combine_stderr': False}
+    script = run.call_args[0][0]
+    assert '[ /srv/ed/data/a/temp/data.nav.lz4 -nt /srv/ed/data/a/data.nav.lz4 ]' in script
+    assert 'mv /srv/ed/data/b/temp/data.nav.lz4 /srv/ed/data/b/data.nav.lz4' in script
+    assert "echo 'b moved'" in script
+
+    with mock.patch.object(kraken, 'get_real_instance', side_effect=lambda i: instances.get(i, i)), \
+            mock.patch.object(kraken, 'run', return_value='a swapped') as run:
+        assert kraken.swap_data_navs(['a'], force=True) == {'a': 'swapped'}
+    assert '-nt' not in run.call_args[0][0]
+
+
+def test_swap_data_navs_aborts_on_failure():
+    instances = {'a': instance('a'), 'b': instance('b')}
+    with settings(data_nav_manifests=False), \
+            mock.patch.object(kraken, 'get_real_instance', side_effect=lambda i: instances.get(i, i)), \
+            mock.patch.object(kraken, 'run', return_value='a swapped\r\nb failed\r\n'):
+        with pytest.raises(SystemExit):
+            kraken.swap_data_navs(['a', 'b'])
+    # no result at all for b
+    with settings(data_nav_manifests=False), \
+            mock.patch.object(kraken, 'get_real_instance', side_effect=lambda i: instances.get(i, i)), \
+            mock.patch.object(kraken, 'run', return_value='a swapped\r\n'):
+        with pytest.raises(SystemExit):
+            kraken.swap_data_navs(['a', 'b'])
+
+
+def test_purge_data_nav():
+    instances = {'a': instance('a'), 'b': instance('b')}
+    stats = {'/srv/ed/data/a/data.nav.lz4': FileStat(10, 200), '/srv/ed/data/a/temp/data.nav.lz4': FileStat(2 ** 30, 100),
+             '/srv/ed/data/b/data.nav.lz4': FileStat(10, 200), '/srv/ed/data/b/temp/data.nav.lz4': None}
+    with settings(instances=instances), \
+            mock.patch.object(kraken, 'stat_files', side_effect=lambda paths: {p: stats[p] for p in paths}), \
+            mock.patch.object(kraken, 'run') as run:
+        kraken.purge_data_nav()
+        run.assert_called_once_with('rm -f /srv/ed/data/a/temp/data.nav.lz4')
+
+        # a temp file more recent than the data.nav.lz4 has not been swapped yet
+        stats['/srv/ed/data/b/temp/data.nav.lz4'] = FileStat(10, 300)
+        run.reset_mock()
+        with pytest.raises(SystemExit):
+            kraken.purge_data_nav()
+        assert not run.called
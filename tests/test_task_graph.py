@@ -0,0 +1,152 @@
+# encoding: utf-8
+
+import pytest
+
+from fabric.api import settings
+
+from fabfile.utils import TaskGraph, UpgradeJournal, BudgetPool
+
+
+def record(calls, name):
+    calls.append(name)
+    return name
+
+
+def fail():
+    raise RuntimeError('failed')
+
+
+def test_task_graph_check():
+    graph = TaskGraph()
+    graph.add_step('a', record)
+    with pytest.raises(ValueError):
+        graph.add_step('a', record)
+    graph.add_step('b', record, requires=['c'])
+    with pytest.raises(ValueError):
+        graph.check()
+    graph.add_step('c', record, requires=['b'])
+    with pytest.raises(ValueError):
+        graph.check()
+
+
+def test_task_graph_sequential():
+    calls = []
+    graph = TaskGraph()
+    graph.add_step('c', record, args=(calls, 'c'), requires=['b'])
+    graph.add_step('a', record, args=(calls, 'a'))
+    graph.add_step('b', record, args=(calls, 'b'), requires=['a'])
+    results = graph.run()
+    assert calls == ['a', 'b', 'c']
+    assert results['b'] == {'<local-only>': 'b'}
+
+
+def test_task_graph_forked():
+    calls = []
+    graph = TaskGraph()
+    graph.add_step('a', record, args=(calls, 'a'))
+    graph.add_step('b', record, args=(calls, 'b'), fork=False)
+    graph.add_step('c', record, args=(calls, 'c'), requires=['a', 'b'])
+    results = graph.run(nb_process=2)
+    # forked steps can't update the fabric process
+    assert calls == ['b']
+    assert results['a'] == {'<local-only>': 'a'}
+    assert results['c'] == {'<local-only>': 'c'}
+
+
+def test_task_graph_failure():
+    calls = []
+    graph = TaskGraph()
+    graph.add_step('a', fail)
+    graph.add_step('b', record, args=(calls, 'b'), requires=['a'], fork=False)
+    with pytest.raises(SystemExit):
+        graph.run(nb_process=2)
+    assert calls == []
+
+
+def test_task_graph_journal(tmpdir):
+    with settings(name='test'):
+        journal = UpgradeJournal(path=str(tmpdir.join('journal.json')))
+        journal.mark_done('a')
+        journal.mark_done('bina', 'fr-idf')
+        resumed = UpgradeJournal(resume=True, path=journal.path)
+        assert resumed.is_done('a') and not resumed.is_done('b')
+        assert resumed.is_done('bina', 'fr-idf') and not resumed.is_done('bina', 'fr-nw')
+
+        graph = TaskGraph()
+        calls = []
+        graph.add_step('a', record, args=(calls, 'a'))
+        graph.add_step('b', record, args=(calls, 'b'), requires=['a'])
+        graph.run(journal=resumed)
+        assert calls == ['b']
+        assert UpgradeJournal(resume=True, path=journal.path).is_done('b')
+        resumed.clear()
+        assert not tmpdir.join('journal.json').check()
+
+
+def test_budget_pool():
+    import threading
+    import time
+    state = dict(used=0, max_used=0)
+    lock = threading.Lock()
+
+    def load(size):
+        with lock:
+            state['used'] += size
+            state['max_used'] = max(state['max_used'], state['used'])
+        time.sleep(0.01)
+        with lock:
+            state['used'] -= size
+        return size * 2
+
+    results = BudgetPool(budget=10, nb_thread=4).map(load, [(size, size) for size in (2, 9, 5, 4, 3)])
+    assert sorted(results) == [(2, 4), (3, 6), (4, 8), (5, 10), (9, 18)]
+    assert state['max_used'] <= 10
+    # a job bigger than the budget is run alone
+    results = BudgetPool(budget=10, nb_thread=4).map(load, [(12, 12), (1, 1)])
+    assert sorted(results) == [(1, 2), (12, 24)]
+    assert state['max_used'] <= 12
+
+
+def test_adaptive_limiter():
+    import mock
+    from fabfile import utils
+    idle = utils.HostLoad(0.1, 32 * 2 ** 30, 0.01)
+    busy = utils.HostLoad(1.5, 32 * 2 ** 30, 0.01)
+    with settings(adaptive_max_load=0.9, adaptive_min_memory=2 ** 30, adaptive_max_iowait=0.3), \
+            mock.patch.object(utils, 'sample_host_load', side_effect=[idle, idle, busy]):
+        limiter = utils.AdaptiveLimiter(1, 2, sample_interval=0)
+        with limiter:
+            assert limiter.limit == 2
+            with limiter:
+                assert limiter.limit == 2 and limiter.running == 2
+        limiter.adjust()
+        assert limiter.limit == 1
+
+
+def test_task_graph_resumed_after_a_failure(tmpdir):
+    calls, broken = [], ['b']
+
+    def step(name):
+        if name in broken:
+            raise RuntimeError('failed')
+        return record(calls, name)
+
+    def graph():
+        graph = TaskGraph()
+        graph.add_step('a', step, args=('a',))
+        graph.add_step('b', step, args=('b',), requires=['a'])
+        graph.add_step('c', step, args=('c',), requires=['b'])
+        return graph
+
+    with settings(name='test'):
+        journal = UpgradeJournal(path=str(tmpdir.join('journal.json')))
+        with pytest.raises(SystemExit):
+            graph().run(journal=journal)
+        assert calls == ['a']
+
+        del broken[:]
+        resumed = UpgradeJournal(resume=True, path=journal.path)
+        graph().run(journal=resumed)
+        # the completed step is skipped, the failed one is run again
+        assert calls == ['a', 'b', 'c']
+        assert all(resumed.is_done(name) for name in 'abc')
@@ -0,0 +1,29 @@
+# encoding: utf-8
+
+import hashlib
+import mock
+
+from fabric.api import env, settings
+
+from fabfile import utils
+
+
+def test_upload_only_changed_templates():
+    context = {'env': env}
+    text = utils._render_template('tyr/tyr.wsgi.jinja', context,
+                                  utils.os.path.join(utils.os.path.dirname(utils.__file__), '..', 'templates'))
+    md5 = hashlib.md5(text).hexdigest()
+    with settings(host_string='h1', upload_only_changed_templates=True, backup_conf_files=False), \
+            mock.patch.object(utils, 'upload_template') as upload, \
+            mock.patch.object(utils, 'run_as_root', return_value='{}  /f1\n'.format(md5)) as md5sum:
+        assert utils.fetch_remote_checksums(['/f1', '/f2']) == {'/f1': md5, '/f2': None}
+        assert md5sum.call_count == 1
+        assert not utils._upload_template('tyr/tyr.wsgi.jinja', '/f1', context=context)
+        assert utils._upload_template('tyr/tyr.wsgi.jinja', '/f2', context=context)
+        assert upload.call_count == 1
+        # the uploaded file is checked again on the next upload
+        md5sum.return_value = '{}  /f2\n'.format(md5)
+        assert not utils._upload_template('tyr/tyr.wsgi.jinja', '/f2', context=context)
+        assert md5sum.call_count == 2
+    assert utils.changed_files({'h1': ['/f1'], 'h2': {'h3': ['/f2']}, 'h4': None}) in \
+        (['/f1', '/f2'], ['/f2', '/f1'])
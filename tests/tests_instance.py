@@ -131,3 +131,18 @@ def test_multiple_zmq_server():
     assert instance.kraken_engines == ['root@bbb', 'root@ccc']
     assert instance.jormungandr_zmq_socket_for_instance == 'tcp://vip.truc:30001'
     assert instance.kraken_zmq_socket == 'tcp://*:30001'
+
+
+def test_kraken_local_data():
+    env.use_zmq_socket_file = True
+    env.roledefs = {
+        'eng': ('root@aaa', 'root@bbb')
+    }
+    instance = add_instance('toto', 'passwd')
+    with settings(kraken_database_file='{base_dest}/{instance}/data.nav.lz4', ed_basedir='/srv/ed',
+                  tyr_base_destination_dir='/srv/ed/data'):
+        with settings(kraken_local_data_dir=None):
+            assert instance.kraken_database == '/srv/ed/data/toto/data.nav.lz4'
+        with settings(kraken_local_data_dir='/srv/kraken_data'):
+            assert instance.kraken_database == '/srv/kraken_data/toto/data.nav.lz4'
+            assert instance.kraken_shared_database == '/srv/ed/data/toto/data.nav.lz4'